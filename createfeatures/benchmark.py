@@ -0,0 +1,284 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import resource
+import tracemalloc
+import h5py
+import numpy as np
+
+import features
+import synthetic
+
+
+def load_expt_datasets(expt_path):
+    """Load all datasets of an experiment dataset into memory.
+
+    Args:
+        expt_path: Path to experiment dataset.
+
+    Returns:
+        A tuple of (data, n_frames) where data is a dictionary mapping dataset names to
+        arrays.
+    """
+    data = dict()
+    with h5py.File(expt_path, "r") as f:
+        n_frames = features.get_n_frames(f)
+        for name, ds in f.items():
+            if isinstance(ds, h5py.Dataset):
+                data[name] = ds[()]
+    return data, n_frames
+
+def benchmark_storage_profile(data, n_frames, output_path, storage, n_reads=200, read_frames=300, seed=0):
+    """Measure write time, file size and read latency of a storage profile.
+
+    Args:
+        data: Dictionary of datasets to write (see load_expt_datasets).
+        n_frames: Number of frames in the experiment.
+        output_path: Path to write the test file to. It is deleted afterwards.
+        storage: Name of a profile in STORAGE_PROFILES or a profile dictionary.
+        n_reads: Number of random slices to read.
+        read_frames: Number of frames in each random slice.
+        seed: Seed of the random slices.
+
+    Returns:
+        A dictionary with the write time in seconds, file size in bytes, median and 95th
+        percentile random-slice read latency in milliseconds and the time to read a full
+        time-aligned feature in milliseconds.
+    """
+    t0 = time.perf_counter()
+    with h5py.File(output_path, "w") as f:
+        for name, x in data.items():
+            features.write_dataset(f, name, x, n_frames=n_frames, storage=storage)
+        f.attrs["n_frames"] = n_frames
+    write_time = time.perf_counter() - t0
+    size = os.path.getsize(output_path)
+
+    # Read random slices of time-aligned features, reopening the file each time as an
+    # analysis of a single window would.
+    rng = np.random.default_rng(seed)
+    names = [k for k, v in data.items() if np.ndim(v) > 0 and len(v) == n_frames and v.dtype.kind in "biuf"]
+    latencies = []
+    for _ in range(n_reads):
+        name = names[rng.integers(len(names))]
+        f0 = rng.integers(max(n_frames - read_frames, 1))
+        t0 = time.perf_counter()
+        with h5py.File(output_path, "r") as f:
+            f[name][f0:f0 + read_frames]
+        latencies.append((time.perf_counter() - t0) * 1000)
+
+    t0 = time.perf_counter()
+    with h5py.File(output_path, "r") as f:
+        for name in names:
+            f[name][:]
+    full_read = (time.perf_counter() - t0) * 1000 / len(names)
+
+    os.remove(output_path)
+    return {
+        "write_s": write_time,
+        "size_mb": size / 1024 ** 2,
+        "read_ms_median": np.median(latencies),
+        "read_ms_p95": np.percentile(latencies, 95),
+        "full_read_ms": full_read,
+    }
+
+def benchmark_storage(expt_path, profiles=None, tmp_dir=None, n_reads=200, read_frames=300):
+    """Compare storage profiles on the datasets of an experiment.
+
+    Args:
+        expt_path: Path to an existing experiment dataset.
+        profiles: List of profile names to compare. Defaults to all STORAGE_PROFILES.
+        tmp_dir: Folder to write the test files to. This should be on the filesystem to
+            benchmark. Defaults to the folder of expt_path.
+        n_reads: Number of random slices to read per profile.
+        read_frames: Number of frames in each random slice.
+
+    Returns:
+        A dictionary mapping each profile name to its results (see
+        benchmark_storage_profile).
+    """
+    if profiles is None:
+        profiles = list(features.STORAGE_PROFILES)
+    if tmp_dir is None:
+        tmp_dir = os.path.dirname(os.path.abspath(expt_path))
+
+    data, n_frames = load_expt_datasets(expt_path)
+    print(f"Benchmarking {len(profiles)} storage profiles on {expt_path} ({n_frames} frames)")
+    print(f"{'profile':<14}{'write (s)':>10}{'size (MB)':>11}{'read p50 (ms)':>15}{'read p95 (ms)':>15}{'full read (ms)':>16}")
+    results = dict()
+    for profile in profiles:
+        output_path = os.path.join(tmp_dir, f".benchmark_{profile}_{os.getpid()}.h5")
+        r = benchmark_storage_profile(data, n_frames, output_path, profile, n_reads=n_reads, read_frames=read_frames)
+        results[profile] = r
+        print(f"{profile:<14}{r['write_s']:>10.2f}{r['size_mb']:>11.1f}{r['read_ms_median']:>15.2f}{r['read_ms_p95']:>15.2f}{r['full_read_ms']:>16.1f}")
+    return results
+
+def measure_stage(func, *args, **kwargs):
+    """Run a function and measure its run time and peak memory.
+
+    Peak memory is the largest amount of memory allocated through Python (including
+    numpy arrays) while the function runs, measured with tracemalloc.
+
+    Returns:
+        A tuple of (result, stats) where stats is a dictionary with "time_s" and
+        "peak_mb".
+    """
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter() - t0
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, {"time_s": elapsed, "peak_mb": peak / 1024 ** 2}
+
+def benchmark_pipeline_stages(expt_folder, ctr_ind=1, fwd_ind=0):
+    """Time each stage of the feature pipeline on one experiment.
+
+    Args:
+        expt_folder: Path to the experiment folder.
+        ctr_ind: Index of centroid joint. Defaults to 1.
+        fwd_ind: Index of "forward" joint (e.g., head). Defaults to 0.
+
+    Returns:
+        A dictionary mapping each stage name to its stats (see measure_stage).
+    """
+    stats = dict()
+    _, stats["get_expt_sync"] = measure_stage(features.get_expt_sync, expt_folder)
+    (tracks, _), stats["load_tracks"] = measure_stage(features.load_tracks, expt_folder)
+    _, stats["normalize_to_egocentric"] = measure_stage(features.normalize_to_egocentric, tracks[..., 1], ctr_ind=ctr_ind, fwd_ind=fwd_ind)
+    _, stats["compute_features"] = measure_stage(
+        features.compute_features, tracks[:, ctr_ind, :, 0], tracks[:, ctr_ind, :, 1], tracks[:, fwd_ind, :, 0], tracks[:, fwd_ind, :, 1]
+    )
+    _, stats["compute_wing_arc_angles"] = measure_stage(features.compute_wing_arc_angles, tracks[..., 1], tracks[..., 0])
+    _, stats["load_song_intervals"] = measure_stage(features.load_song_intervals, expt_folder, use_cache=False)
+    del tracks
+    _, stats["make_expt_dataset"] = measure_stage(features.make_expt_dataset, expt_folder, output_path=expt_folder, overwrite=True, ctr_ind=ctr_ind, fwd_ind=fwd_ind)
+    return stats
+
+def benchmark_pipeline(durations=(600, 3600, 14400), tmp_dir=None, n_channels=2, keep=False, seed=0):
+    """Time the feature pipeline on synthetic experiments of several lengths.
+
+    Args:
+        durations: Recording lengths in seconds. Defaults to 10 min, 1 h and 4 h.
+        tmp_dir: Folder to write the synthetic experiments to. Defaults to the system
+            temporary folder.
+        n_channels: Number of audio channels to write. Audio is not read by the
+            pipeline, so this only affects the size of daq.h5.
+        keep: If True, do not delete the synthetic experiments.
+        seed: Random seed of the synthetic data.
+
+    Returns:
+        A dictionary mapping each duration to the stats of each stage (see
+        benchmark_pipeline_stages), the time to generate the data ("generate") and the
+        peak resident memory of the process so far ("max_rss_mb").
+    """
+    results = dict()
+    for duration in durations:
+        expt_folder = tempfile.mkdtemp(prefix=f"synthetic_{int(duration)}s_", dir=tmp_dir)
+        try:
+            t0 = time.perf_counter()
+            synthetic.make_synthetic_expt(expt_folder, duration=duration, n_channels=n_channels, seed=seed)
+            generate_time = time.perf_counter() - t0
+            stats = benchmark_pipeline_stages(expt_folder)
+        finally:
+            if not keep:
+                shutil.rmtree(expt_folder, ignore_errors=True)
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        results[duration] = dict(stats, generate={"time_s": generate_time}, max_rss_mb=max_rss)
+
+        print(f"\nDuration: {duration / 60:.0f} min (data generated in {generate_time:.1f} s)")
+        print(f"{'stage':<26}{'time (s)':>10}{'peak (MB)':>11}")
+        for stage, r in stats.items():
+            print(f"{stage:<26}{r['time_s']:>10.2f}{r['peak_mb']:>11.1f}")
+        print(f"{'max RSS of process (MB)':<26}{max_rss:>21.1f}")
+    return results
+
+# Rotational speed and subtended angles can change by one rounding step of signed_angle.
+PRECISION_TOLERANCES = {name: features.SIGNED_ANGLE_RESOLUTION + 0.01 for name in ["mRS", "fRS", "mfAng", "fmAng"]}
+
+def benchmark_precision(expt_folder, names=None, max_error=0.1, ctr_ind=1, fwd_ind=0):
+    """Compare the tracking features computed in float32 and float64.
+
+    Args:
+        expt_folder: Path to the experiment folder.
+        names: List of features to compare. Defaults to all TRACKING_FEATURES.
+        max_error: Largest absolute error allowed in the units of each feature
+            (pixels, degrees, pixels per frame...) unless set in PRECISION_TOLERANCES.
+            Defaults to 0.1.
+        ctr_ind: Index of centroid joint. Defaults to 1.
+        fwd_ind: Index of "forward" joint (e.g., head). Defaults to 0.
+
+    Returns:
+        A tuple of (results, failed). results maps each feature to a dictionary with the
+        maximum and 99.9th percentile absolute error over frames where both are finite,
+        and the number of frames that are finite in only one of them. "time_s" and
+        "peak_mb" of computing all features in each precision are saved under the
+        "float64" and "float32" keys. failed is a list of features whose maximum error
+        is larger than its tolerance or whose missing values differ.
+    """
+    if names is None:
+        names = features.TRACKING_FEATURES
+    results = dict()
+    (data64, _), results["float64"] = measure_stage(features.compute_tracking_stage, expt_folder, ctr_ind=ctr_ind, fwd_ind=fwd_ind, features=names)
+    (data32, _), results["float32"] = measure_stage(features.compute_tracking_stage, expt_folder, ctr_ind=ctr_ind, fwd_ind=fwd_ind, features=names, dtype="float32")
+
+    failed = []
+    print(f"{'feature':<12}{'max error':>12}{'p99.9 error':>13}{'NaN mismatch':>14}")
+    for name in names:
+        x, y = data64[name], data32[name].astype("float64")
+        is_finite = np.isfinite(x) & np.isfinite(y)
+        err = np.abs(x - y)[is_finite]
+        r = {
+            "max_error": float(err.max()) if err.size > 0 else 0.0,
+            "p999_error": float(np.percentile(err, 99.9)) if err.size > 0 else 0.0,
+            "nan_mismatch": int((np.isfinite(x) != np.isfinite(y)).sum()),
+        }
+        results[name] = r
+        if r["max_error"] > PRECISION_TOLERANCES.get(name, max_error) or r["nan_mismatch"] > 0:
+            failed.append(name)
+        print(f"{name:<12}{r['max_error']:>12.2g}{r['p999_error']:>13.2g}{r['nan_mismatch']:>14}{'  FAIL' if name in failed else ''}")
+    for precision in ["float64", "float32"]:
+        print(f"{precision}: {results[precision]['time_s']:.2f} s, peak {results[precision]['peak_mb']:.1f} MB")
+    return results, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    storage_parser = subparsers.add_parser("storage", help='compare storage profiles on an existing dataset')
+    storage_parser.add_argument('expt_path', type=str, help='path to an experiment dataset (.h5) created by features.py')
+    storage_parser.add_argument('-p', '--profiles', type=str, nargs='+', default=None, help='storage profiles to compare (default: all)')
+    storage_parser.add_argument('-t', '--tmp_dir', type=str, default=None, help='folder to write test files to (default: folder of the dataset)')
+    storage_parser.add_argument('-n', '--n_reads', type=int, default=200, help='number of random slices to read')
+    storage_parser.add_argument('-w', '--read_frames', type=int, default=300, help='number of frames per random slice')
+
+    pipeline_parser = subparsers.add_parser("pipeline", help='time the pipeline stages on synthetic experiments')
+    pipeline_parser.add_argument('-d', '--durations', type=float, nargs='+', default=[600, 3600, 14400], help='recording lengths in seconds (default: 10 min, 1 h and 4 h)')
+    pipeline_parser.add_argument('-t', '--tmp_dir', type=str, default=None, help='folder to write synthetic experiments to (default: system temp folder)')
+    pipeline_parser.add_argument('-c', '--channels', type=int, default=2, help='number of audio channels in the synthetic daq.h5')
+    pipeline_parser.add_argument('-o', '--output', type=str, default=None, help='JSON file to save the results to')
+    pipeline_parser.add_argument('--keep', action='store_true', help='keep the synthetic experiments')
+
+    precision_parser = subparsers.add_parser("precision", help='compare features computed in float32 and float64')
+    precision_parser.add_argument('expt_folder', type=str, help='path to an experiment folder')
+    precision_parser.add_argument('-f', '--features', type=str, nargs='+', default=None, help='features to compare (default: all)')
+    precision_parser.add_argument('-m', '--max_error', type=float, default=0.1, help='largest absolute error allowed in each feature')
+
+    args = parser.parse_args()
+
+    if args.command == "storage":
+        benchmark_storage(args.expt_path, profiles=args.profiles, tmp_dir=args.tmp_dir, n_reads=args.n_reads, read_frames=args.read_frames)
+    elif args.command == "precision":
+        _, failed = benchmark_precision(args.expt_folder, names=args.features, max_error=args.max_error)
+        if len(failed) > 0:
+            raise SystemExit(f"float32 error too large in: {', '.join(failed)}")
+    else:
+        results = benchmark_pipeline(args.durations, tmp_dir=args.tmp_dir, n_channels=args.channels, keep=args.keep)
+        if args.output is not None:
+            with open(args.output, "w") as f:
+                json.dump({str(k): v for k, v in results.items()}, f, indent=2)
@@ -4,11 +4,20 @@
 import os
 import h5py
 import numpy as np
-import pandas as pd
-import scipy.ndimage
-import scipy.io
-import scipy.interpolate
 import argparse
+import collections
+import functools
+import hashlib
+import json
+import time
+import logging
+import resource
+import contextlib
+import tracemalloc
+import threading
+import concurrent.futures
+
+logger = logging.getLogger("features")
 
 fly_nodes = [
  'head',
@@ -25,15 +34,14 @@ fly_nodes = [
  'eyeL',
  'eyeR']
 
-def load_tracks(expt_folder):
-    """Load proofread and exported pose tracks.
+def find_track_file(expt_folder):
+    """Find the exported pose tracking file of an experiment.
+
     Args:
-        expt_folder: Path to experiment folder containing inference.cleaned.proofread.tracking.h5.
+        expt_folder: Path to experiment folder or directly to the tracking file.
+
     Returns:
-        Tuple of (tracks, node_names).
-        tracks contain the pose estimates in an array of shape (frame, joint, xy, fly).
-        The last axis is ordered as [female, male].
-        node_names contains a list of string names for the joints.
+        Path to the tracking file.
     """
     if os.path.isdir(expt_folder):
         track_file = os.path.join(expt_folder, "inference.cleaned.proofread.tracking.h5")
@@ -42,61 +50,263 @@ def load_tracks(expt_folder):
         if not os.path.exists(track_file):
             track_file = os.path.join(expt_folder, os.path.basename(expt_folder)+'.tracking.h5')
         if not os.path.exists(track_file):
-            print('No proofread tracking file found. Using ".cleaned.tracking.h5" instead')
+            logger.warning('No proofread tracking file found. Using ".cleaned.tracking.h5" instead')
             track_file = os.path.join(expt_folder, os.path.basename(expt_folder)+'.000000.mp4.inference.cleaned.tracking.h5')
     else:
         track_file = expt_folder
+    return track_file
+
+def load_tracks(expt_folder, nodes=None, dtype=None, chunk_frames=2**14):
+    """Load proofread and exported pose tracks.
+
+    Only the requested nodes and the tracked frames are read from the file, in blocks
+    that are transposed directly into the output array.
+
+    Args:
+        expt_folder: Path to experiment folder containing inference.cleaned.proofread.tracking.h5.
+        nodes: Optional list of names or indices of the nodes to load. Defaults to all.
+        dtype: Optional data type of the output (e.g., "float32"). Defaults to the data
+            type of the file.
+        chunk_frames: Number of frames to read at a time.
+    Returns:
+        Tuple of (tracks, node_names).
+        tracks contain the pose estimates in an array of shape (frame, joint, xy, fly).
+        The last axis is ordered as [female, male].
+        node_names contains a list of string names for the joints.
+
+    Notes:
+        The tracks are cropped before the last frame with any tracked node (of any
+        node, so that the number of frames does not depend on the selected nodes).
+    """
+    track_file = find_track_file(expt_folder)
     with h5py.File(track_file, "r") as f:
-        tracks = np.transpose(f["tracks"][:])  # (frame, joint, xy, fly)
-        node_names = f["node_names"][:]
-        node_names = [x.decode() for x in node_names]
+        ds = f["tracks"]  # (fly, xy, joint, frame)
+        node_names = [x.decode() for x in f["node_names"][:]]
+        if nodes is None:
+            node_inds = list(range(len(node_names)))
+        else:
+            node_inds = [node_names.index(x) if isinstance(x, str) else int(x) for x in nodes]
+        node_names = [node_names[i] for i in node_inds]
+
+        # Crop to valid range.
+        n_frames = max(find_last_tracked_frame(ds), 0)
 
-    # Crop to valid range.
-    last_fidx = np.argwhere(np.isfinite(tracks.reshape(len(tracks), -1)).any(axis=-1)).squeeze()[-1]
-    tracks = tracks[:last_fidx]
+        # h5py selections must be increasing, so read the sorted nodes and reorder.
+        read_inds = sorted(set(node_inds))
+        order = [read_inds.index(i) for i in node_inds]
+        sel = slice(None) if read_inds == list(range(ds.shape[2])) else read_inds
+        tracks = np.empty((n_frames, len(node_inds), ds.shape[1], ds.shape[0]), dtype=ds.dtype if dtype is None else dtype)
+        for f0 in range(0, n_frames, chunk_frames):
+            f1 = min(f0 + chunk_frames, n_frames)
+            tracks[f0:f1] = np.transpose(ds[:, :, sel, f0:f1])[:, order]
 
     return tracks, node_names
 
-def get_expt_sync(expt_folder):
+def find_runs(x, is_on, chunk_size=2**20):
+    """Find runs of consecutive "on" samples in a long vector.
+
+    The vector is read in blocks, carrying the on/off state across block edges, so
+    that it never has to be fully loaded into memory.
+
+    Args:
+        x: 1D array-like that supports slicing (e.g., an h5py.Dataset).
+        is_on: Function that takes a block of samples and returns a boolean array of
+            whether each sample is "on".
+        chunk_size: Number of samples to read at a time. Defaults to 2 ** 20.
+
+    Returns:
+        A tuple of (starts, ends) containing the first sample index and the sample
+        index after the end of each run.
+    """
+    n_samples = x.shape[0]
+    starts, ends = [], []
+    prev_on = False
+    for i0 in range(0, n_samples, chunk_size):
+        on = is_on(np.asarray(x[i0:i0 + chunk_size]).reshape(-1))
+        if len(on) == 0:
+            break
+        edges = np.diff(on.astype("int8"), prepend=np.int8(prev_on))
+        starts.append(np.flatnonzero(edges == 1) + i0)
+        ends.append(np.flatnonzero(edges == -1) + i0)
+        prev_on = on[-1]
+    if prev_on:
+        ends.append(np.array([n_samples]))
+
+    starts = np.concatenate(starts) if len(starts) > 0 else np.array([], dtype=int)
+    ends = np.concatenate(ends) if len(ends) > 0 else np.array([], dtype=int)
+    return starts, ends
+
+def find_exposure_pulses(sync, chunk_size=2**20, threshold=1.5):
+    """Find camera exposure pulses in a synchronization signal.
+
+    Args:
+        sync: 1D array-like containing the exposure signal (e.g., an h5py.Dataset).
+        chunk_size: Number of samples to read at a time. Defaults to 2 ** 20.
+        threshold: Samples that are not below this value are considered exposed.
+            Defaults to 1.5.
+
+    Returns:
+        A tuple of (starts, ends) containing the first sample index and the sample
+        index after the end of each pulse.
+    """
+    return find_runs(sync, lambda x: ~(x < threshold), chunk_size=chunk_size)
+
+class SampleFrameMap:
+    """Lazy lookup of the video frame index at each DAQ sample.
+
+    This behaves like the dense vector of frame indices at each sample (the nearest
+    frame, extrapolated to the first/last frame at the edges), but values are
+    computed on demand by binary search against sample_at_frame.
+
+    Args:
+        sample_at_frame: A vector of the length of the number of frames where each
+            element is the estimated DAQ sample index.
+        n_samples: Total number of samples in the recording.
+    """
+    def __init__(self, sample_at_frame, n_samples):
+        self.sample_at_frame = np.asarray(sample_at_frame)
+        self.n_samples = int(n_samples)
+
+        # Halfway points between frames (same as nearest neighbor interpolation).
+        bounds = self.sample_at_frame / 2.0
+        self.bounds = bounds[1:] + bounds[:-1]
+
+    def __len__(self):
+        return self.n_samples
+
+    @property
+    def shape(self):
+        return (self.n_samples,)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            idx = np.arange(*idx.indices(self.n_samples))
+        else:
+            idx = np.asarray(idx)
+            idx = np.where(idx < 0, idx + self.n_samples, idx)
+        return np.searchsorted(self.bounds, idx, side="left")
+
+    def __array__(self, dtype=None, copy=None):
+        frames = self[:]
+        if dtype is not None:
+            frames = frames.astype(dtype)
+        return frames
+
+def get_expt_sync(expt_folder, chunk_size=2**20):
     """Computes the sample/frame maps from experiment synchronization.
 
     Args:
         expt_folder: Path to experiment folder with daq.h5.
+        chunk_size: Number of samples of the sync channel to read at a time.
     Returns:
         frame_daq_sample: A vector of the length of the number of frames where each
             element is the estimated DAQ sample index.
-        daq_frame_idx: A vector of the lenght of the number of samples where each
-            element is the estimated video frame index.
+        daq_frame_idx: A SampleFrameMap that can be indexed like a vector of the
+            length of the number of samples where each element is the estimated video
+            frame index.
     """
     with h5py.File(os.path.join(expt_folder, "daq.h5"), "r") as f:
-        try:
-            trigger = f["sync"][:]
-        except KeyError:
-            trigger = f["Sync"][:]
-
-    # Threshold exposure signal.
-    trigger[trigger[:] < 1.5] = 0
-    trigger[trigger[:] > 1.5] = 1
-
-    # Find connected components.
-    daq2frame, n_frames = scipy.ndimage.measurements.label(trigger)
-
-    # Compute sample at each frame.
-    frame_idx, frame_time, count = np.unique(daq2frame, return_index=True,
-                                             return_counts=True)
-    frame_daq_sample = frame_time[1:] + (count[1:] - 1) / 2
-
-    # Interpolate frame at each sample.
-    f = scipy.interpolate.interp1d(
-        frame_daq_sample,
-        np.arange(frame_daq_sample.shape[0]),
-        kind="nearest",
-        fill_value="extrapolate"
-    )
-    daq_frame_idx = f(np.arange(trigger.shape[0]))
+        sync = f["sync"] if "sync" in f else f["Sync"]
+        n_samples = sync.shape[0]
+
+        # Find exposure pulses.
+        starts, ends = find_exposure_pulses(sync, chunk_size=chunk_size)
+
+    # Compute sample at each frame (pulse center).
+    frame_daq_sample = starts + (ends - starts - 1) / 2
+
+    # Frame at each sample.
+    daq_frame_idx = SampleFrameMap(frame_daq_sample, n_samples)
 
     return frame_daq_sample, daq_frame_idx
 
+def find_song_file(expt_folder):
+    """Find the song segmentation file of an experiment.
+
+    Args:
+        expt_folder: Path to experiment folder.
+
+    Returns:
+        Path to daq_segmentation_new.mat if it exists, otherwise to song.mat.
+    """
+    seg_path = os.path.join(expt_folder, "daq_segmentation_new.mat")
+    if not os.path.exists(seg_path):
+        seg_path = os.path.join(expt_folder, "song.mat")
+    return seg_path
+
+class MatVector:
+    """A vector stored in a MATLAB v7.3 (HDF5) file that is read on demand.
+
+    MATLAB stores row and column vectors as 2D datasets of shape (n, 1) or (1, n).
+    This exposes them as 1D array-likes that can be sliced.
+
+    Args:
+        ds: The h5py.Dataset containing the vector.
+    """
+    def __init__(self, ds):
+        self.ds = ds
+        self.axis = int(np.argmax(ds.shape)) if ds.ndim == 2 else 0
+        self.shape = (ds.shape[self.axis],)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        if self.ds.ndim == 1:
+            return self.ds[idx]
+        elif self.axis == 0:
+            return self.ds[idx, 0]
+        else:
+            return self.ds[0, idx]
+
+def read_mat_strings(f, ds):
+    """Read a cell array of strings or a char matrix from a MATLAB v7.3 file.
+
+    Args:
+        f: The open h5py.File.
+        ds: The h5py.Dataset containing the cell array or char matrix.
+
+    Returns:
+        An array of strings.
+    """
+    if h5py.check_dtype(ref=ds.dtype) is not None:
+        return np.array(["".join(map(chr, f[ref][()].ravel())) for ref in ds[()].ravel()])
+    chars = ds[()].reshape(ds.shape[0], -1)  # (string length, n)
+    return np.array(["".join(map(chr, chars[:, i])) for i in range(chars.shape[1])])
+
+def read_mat_bouts(f):
+    """Read the bout limits and types from the bInf struct of a MATLAB v7.3 file.
+
+    Args:
+        f: The open h5py.File.
+
+    Returns:
+        A tuple of (bout_lims, bout_types) containing an (n, 2) array of start and end
+        sample indices and an array of n type strings (e.g., "Pul", "Sin", "Mix").
+    """
+    if "MATLAB_empty" in f["bInf"]["stEn"].attrs and f["bInf"]["stEn"].attrs["MATLAB_empty"]:
+        return np.zeros((0, 2)), np.array([], dtype=str)
+    bout_lims = f["bInf"]["stEn"][()].T
+    bout_types = read_mat_strings(f, f["bInf"]["Type"])
+    return bout_lims, bout_types
+
+def split_bouts(bout_lims, bout_types):
+    """Split bout limits by bout type.
+
+    Args:
+        bout_lims: Array of start and end sample indices of each bout.
+        bout_types: Array of type strings of each bout. MAT files written by MATLAB or
+            loaded with scipy.io.loadmat store these as an (n, 1) or (1, n) cell array
+            of (1,) string arrays, which is flattened first.
+
+    Returns:
+        A tuple of (pulse_bouts, sine_bouts, mix_bouts) with the (n, 2) limits of the
+        bouts of each type.
+    """
+    bout_lims = np.reshape(bout_lims, (-1, 2))
+    bout_types = np.array([str(np.squeeze(t)) for t in np.ravel(bout_types)])
+    return tuple(bout_lims[np.flatnonzero(bout_types == x)] for x in ["Pul", "Sin", "Mix"])
+
 def load_song(expt_folder, return_audio=False):
     """Load song segmentation.
 
@@ -112,33 +322,150 @@ def load_song(expt_folder, return_audio=False):
         start and end sample indices for predicted bouts.
 
         If return_audio is True, then also returns a vector with the merged audio.
-    """
-    seg_path = os.path.join(expt_folder, "daq_segmentation_new.mat")
-    if not os.path.exists(seg_path):
-        seg_path = os.path.join(expt_folder, "song.mat")
 
-    var_names = ["sine", "pfast", "pslow", "bInf"]
-    if return_audio:
-        var_names.append("song")
-    seg = scipy.io.loadmat(seg_path, variable_names=var_names)
+    Notes:
+        Both MATLAB v7.3 (HDF5) files and older MAT files are supported. If only the
+        song intervals are needed, load_song_intervals is much faster.
+    """
+    seg_path = find_song_file(expt_folder)
+
+    if h5py.is_hdf5(seg_path):
+        with h5py.File(seg_path, "r") as f:
+            bout_lims, bout_types = read_mat_bouts(f)
+            pslow = MatVector(f["pslow"])[:] > 0
+            pfast = MatVector(f["pfast"])[:] > 0
+            sine = MatVector(f["sine"])[:] > 0
+            if return_audio:
+                song = MatVector(f["song"])[:]
+    else:
+        import scipy.io
+        var_names = ["sine", "pfast", "pslow", "bInf"]
+        if return_audio:
+            var_names.append("song")
+        seg = scipy.io.loadmat(seg_path, variable_names=var_names)
+
+        bout_lims = seg["bInf"]["stEn"][0][0]
+        bout_types = seg["bInf"]["Type"][0][0]
+
+        # Masks.
+        pslow = (seg["pslow"] > 0).squeeze()
+        pfast = (seg["pfast"] > 0).squeeze()
+        sine = (seg["sine"] > 0).squeeze()
+        if return_audio:
+            song = seg["song"].squeeze()
 
     # Bout sample limits.
-    bout_lims = seg["bInf"]["stEn"][0][0]
-    pulse_bouts = bout_lims[np.where(seg["bInf"]["Type"][0][0] == "Pul")[0]]
-    sine_bouts = bout_lims[np.where(seg["bInf"]["Type"][0][0] == "Sin")[0]]
-    mix_bouts = bout_lims[np.where(seg["bInf"]["Type"][0][0] == "Mix")[0]]
-
-    # Masks.
-    pslow = (seg["pslow"] > 0).squeeze()
-    pfast = (seg["pfast"] > 0).squeeze()
-    sine = (seg["sine"] > 0).squeeze()
+    pulse_bouts, sine_bouts, mix_bouts = split_bouts(bout_lims, bout_types)
 
     if return_audio:
-        song = seg["song"].squeeze()
         return pslow, pfast, sine, pulse_bouts, sine_bouts, mix_bouts, song
     else:
         return pslow, pfast, sine, pulse_bouts, sine_bouts, mix_bouts
 
+def load_song_audio(expt_folder):
+    """Load the merged audio track from the song segmentation file.
+
+    Args:
+        expt_folder: Path to experiment folder.
+
+    Returns:
+        A vector with the merged audio.
+    """
+    seg_path = find_song_file(expt_folder)
+    if h5py.is_hdf5(seg_path):
+        with h5py.File(seg_path, "r") as f:
+            return MatVector(f["song"])[:]
+    import scipy.io
+    return scipy.io.loadmat(seg_path, variable_names=["song"])["song"].squeeze()
+
+# Names of the arrays returned by load_song_intervals.
+SONG_INTERVALS = ["pslow_lims", "pfast_lims", "sine_lims", "pulse_bouts", "sine_bouts", "mix_bouts"]
+
+# Version of the song intervals cache. Caches written by other versions are rebuilt
+# (version 1 split the bouts of older MAT files incorrectly).
+SONG_CACHE_VERSION = 2
+
+def load_song_intervals(expt_folder, use_cache=True, chunk_size=2**22):
+    """Load song segmentation as intervals, using a compact sidecar cache.
+
+    On the first call, the song file is parsed and the bout limits and run-length
+    song intervals are saved next to it as "<song file>.intervals.h5". Later calls
+    read only the cache as long as the song file has not changed.
+
+    MATLAB v7.3 (HDF5) files are read lazily in blocks, so the per-sample masks are
+    never fully loaded into memory.
+
+    Args:
+        expt_folder: Path to experiment folder.
+        use_cache: If True, read from and write to the cache. Defaults to True.
+        chunk_size: Number of samples to read at a time from v7.3 files.
+
+    Returns:
+        A dictionary with keys:
+
+        pslow_lims, pfast_lims, sine_lims: (n, 2) arrays containing the start and end
+        (exclusive) sample indices of each run of detected song.
+
+        pulse_bouts, sine_bouts, mix_bouts: (n, 2) arrays containing the start and end
+        sample indices for predicted bouts.
+
+        n_samples: Number of samples in the recording.
+    """
+    seg_path = find_song_file(expt_folder)
+    cache_path = seg_path + ".intervals.h5"
+
+    # The cache is valid if it has the current version and the contents of the song file
+    # did not change.
+    previous = None
+    if use_cache and os.path.exists(cache_path):
+        try:
+            with h5py.File(cache_path, "r") as f:
+                if f.attrs.get("version", 1) == SONG_CACHE_VERSION:
+                    previous = json.loads(f.attrs["source"])
+        except (OSError, KeyError, ValueError):
+            pass
+    source = file_fingerprint(seg_path, previous=previous)
+
+    if previous is not None and "sha1" in previous and same_file_contents(previous, source):
+        try:
+            with h5py.File(cache_path, "r+" if previous != source else "r") as f:
+                song = {k: f[k][:] for k in SONG_INTERVALS}
+                song["n_samples"] = int(f.attrs["n_samples"])
+                if previous != source:
+                    f.attrs["source"] = json.dumps(source)
+                return song
+        except (OSError, KeyError):
+            pass
+
+    song = dict()
+    if h5py.is_hdf5(seg_path):
+        with h5py.File(seg_path, "r") as f:
+            for name in ["pslow", "pfast", "sine"]:
+                mask = MatVector(f[name])
+                song[f"{name}_lims"] = np.stack(find_runs(mask, lambda x: x > 0, chunk_size=chunk_size), axis=1)
+            song["n_samples"] = len(mask)
+            bout_lims, bout_types = read_mat_bouts(f)
+        song["pulse_bouts"], song["sine_bouts"], song["mix_bouts"] = split_bouts(bout_lims, bout_types)
+    else:
+        pslow, pfast, sine, song["pulse_bouts"], song["sine_bouts"], song["mix_bouts"] = load_song(expt_folder)
+        song["pslow_lims"] = connected_components1d(pslow, return_limits=True).reshape(-1, 2)
+        song["pfast_lims"] = connected_components1d(pfast, return_limits=True).reshape(-1, 2)
+        song["sine_lims"] = connected_components1d(sine, return_limits=True).reshape(-1, 2)
+        song["n_samples"] = len(sine)
+
+    if use_cache:
+        try:
+            with h5py.File(cache_path, "w") as f:
+                for k in SONG_INTERVALS:
+                    f.create_dataset(k, data=song[k])
+                f.attrs["n_samples"] = song["n_samples"]
+                f.attrs["source"] = json.dumps(source)
+                f.attrs["version"] = SONG_CACHE_VERSION
+        except OSError as e:
+            logger.warning(f"Could not write song cache to {cache_path}: {e}")
+
+    return song
+
 def h5read(filename, dataset):
     """Load a single dataset from HDF5 file.
 
@@ -152,13 +479,249 @@ def h5read(filename, dataset):
     with h5py.File(filename, "r") as f:
         return f[dataset][:]
 
+class FeatureDataset:
+    """Reader of an experiment dataset that keeps the file open.
+
+    Features are exposed as h5py datasets that are only read when sliced, and small
+    metadata is read once and cached. This avoids reopening the file for every read in
+    random-access analysis loops.
+
+    Args:
+        expt_path: Path to experiment dataset.
+        rdcc_nbytes: Optional size in bytes of the raw chunk cache of each dataset. A
+            larger cache helps when reading many small slices of compressed datasets.
+        rdcc_nslots: Optional number of slots of the raw chunk cache.
+        **kwargs: Additional keyword arguments passed to h5py.File (e.g., driver).
+
+    Example:
+        with FeatureDataset(expt_path) as ds:
+            mFV = ds["mFV"][f0:f1]
+            data = ds.frames(f0, f1, ["mfDist", "wingML"])
+    """
+    def __init__(self, expt_path, rdcc_nbytes=None, rdcc_nslots=None, **kwargs):
+        if rdcc_nbytes is not None:
+            kwargs["rdcc_nbytes"] = rdcc_nbytes
+        if rdcc_nslots is not None:
+            kwargs["rdcc_nslots"] = rdcc_nslots
+        self.expt_path = expt_path
+        self.f = h5py.File(expt_path, "r", **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the file."""
+        self.f.close()
+
+    def __getitem__(self, name):
+        return self.f[name]
+
+    def __contains__(self, name):
+        return name in self.f
+
+    def keys(self):
+        """Returns the names of the datasets in the file."""
+        return [k for k, v in self.f.items() if isinstance(v, h5py.Dataset)]
+
+    @functools.cached_property
+    def node_names(self):
+        """List of decoded names of the tracked body parts."""
+        return [x.decode() if isinstance(x, bytes) else str(x) for x in self.f["node_names"][:]]
+
+    @functools.cached_property
+    def expt_name(self):
+        """Name of the experiment."""
+        x = self.f["expt_name"][()]
+        return x.decode() if isinstance(x, bytes) else str(x)
+
+    @functools.cached_property
+    def n_frames(self):
+        """Number of tracked frames."""
+        return get_n_frames(self.f)
+
+    @functools.cached_property
+    def feature_names(self):
+        """Names of the time-aligned features in the file."""
+        return [x for x in self.keys() if x != "node_names" and self.f[x].shape[:1] == (self.n_frames,)]
+
+    @functools.cached_property
+    def frame_at_sample(self):
+        """SampleFrameMap with the estimated frame at each sample. See load_frame_at_sample."""
+        ds = self.f["sample_at_frame"]
+        if "n_samples" in ds.attrs:
+            n_samples = ds.attrs["n_samples"]
+        else:
+            n_samples = self.f["frame_at_sample"].shape[0]
+        return SampleFrameMap(ds[:], n_samples)
+
+    @functools.cached_property
+    def event_index(self):
+        """EventIndex of the song events. See load_event_index."""
+        if "event_frames" in self.f:
+            return EventIndex(self.f["event_frames"][:], self.f["event_types"][:], self.n_frames)
+        song_lims = [self.f[f"{x}_lims"][:] for x in SONG_EVENT_TYPES]
+        event_frames, event_types = make_event_index(song_lims, self.frame_at_sample)
+        return EventIndex(event_frames, event_types, self.n_frames)
+
+    def frames(self, f0, f1, names=None):
+        """Read a range of frames of several features.
+
+        Args:
+            f0: First frame to read.
+            f1: Frame after the last frame to read.
+            names: List of feature names to read. Defaults to all time-aligned features.
+
+        Returns:
+            A dictionary mapping feature names to arrays of length f1 - f0.
+        """
+        if names is None:
+            names = self.feature_names
+        return {name: self.f[name][f0:f1] for name in names}
+
+def open_feature_dataset(expt):
+    """Returns a tuple of (FeatureDataset, should_close) given a path or FeatureDataset."""
+    if isinstance(expt, FeatureDataset):
+        return expt, False
+    return FeatureDataset(expt), True
+
+def load_frame_at_sample(expt_path):
+    """Load the sample to frame map from an experiment dataset.
+
+    Args:
+        expt_path: Path to experiment dataset.
+
+    Returns:
+        A SampleFrameMap that can be indexed or sliced like a vector of the length of
+        the number of samples where each element is the estimated video frame index.
+        Only the requested elements are computed.
+
+    Notes:
+        Older datasets store the dense frame_at_sample vector. For those, only its
+        length is read and the map is rebuilt from sample_at_frame.
+    """
+    with FeatureDataset(expt_path) as ds:
+        return ds.frame_at_sample
+
+def get_n_frames(f):
+    """Returns the number of tracked frames in an open experiment dataset.
+
+    Args:
+        f: The open h5py.File of the experiment dataset.
+
+    Returns:
+        The number of frames, or None if it cannot be determined.
+    """
+    if "n_frames" in f.attrs:
+        return int(f.attrs["n_frames"])
+    for name in TRACKING_FEATURES:
+        if name in f:
+            return f[name].shape[0]
+    return None
+
+# Song event types in the order of their type codes.
+SONG_EVENT_TYPES = ["pfast", "pslow", "sine"]
+
+# Types of song bouts and frame-aligned song channels (see compute_song_frames).
+SONG_BOUT_TYPES = ["pulse", "sine", "mix"]
+SONG_FRAME_FEATURES = ["pfast_frac", "pslow_frac", "sine_frac", "song_bout_id", "song_bout_type"]
+
+def make_event_index(song_lims, frame_at_sample):
+    """Build an index of song events sorted by time.
+
+    Args:
+        song_lims: List of (n, 2) arrays of event start and end sample indices, one for
+            each type in SONG_EVENT_TYPES.
+        frame_at_sample: Estimated frame index at each sample (see get_expt_sync).
+
+    Returns:
+        A tuple of (event_frames, event_types).
+
+        event_frames is an array of shape (n, 2) with the onset and offset frames of
+        all events sorted by onset.
+
+        event_types is an array of shape (n,) with the index of the type of each event
+        in SONG_EVENT_TYPES.
+    """
+    lims = np.concatenate([np.reshape(x, (-1, 2)) for x in song_lims], axis=0).astype(int)
+    types = np.concatenate([np.full((len(np.reshape(x, (-1, 2))),), i, dtype="int8") for i, x in enumerate(song_lims)])
+    order = np.lexsort((types, lims[:, 0]))
+    event_frames = np.asarray(frame_at_sample[lims[order]], dtype="int64").reshape(-1, 2)
+    return event_frames, types[order]
+
+class EventIndex:
+    """Index of song events sorted by time supporting binary search queries.
+
+    Args:
+        event_frames: Array of shape (n, 2) with onset and offset frames sorted by
+            onset. See make_event_index.
+        event_types: Array of shape (n,) with the event type codes.
+        n_frames: Number of frames in the recording. If None, the end of the recording
+            is not known and within only checks the start.
+    """
+    def __init__(self, event_frames, event_types, n_frames=None):
+        self.event_frames = np.asarray(event_frames).reshape(-1, 2)
+        self.event_types = np.asarray(event_types)
+        self.n_frames = n_frames
+        self.onsets = self.event_frames[:, 0]
+
+    def __len__(self):
+        return len(self.onsets)
+
+    def between(self, f0, f1, types=None):
+        """Find events with onsets in a range of frames.
+
+        Args:
+            f0: First frame of the range.
+            f1: Frame after the end of the range.
+            types: Optional list of event type names or codes to keep.
+
+        Returns:
+            Indices of the matching events in time order.
+        """
+        i0, i1 = np.searchsorted(self.onsets, [f0, f1], side="left")
+        inds = np.arange(i0, i1)
+        if types is not None:
+            codes = [SONG_EVENT_TYPES.index(x) if isinstance(x, str) else x for x in types]
+            inds = inds[np.isin(self.event_types[inds], codes)]
+        return inds
+
+    def within(self, window, types=None):
+        """Find events whose window of frames fits inside the recording.
+
+        Args:
+            window: Window of frame offsets relative to the onset (e.g., np.arange(-150, 151)).
+            types: Optional list of event type names or codes to keep.
+
+        Returns:
+            Indices of the matching events in time order. If the index has no n_frames,
+            only the start of the recording is checked.
+        """
+        f1 = np.inf if self.n_frames is None else self.n_frames - np.max(window)
+        return self.between(-np.min(window), f1, types=types)
+
+def load_event_index(expt_path):
+    """Load the song event index of an experiment dataset.
+
+    Args:
+        expt_path: Path to experiment dataset.
+
+    Returns:
+        An EventIndex. For older datasets without a stored index, it is built from the
+        song limits.
+    """
+    with FeatureDataset(expt_path) as ds:
+        return ds.event_index
+
 def find_song_frames(expt_path, window=None):
     """Find frame indices of song events in an experiment.
 
     This function is useful for getting the song times as frame indices.
 
     Args:
-        expt_path: Path to experiment dataset.
+        expt_path: Path to experiment dataset or an open FeatureDataset.
         window: Window of frame offsets that are expected to exist. This is used to
             exclude song that falls outside of the bounds of the window (e.g., at the
             start and end of the experiment). If None, all frame indices are returned.
@@ -166,33 +729,291 @@ def find_song_frames(expt_path, window=None):
     Returns:
         A tuple of (song_type, song_f0) where song_type is an indicator variable
         denoting the type of the event and song_f0 is the frame index of the song event.
+        Events are sorted by time.
 
         song_type is an array of shape (n,) containing the index in
         ["pfast", "pslow", "sine"] of the event type.
 
         song_f0 is an array of shape (n,) containing the frame index of the song event.
     """
-    song_lims = [
-        h5read(expt_path, "pfast_lims"),
-        h5read(expt_path, "pslow_lims"),
-        h5read(expt_path, "sine_lims")
-    ]
-    song_type = np.concatenate(
-        [np.full((lims.shape[0],), i) for i, lims in enumerate(song_lims)]
-    )
-    song_s0 = np.concatenate(song_lims, axis=0)[:, 0]
-    if len(song_s0) == 0:
+    ds, should_close = open_feature_dataset(expt_path)
+    index = ds.event_index
+    if should_close:
+        ds.close()
+    if len(index) == 0:
         return None, None
-    song_f0 = h5read(expt_path, "frame_at_sample")[song_s0].astype(int)
 
     if window is not None:
-        _, valid_f0 = get_windows(h5read(expt_path, "fFV"), song_f0, window)
-        valid_inds = np.array([np.where(song_f0 == f)[0].squeeze() for f in valid_f0])
-        song_f0 = valid_f0
-        song_type = song_type[valid_inds]
+        inds = index.within(window)
+    else:
+        inds = np.arange(len(index))
 
+    song_type = index.event_types[inds].astype(int)
+    song_f0 = index.onsets[inds]
     return song_type, song_f0
 
+def get_windows(feature, frames, window, fill=np.nan):
+    """Extract windows of a feature around a set of frames.
+
+    Windows are gathered from a strided view of the feature, so no index arrays or
+    intermediate copies of the feature are built, but the returned windows are a copy
+    (see Notes).
+
+    Args:
+        feature: Array of shape (n_frames, ...) with the feature time series.
+        frames: Array of shape (n_events,) with the frame index of each event.
+        window: Window of frame offsets relative to each event (e.g.,
+            np.arange(-150, 151)).
+        fill: Value to fill in samples that fall outside of the feature.
+
+    Returns:
+        A tuple of (windows, valid).
+
+        windows is an array of shape (n_events, len(window), ...) with the feature at
+        each offset around each event.
+
+        valid is a boolean array of shape (n_events, len(window)) denoting which
+        samples fell within the bounds of the feature. Invalid samples are set to fill.
+
+    Notes:
+        windows is always a new array, not a view of feature. Events are at arbitrary
+        frames, so they cannot be selected from the strided view by basic slicing, and
+        windows at the edges need fill values that are not in feature. The copy is of
+        size n_events * len(window) per feature column. To read a single window without
+        copying, slice the feature directly (feature[f + window[0]:f + window[-1] + 1]).
+    """
+    feature = np.asarray(feature)
+    frames = np.asarray(frames, dtype=int).reshape(-1)
+    window = np.asarray(window, dtype=int).reshape(-1)
+    n_frames = len(feature)
+
+    # Strided view of all windows spanning the range of offsets.
+    w0, w1 = window.min(), window.max()
+    span = w1 - w0 + 1
+    out_shape = (len(frames), len(window)) + feature.shape[1:]
+    if n_frames < span:
+        windows = np.full(out_shape, fill, dtype=np.result_type(feature, type(fill)))
+        inds = frames[:, None] + window[None, :]
+        valid = (inds >= 0) & (inds < n_frames)
+        windows[valid] = feature[inds[valid]]
+        return windows, valid
+    view = np.moveaxis(np.lib.stride_tricks.sliding_window_view(feature, span, axis=0), -1, 1)
+
+    # Gather windows, clamping edge events into range.
+    starts = frames + w0
+    windows = view[np.clip(starts, 0, n_frames - span)]
+    if len(window) != span or np.any(window[:-1] > window[1:]):
+        windows = windows[:, window - w0]
+
+    # Fix up events that overlap the edges.
+    valid = np.ones(out_shape[:2], dtype=bool)
+    is_edge = (starts < 0) | (starts > n_frames - span)
+    if is_edge.any():
+        dtype = np.result_type(feature, type(fill))
+        windows = windows.astype(dtype, copy=False)
+        inds = frames[is_edge, None] + window[None, :]
+        valid[is_edge] = (inds >= 0) & (inds < n_frames)
+        edge_windows = feature[np.clip(inds, 0, n_frames - 1)].astype(dtype, copy=False)
+        edge_windows[~valid[is_edge]] = fill
+        windows[is_edge] = edge_windows
+    return windows, valid
+
+def get_feature_windows(expt_path, names, frames, window, fill=np.nan):
+    """Extract windows of several features of an experiment around a set of frames.
+
+    Args:
+        expt_path: Path to experiment dataset or an open FeatureDataset.
+        names: List of feature names to extract (e.g., ["fFV", "mfDist"]).
+        frames: Array of shape (n_events,) with the frame index of each event.
+        window: Window of frame offsets relative to each event.
+        fill: Value to fill in samples that fall outside of the recording.
+
+    Returns:
+        A tuple of (windows, valid) where windows is a dictionary mapping each feature
+        name to its array of shape (n_events, len(window), ...) and valid is the boolean
+        array of shape (n_events, len(window)) shared by all features.
+    """
+    windows, valid = dict(), None
+    ds, should_close = open_feature_dataset(expt_path)
+    for name in names:
+        windows[name], valid = get_windows(ds[name][:], frames, window, fill=fill)
+    if should_close:
+        ds.close()
+    return windows, valid
+
+class EventTriggeredAverage:
+    """Streaming event-triggered average of features across experiments.
+
+    Sums and counts are accumulated into preallocated arrays so that averaging over any
+    number of experiments takes constant memory.
+
+    Args:
+        names: List of feature names to average.
+        window: Window of frame offsets relative to each event.
+        types: Optional list of event type names or codes in SONG_EVENT_TYPES to
+            include. If None, all song events are used.
+
+    Attributes:
+        total: Dictionary of arrays with the sum of each feature at each offset.
+        total_sq: Dictionary of arrays with the sum of squares of each feature.
+        count: Dictionary of arrays with the number of finite samples at each offset.
+        n_events: Number of events accumulated.
+        n_expts: Number of experiments accumulated.
+    """
+    def __init__(self, names, window, types=None):
+        self.names = list(names)
+        self.window = np.asarray(window, dtype=int).reshape(-1)
+        self.types = types
+        self.total, self.total_sq, self.count = dict(), dict(), dict()
+        self.n_events = 0
+        self.n_expts = 0
+
+    def add(self, windows, valid=None):
+        """Accumulate a batch of windows.
+
+        Args:
+            windows: Dictionary mapping feature names to arrays of shape
+                (n_events, len(window), ...). See get_feature_windows.
+            valid: Optional boolean array of shape (n_events, len(window)) marking
+                samples to include.
+        """
+        for name in self.names:
+            x = np.asarray(windows[name], dtype="float64")
+            mask = np.isfinite(x)
+            if valid is not None:
+                mask &= np.reshape(valid, valid.shape + (1,) * (x.ndim - 2))
+            x = np.where(mask, x, 0)
+            if name not in self.total:
+                self.total[name] = np.zeros(x.shape[1:])
+                self.total_sq[name] = np.zeros(x.shape[1:])
+                self.count[name] = np.zeros(x.shape[1:], dtype="int64")
+            self.total[name] += x.sum(axis=0)
+            self.total_sq[name] += (x ** 2).sum(axis=0)
+            self.count[name] += mask.sum(axis=0)
+        self.n_events += len(next(iter(windows.values()))) if len(windows) > 0 else 0
+
+    def add_experiment(self, expt_path):
+        """Accumulate the song-triggered windows of one experiment.
+
+        Args:
+            expt_path: Path to experiment dataset or an open FeatureDataset.
+
+        Returns:
+            Number of events added from this experiment.
+        """
+        ds, should_close = open_feature_dataset(expt_path)
+        index = ds.event_index
+        inds = index.between(-np.inf, np.inf, types=self.types)
+        if len(inds) > 0:
+            windows, valid = get_feature_windows(ds, self.names, index.onsets[inds], self.window)
+            self.add(windows, valid)
+        if should_close:
+            ds.close()
+        self.n_expts += 1
+        return len(inds)
+
+    def mean(self):
+        """Returns a dictionary with the mean of each feature at each offset."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return {name: self.total[name] / self.count[name] for name in self.total}
+
+    def std(self):
+        """Returns a dictionary with the standard deviation of each feature at each offset."""
+        mean = self.mean()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return {name: np.sqrt(np.maximum(self.total_sq[name] / self.count[name] - mean[name] ** 2, 0)) for name in self.total}
+
+def interpolate_missing(x, method="linear", axis=0, before=None, after=None):
+    """Fill missing values along one axis of an array in a single vectorized pass.
+
+    This is a native NumPy equivalent of pandas.DataFrame.interpolate with
+    limit_direction="both" for the "linear" and "nearest" methods. All series along
+    the axis are filled at once, so whole track arrays of shape
+    (frame, joint, xy, fly) can be filled without building a DataFrame per slice.
+
+    Args:
+        x: Array of any shape containing NaNs to be filled.
+        method: Either "linear" or "nearest". Defaults to "linear".
+        axis: Axis along which to interpolate (time). Defaults to 0.
+        before: Optional tuple of (index, value) with the last valid sample of each
+            series before the start of x, to fill x as a block of a longer recording.
+            Both have the shape of x without axis. Indices are relative to the start of
+            x (negative) and values are NaN for series without a valid sample before.
+        after: Optional tuple of (index, value) with the first valid sample of each
+            series after the end of x (indices >= the length of x along axis).
+
+    Returns:
+        Array of the same shape as the input with NaNs filled in.
+
+        With "linear", gaps are linearly interpolated and leading/trailing gaps are
+        filled with the first/last valid value. With "nearest", gaps are filled with
+        the value of the closest valid sample (ties go to the earlier sample) and,
+        as in pandas, leading/trailing gaps are left as NaN. Series with no valid
+        values are left as NaN.
+    """
+    if method not in ("linear", "nearest"):
+        raise ValueError(f"Unsupported interpolation method: {method}")
+
+    x = np.asarray(x)
+    if not np.issubdtype(x.dtype, np.floating):
+        x = x.astype("float64")
+
+    # Flatten to (time, series).
+    xt = np.moveaxis(x, axis, 0)
+    n = xt.shape[0]
+    flat = xt.reshape(n, -1)
+    valid = np.isfinite(flat)
+    if valid.all() or n == 0:
+        return x.copy()
+
+    # Valid samples outside of x.
+    n_series = flat.shape[1]
+    b_idx, b_val = (np.full(n_series, -1), np.full(n_series, np.nan)) if before is None else before
+    a_idx, a_val = (np.full(n_series, n), np.full(n_series, np.nan)) if after is None else after
+    b_idx, b_val = np.reshape(b_idx, -1), np.reshape(b_val, -1).astype(flat.dtype)
+    a_idx, a_val = np.reshape(a_idx, -1), np.reshape(a_val, -1).astype(flat.dtype)
+    b_ok, a_ok = np.isfinite(b_val), np.isfinite(a_val)
+
+    # Index of the previous and next valid sample for every element.
+    t = np.arange(n).reshape(-1, 1)
+    prev_idx = np.where(valid, t, -1)
+    np.maximum.accumulate(prev_idx, axis=0, out=prev_idx)
+    next_idx = np.where(valid, t, n)
+    next_idx = np.minimum.accumulate(next_idx[::-1], axis=0)[::-1]
+
+    # Only fill missing elements that have at least one valid neighbor.
+    has_prev = prev_idx >= 0
+    has_next = next_idx < n
+    fill = ~valid & (has_prev | has_next | b_ok | a_ok)
+    rows, cols = np.nonzero(fill)
+    i0, i1 = prev_idx[rows, cols], next_idx[rows, cols]
+    has_prev, has_next = has_prev[rows, cols], has_next[rows, cols]
+    y0, y1 = flat[np.maximum(i0, 0), cols], flat[np.minimum(i1, n - 1), cols]
+
+    # Use the samples outside of x where there is no valid neighbor within x.
+    use_b, use_a = ~has_prev & b_ok[cols], ~has_next & a_ok[cols]
+    i0, y0 = np.where(use_b, b_idx[cols], i0), np.where(use_b, b_val[cols], y0)
+    i1, y1 = np.where(use_a, a_idx[cols], i1), np.where(use_a, a_val[cols], y1)
+    has_prev, has_next = has_prev | use_b, has_next | use_a
+
+    out = flat.copy()
+    if method == "linear":
+        # Hold the edge values beyond the first/last valid sample.
+        i0, y0 = np.where(has_prev, i0, i1), np.where(has_prev, y0, y1)
+        i1, y1 = np.where(has_next, i1, i0), np.where(has_next, y1, y0)
+        interior = i1 != i0
+        vals = y0.copy()
+        slope = (y1[interior] - y0[interior]) / (i1[interior] - i0[interior])
+        vals[interior] = slope * (rows[interior] - i0[interior]) + y0[interior]
+        out[rows, cols] = vals
+    else:
+        # Pandas (scipy) nearest leaves leading/trailing gaps unfilled.
+        interior = has_prev & has_next
+        rows, i0, i1, y0, y1 = rows[interior], i0[interior], i1[interior], y0[interior], y1[interior]
+        out[rows, cols[interior]] = np.where((rows - i0) <= (i1 - rows), y0, y1)
+
+    return np.moveaxis(out.reshape(xt.shape), 0, axis)
+
 def fill_missing(x, kind="nearest", **kwargs):
     """Fill missing values in a timeseries.
 
@@ -204,13 +1025,129 @@ def fill_missing(x, kind="nearest", **kwargs):
         Timeseries of the same shape as the input with NaNs filled in.
 
     Notes:
-        This uses pandas.DataFrame.interpolate and accepts the same kwargs.
+        This accepts the same kwargs as pandas.DataFrame.interpolate. Note that
+        pandas ignores kind, so the interpolation is set by the method kwarg, which
+        defaults to "linear". The "linear" and "nearest" methods are computed natively
+        with interpolate_missing. Any other method or kwargs fall back to pandas.
     """
+    method = kwargs.get("method", "linear")
+    if method in ("linear", "nearest") and set(kwargs) <= {"method"}:
+        return interpolate_missing(x, method=method, axis=1 if x.ndim == 3 else 0)
+
     if x.ndim == 3:
         return np.stack([fill_missing(xi, kind=kind, **kwargs) for xi in x], axis=0)
+    import pandas as pd
     return pd.DataFrame(x).interpolate(kind=kind, axis=0, limit_direction='both',**kwargs).to_numpy()
 
-def normalize_to_egocentric(x, rel_to=None, scale_factor=1, ctr_ind=1, fwd_ind=0, fill=True, return_angles=False):
+class PoseCache:
+    """Gap-filled pose series of one experiment, shared by all feature stages.
+
+    Each (fly, joint) series is filled at most once and memoized. The filled series
+    are returned as read-only arrays so they can be handed to every feature function
+    without defensive copies. Series can be requested from several threads.
+
+    Args:
+        tracks: Pose tracks of shape (frame, joint, xy, fly).
+        before: Optional tuple of (index, value) arrays of shape (joint, xy, fly) with
+            the last valid sample of each series before the first frame of tracks, when
+            tracks are a block of a longer recording (see interpolate_missing).
+        after: Optional tuple of (index, value) with the first valid sample of each
+            series after the last frame of tracks.
+    """
+    def __init__(self, tracks, before=None, after=None):
+        self.tracks = tracks
+        self.before = before
+        self.after = after
+        self._filled = dict()
+        self.lock = threading.RLock()
+
+    def prefill(self, joints, flies=None):
+        """Fill several series in a single vectorized pass.
+
+        Args:
+            joints: List of joint indices to fill.
+            flies: List of fly indices to fill. Defaults to all flies.
+        """
+        if flies is None:
+            flies = range(self.tracks.shape[-1])
+        with self.lock:
+            todo = [(fly, joint) for fly in flies for joint in joints if (fly, joint) not in self._filled]
+            if len(todo) == 0:
+                return
+            sel_joints = sorted(set(joint for _, joint in todo))
+            sel_flies = sorted(set(fly for fly, _ in todo))
+            if self.before is None and self.after is None:
+                filled = fill_missing(self.tracks[:, sel_joints][..., sel_flies], kind="nearest")
+            else:
+                before, after = [None if x is None else tuple(y[sel_joints][..., sel_flies] for y in x) for x in (self.before, self.after)]
+                filled = interpolate_missing(self.tracks[:, sel_joints][..., sel_flies], axis=0, before=before, after=after)
+            filled.flags.writeable = False
+            for fly, joint in todo:
+                self._filled[(fly, joint)] = filled[:, sel_joints.index(joint), :, sel_flies.index(fly)]
+
+    def get(self, fly, joint):
+        """Return the filled coordinates of a single joint.
+
+        Args:
+            fly: Index of the fly (last axis of tracks).
+            joint: Index of the joint.
+
+        Returns:
+            A read-only array of shape (frame, 2).
+        """
+        if (fly, joint) not in self._filled:
+            self.prefill([joint], flies=[fly])
+        return self._filled[(fly, joint)]
+
+    def get_all(self, joint):
+        """Return the filled coordinates of a joint for all flies.
+
+        Args:
+            joint: Index of the joint.
+
+        Returns:
+            An array of shape (frame, 2, fly).
+        """
+        self.prefill([joint])
+        return np.stack([self.get(fly, joint) for fly in range(self.tracks.shape[-1])], axis=-1)
+
+    def egocentric(self, fly, rel_fly=None, ctr_ind=1, fwd_ind=0, return_angles=False):
+        """Normalize a fly's pose to egocentric coordinates of itself or another fly.
+
+        Args:
+            fly: Index of the fly to normalize.
+            rel_fly: Index of the fly to align to. Defaults to fly.
+            ctr_ind: Index of centroid joint. Defaults to 1.
+            fwd_ind: Index of "forward" joint (e.g., head). Defaults to 0.
+            return_angles: If True, return angles with the aligned coordinates.
+
+        Returns:
+            Output of normalize_to_egocentric.
+        """
+        if rel_fly is None:
+            rel_fly = fly
+        return normalize_to_egocentric(
+            self.tracks[..., fly],
+            ctr=self.get(rel_fly, ctr_ind),
+            fwd=self.get(rel_fly, fwd_ind),
+            return_angles=return_angles
+        )
+
+    def wing_arc_angles(self, male=1, female=0):
+        """Compute wing arc angles from the filled series. See compute_wing_arc_angles."""
+        return compute_wing_arc_angles_from_points(
+            self.get(male, 1), self.get(male, 3), self.get(male, 4), self.get(female, 0)
+        )
+
+    def features(self, female=0, male=1, ctr_ind=1, fwd_ind=0):
+        """Compute classical features from the filled series. See compute_features."""
+        return compute_features(
+            self.get(female, ctr_ind), self.get(male, ctr_ind),
+            self.get(female, fwd_ind), self.get(male, fwd_ind),
+            fill=False
+        )
+
+def normalize_to_egocentric(x, rel_to=None, scale_factor=1, ctr_ind=1, fwd_ind=0, fill=True, return_angles=False, ctr=None, fwd=None):
     """Normalize pose estimates to egocentric coordinates.
 
     Args:
@@ -223,6 +1160,11 @@ def normalize_to_egocentric(x, rel_to=None, scale_factor=1, ctr_ind=1, fwd_ind=0
         fill: If True, interpolate missing ctr and fwd coordinates. If False, timesteps
             with missing coordinates will be all NaN. Defaults to True.
         return_angles: If True, return angles with the aligned coordinates.
+        ctr: Precomputed (e.g., already filled) centroid coordinates of shape (time, 2).
+            If provided, these are used instead of extracting ctr_ind from rel_to and
+            are not filled again.
+        fwd: Precomputed forward joint coordinates of shape (time, 2). Same behavior
+            as ctr.
 
     Returns:
         Egocentrically aligned poses of the same shape as the input.
@@ -241,11 +1183,16 @@ def normalize_to_egocentric(x, rel_to=None, scale_factor=1, ctr_ind=1, fwd_ind=0
         rel_to = np.expand_dims(rel_to, axis=0)
 
     # Find egocentric forward coordinates.
-    ctr = rel_to[..., ctr_ind, :]  # (t, 2)
-    fwd = rel_to[..., fwd_ind, :]  # (t, 2)
-    if fill:
-        ctr = fill_missing(ctr, kind="nearest")
-        fwd = fill_missing(fwd, kind="nearest")
+    if ctr is None:
+        ctr = rel_to[..., ctr_ind, :]  # (t, 2)
+        if fill:
+            ctr = fill_missing(ctr, kind="nearest")
+    if fwd is None:
+        fwd = rel_to[..., fwd_ind, :]  # (t, 2)
+        if fill:
+            fwd = fill_missing(fwd, kind="nearest")
+    ctr = ctr.reshape(-1, 2)
+    fwd = fwd.reshape(-1, 2)
     ego_fwd = fwd - ctr
 
     # Compute angle.
@@ -277,6 +1224,97 @@ def normalize_to_egocentric(x, rel_to=None, scale_factor=1, ctr_ind=1, fwd_ind=0
     else:
         return x
 
+def rotate_to_heading(x, ctr, ca, sa, scale_factor=1, out=None):
+    """Center poses on a reference point and rotate them to a reference heading.
+
+    Args:
+        x: Poses of shape (time, joints, 2, ...).
+        ctr: Reference coordinates of shape (time, 2).
+        ca: Cosine of the reference heading angle of shape (time,).
+        sa: Sine of the reference heading angle of shape (time,).
+        scale_factor: Spatial scaling to apply to coordinates after centering.
+        out: Optional preallocated output array of the same shape as x.
+
+    Returns:
+        The egocentric poses of the same shape as x.
+    """
+    shape = (len(ca),) + (1,) * (x.ndim - 2)
+    dx = x[:, :, 0] - ctr[:, 0].reshape(shape)
+    dy = x[:, :, 1] - ctr[:, 1].reshape(shape)
+    if scale_factor != 1:
+        dx /= scale_factor
+        dy /= scale_factor
+
+    c = ca.reshape(shape)
+    s = sa.reshape(shape)
+    if out is None:
+        out = np.empty(x.shape, dtype=dx.dtype)
+    np.multiply(dx, c, out=out[:, :, 0])
+    out[:, :, 0] += dy * s
+    np.multiply(dy, c, out=out[:, :, 1])
+    out[:, :, 1] -= dx * s
+    return out
+
+def normalize_to_egocentric_batch(tracks, scale_factor=1, ctr_ind=1, fwd_ind=0, fill=True, ctr=None, fwd=None, out=None):
+    """Normalize the poses of all flies to the egocentric coordinates of every fly.
+
+    This is a batched version of normalize_to_egocentric that computes the self- and
+    cross-referenced poses for all pairs of flies in one pass. The heading of each
+    fly is computed once and poses are rotated with direct 2x2 rotations into a
+    preallocated output.
+
+    Args:
+        tracks: Pose tracks of shape (frame, joint, xy, fly).
+        scale_factor: Spatial scaling to apply to coordinates after centering.
+        ctr_ind: Index of centroid joint. Defaults to 1.
+        fwd_ind: Index of "forward" joint (e.g., head). Defaults to 0.
+        fill: If True, interpolate missing ctr and fwd coordinates. If False, timesteps
+            with missing coordinates will be all NaN. Defaults to True.
+        ctr: Precomputed (e.g., already filled) centroid coordinates of shape
+            (frame, 2, fly). If provided, fill is not applied to them.
+        fwd: Precomputed forward joint coordinates of shape (frame, 2, fly). Same
+            behavior as ctr.
+        out: Optional preallocated output array of shape (frame, joint, xy, fly, fly).
+
+    Returns:
+        A tuple of (ego, ang).
+
+        ego is an array of shape (frame, joint, xy, fly, rel_fly) where
+        ego[..., i, j] is the pose of fly i aligned to fly j. For the two fly case,
+        egoF = ego[..., 0, 0], egoM = ego[..., 1, 1], egoFrM = ego[..., 0, 1] and
+        egoMrF = ego[..., 1, 0].
+
+        ang is an array of shape (frame, fly) with the heading angle of each fly in
+        radians.
+    """
+    n_frames, n_joints, _, n_flies = tracks.shape
+
+    # Find egocentric forward coordinates.
+    if ctr is None:
+        ctr = tracks[:, ctr_ind]  # (t, 2, fly)
+        if fill:
+            ctr = interpolate_missing(ctr, axis=0)
+    if fwd is None:
+        fwd = tracks[:, fwd_ind]  # (t, 2, fly)
+        if fill:
+            fwd = interpolate_missing(fwd, axis=0)
+    ego_fwd = fwd - ctr
+
+    # Compute heading angles once for all flies.
+    ang = np.arctan2(ego_fwd[:, 1], ego_fwd[:, 0])  # (t, fly)
+    ca = np.cos(ang)
+    sa = np.sin(ang)
+
+    if out is None:
+        dtype = np.result_type(tracks.dtype, ca.dtype)
+        out = np.empty((n_frames, n_joints, 2, n_flies, n_flies), dtype=dtype)
+
+    # Align all flies to each reference fly.
+    for j in range(n_flies):
+        rotate_to_heading(tracks, ctr[..., j], ca[:, j], sa[:, j], scale_factor=scale_factor, out=out[..., j])
+
+    return out, ang
+
 def compute_wing_angles(x, left_ind=3, right_ind=4):
     """Returns the wing angles in degrees from normalized pose.
 
@@ -329,15 +1367,39 @@ def compute_wing_arc_angles(XM, XF):
 
     # Get female features.
     XF_H = XF[:, 0]  # head
-    XF_Th = XF[:, 1]  # thorax
 
     # Fill missing values.
     XM_Th = fill_missing(XM_Th, kind="nearest")
     XM_WL = fill_missing(XM_WL, kind="nearest")
     XM_WR = fill_missing(XM_WR, kind="nearest")
     XF_H = fill_missing(XF_H, kind="nearest")
-    XF_Th = fill_missing(XF_Th, kind="nearest")
 
+    return compute_wing_arc_angles_from_points(XM_Th, XM_WL, XM_WR, XF_H)
+
+def compute_wing_arc_angles_from_points(XM_Th, XM_WL, XM_WR, XF_H):
+    """Compute wing arc angles from individual (filled) keypoint coordinates.
+
+    Args:
+        XM_Th: Male thorax coordinates of shape (time, 2, ...).
+        XM_WL: Male left wing coordinates of shape (time, 2, ...).
+        XM_WR: Male right wing coordinates of shape (time, 2, ...).
+        XF_H: Female head coordinates of shape (time, 2, ...).
+
+        Trailing axes are broadcast, e.g., male coordinates of shape (time, 2, fly, 1)
+        and female coordinates of shape (time, 2, 1, fly) give the arc angles of every
+        pair of flies.
+
+    Returns:
+        A tuple of (arcThetaL, arcThetaR) both of shape (time, ...). See
+        compute_wing_arc_angles for details.
+
+    Notes:
+        Missing values are not filled here. Use compute_wing_arc_angles on raw pose
+        tracks or pass series from a PoseCache.
+
+        The dot products and arccos are computed in float64 even for float32 inputs,
+        since arccos amplifies rounding errors when the wing and head are aligned.
+    """
     # Compute wing midpoints.
     XM_WRm = (XM_Th + XM_WR) / 2
     XM_WLm = (XM_Th + XM_WL) / 2
@@ -351,43 +1413,53 @@ def compute_wing_arc_angles(XM, XF):
     angWL = np.rad2deg(np.arctan2(XM_WLm_to_WL[:, 1], XM_WLm_to_WL[:, 0])) % 360
 
     # Compute arc angle between wing midpoint and female head.
-    A = XF_H - XM_WRm
-    B = np.stack([np.cos(np.deg2rad(angWR - 90)), np.sin(np.deg2rad(angWR - 90))], axis=-1)
-    C = ((A.reshape((-1, 1, 2)) @ B.reshape((-1, 1, 2)).transpose([0, 2, 1])).squeeze() /
-         (np.linalg.norm(A, axis=-1) * np.linalg.norm(B, axis=-1)))
+    A = np.asarray(XF_H - XM_WRm, dtype="float64")
+    B = np.stack([np.cos(np.deg2rad(angWR - 90, dtype="float64")), np.sin(np.deg2rad(angWR - 90, dtype="float64"))], axis=1)
+    C = np.sum(A * B, axis=1) / (np.linalg.norm(A, axis=1) * np.linalg.norm(B, axis=1))
     arcThetaR = np.rad2deg(np.arccos(np.clip(C, -1, 1)))
 
-    A = XF_H - XM_WLm
-    B = np.stack([np.cos(np.deg2rad(angWL + 90)), np.sin(np.deg2rad(angWL + 90))], axis=-1)
-    C = ((A.reshape((-1, 1, 2)) @ B.reshape((-1, 1, 2)).transpose([0, 2, 1])).squeeze() /
-         (np.linalg.norm(A, axis=-1) * np.linalg.norm(B, axis=-1)))
+    A = np.asarray(XF_H - XM_WLm, dtype="float64")
+    B = np.stack([np.cos(np.deg2rad(angWL + 90, dtype="float64")), np.sin(np.deg2rad(angWL + 90, dtype="float64"))], axis=1)
+    C = np.sum(A * B, axis=1) / (np.linalg.norm(A, axis=1) * np.linalg.norm(B, axis=1))
     arcThetaL = np.rad2deg(np.arccos(np.clip(C, -1, 1)))
 
     return arcThetaL, arcThetaR
 
+# signed_angle rounds cosines to 4 decimals, so angles between nearly parallel vectors
+# have a resolution of about 0.81 degrees and can change by one step when the inputs
+# change in their last bits.
+SIGNED_ANGLE_RESOLUTION = float(np.rad2deg(np.arccos(1 - 1e-4)))
+
 def signed_angle(a, b):
     """Finds the signed angle between two 2D vectors a and b.
 
     Args:
-        a: Array of shape (n, 2).
-        b: Array of shape (n, 2).
+        a: Array of shape (n, 2) or (n, 2, ...).
+        b: Array of the same shape as a.
 
     Returns:
-        The signed angles in degrees in vector of shape (n, 2).
+        The signed angles in degrees in vector of shape (n,) or (n, ...).
 
         This angle is positive if a is rotated clockwise to align to b and negative if
         this rotation is counter-clockwise.
+
+    Notes:
+        The angle is always computed in float64. arccos is very sensitive to its
+        argument near +/-1 (nearly parallel vectors, e.g., small rotations between
+        frames), where float32 rounding would give errors of up to a degree.
     """
+    a = np.asarray(a, dtype="float64")
+    b = np.asarray(b, dtype="float64")
     a = a / np.linalg.norm(a, axis=1, keepdims=True)
     b = b / np.linalg.norm(b, axis=1, keepdims=True)
     theta = np.arccos(np.around(np.sum(a * b, axis=1), decimals=4))
-    cross = np.cross(a, b, axis=1)
+    cross = a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0]
     sign = np.zeros(cross.shape)
     sign[cross >= 0] = -1
     sign[cross < 0] = 1
     return np.rad2deg(theta) * sign
 
-def compute_features(fThx, mThx, fHd, mHd):
+def compute_features(fThx, mThx, fHd, mHd, fill=True):
     """Extract behavioral features given head and thorax coordinates.
 
     Args:
@@ -395,6 +1467,8 @@ def compute_features(fThx, mThx, fHd, mHd):
         mThx: Male thorax coordinates in array of shape (timesteps, 2).
         fHd: Female head coordinates in array of shape (timesteps, 2).
         mHd: Female head coordinates in array of shape (timesteps, 2).
+        fill: If True, interpolate missing coordinates first. Set to False if the inputs
+            are already filled (e.g., from a PoseCache). Defaults to True.
 
     Returns:
         A dictionary of classical features with keys:
@@ -423,104 +1497,347 @@ def compute_features(fThx, mThx, fHd, mHd):
         Based off of Junyu Li's implementation (/tigress/MMURTHY/junyu/code/alignFeature/compute_features.py).
     """
     # Fill missing values.
-    fThx = fill_missing(fThx, kind="nearest")
-    mThx = fill_missing(mThx, kind="nearest")
-    fHd = fill_missing(fHd, kind="nearest")
-    mHd = fill_missing(mHd, kind="nearest")
-
-    # Euclidean distance between the male and female thorax.
-    mfDist = np.sqrt(np.sum((fThx - mThx) ** 2, axis=1))
-
-    # Vector joining the thorax points in consecutive frames.
-    mV_vec = np.diff(mThx, axis=0)
-    mV_vec = np.pad(mV_vec, ((0, 1), (0, 0)), mode="edge")
-    fV_vec = np.diff(fThx, axis=0)
-    fV_vec = np.pad(fV_vec, ((0, 1), (0, 0)), mode="edge")
-
-    # Velocity - the Euclidean distance moved by the thorax in each frame.
-    # mV = np.sqrt(np.sum(mV_vec ** 2, axis=1))
-    # fV = np.sqrt(np.sum(fV_vec ** 2, axis=1))
-
-    # Vector of thorax to head
-    mDir = mHd - mThx
-    fDir = fHd - fThx
-    mDir_unit = mDir / np.linalg.norm(mDir, axis=1, keepdims=True)
-    fDir_unit = fDir / np.linalg.norm(fDir, axis=1, keepdims=True)
-
-    # Angle made by the body axis with the x-axis.
-    # mTheta = np.rad2deg(np.arctan2(mDir[:, 1], mDir[:, 0]))
-    # fTheta = np.rad2deg(np.arctan2(fDir[:, 1], fDir[:, 0]))
-
-    # Forward velocity - magnitude of the velocity in the direction of heading.
-    mFV = np.sum(mV_vec * mDir_unit, axis=1)
-    mFA = np.diff(mFV, axis=0)
-    mFA = np.pad(mFA, (0, 1), mode="edge")
-    fFV = np.sum(fV_vec * fDir_unit, axis=1)
-    fFA = np.diff(fFV, axis=0)
-    fFA = np.pad(fFA, (0, 1), mode="edge")
-
-    # Lateral velocity - magnitude of the velocity perpendicular to the forward velocity.
-    mLV = np.sum(mV_vec * np.stack([-mDir_unit[:, 1], mDir_unit[:, 0]], axis=1), axis=1)
-    fLV = np.sum(fV_vec * np.stack([-fDir_unit[:, 1], fDir_unit[:, 0]], axis=1), axis=1)
-
-    # Lateral acceration.
-    mLA = np.diff(mLV)
-    mLA = np.pad(mLA, (0, 1), mode="edge")
-    fLA = np.diff(fLV)
-    fLA = np.pad(fLA, (0, 1), mode="edge")
-
-    # Rotational speed - change in the heading of the male
-    delt = 1
-    mRS = signed_angle(mDir[0:(-1 - delt), :], mDir[delt:-1, :])
-    mRS = np.pad(mRS, (1, 1), mode="edge")
-    fRS = signed_angle(fDir[0:(-1 - delt), :], fDir[delt:-1, :])
-    fRS = np.pad(fRS, (1, 1), mode="edge")
-
-    # Vector joining one fly's thorax to the other's
-    mfDir = fThx - mHd
-    fmDir = mThx - fHd
-
-    fmDir_unit = fmDir / np.linalg.norm(fmDir, axis=1, keepdims=True)
-    mfDir_unit = mfDir / np.linalg.norm(mfDir, axis=1, keepdims=True)
-
-    # Angle subtended by one fly on the other fly
-    mfAng = signed_angle(mDir, mfDir)
-    fmAng = signed_angle(fDir, fmDir)
-
-    # Velocity in the direction of the other fly.
-    fmFV = np.sum(fV_vec * fmDir_unit, axis=1)
-    mfFV = np.sum(mV_vec * mfDir_unit, axis=1)
-
-    # Male lateral speed in female direction: mfLS
-    mfDir_unit_perp = np.stack([-mfDir_unit[:, 1], mfDir_unit[:, 0]], axis=1)
-    mfLS = np.abs(np.sum(mV_vec * mfDir_unit_perp, axis=1))
-
-    # Female lateral speed in male direction: fmLS
-    fmDir_unit_perp = np.stack([-fmDir_unit[:, 1], fmDir_unit[:, 0]], axis=1)
-    fmLS = np.abs(np.sum(fV_vec * fmDir_unit_perp, axis=1))
-
-    ftrs = dict()
-    ftrs["mfDist"] = mfDist
-    ftrs["mFV"] = mFV
-    ftrs["fFV"] = fFV
-    ftrs["mFA"] = mFA
-    ftrs["fFA"] = fFA
-    ftrs["mLV"] = mLV
-    ftrs["fLV"] = fLV
-    ftrs["mLS"] = abs(mLV)
-    ftrs["fLS"] = abs(fLV)
-    ftrs["mLA"] = mLA
-    ftrs["fLA"] = fLA
-    ftrs["mRS"] = mRS
-    ftrs["fRS"] = fRS
-    ftrs["mfAng"] = mfAng
-    ftrs["fmAng"] = fmAng
-    ftrs["mfFV"] = mfFV
-    ftrs["fmFV"] = fmFV
-    ftrs["mfLS"] = mfLS
-    ftrs["fmLS"] = fmLS
-
-    return ftrs
+    if fill:
+        fThx = fill_missing(fThx, kind="nearest")
+        mThx = fill_missing(mThx, kind="nearest")
+        fHd = fill_missing(fHd, kind="nearest")
+        mHd = fill_missing(mHd, kind="nearest")
+
+    # Stack as (timesteps, 2, fly) with fly ordered as [female, male].
+    inputs = dict()
+    inputs["thx"] = np.stack([fThx, mThx], axis=-1)
+    inputs["hd"] = np.stack([fHd, mHd], axis=-1)
+
+    return compute_feature_graph(CLASSICAL_FEATURES, inputs)
+
+# Registry of features computed by make_expt_dataset.
+Feature = collections.namedtuple("Feature", ["name", "deps", "func", "dtype", "output", "stage"])
+FEATURES = dict()
+
+def register_feature(name, deps, dtype="float64", output=False, stage="features"):
+    """Decorator that registers a function computing a feature or intermediate.
+
+    Args:
+        name: Name of the feature.
+        deps: Names of the features or inputs whose values are passed as positional
+            arguments to the decorated function.
+        dtype: Data type of the feature when saved. Defaults to "float64".
+        output: If True, this is a feature that can be saved. If False, it is an
+            intermediate that is only computed when another feature needs it.
+        stage: Name of the profiler stage that the computation time of this feature is
+            attributed to (e.g., "ego", "wings", "arc"). Defaults to "features".
+
+    Returns:
+        The decorator.
+    """
+    def decorator(func):
+        FEATURES[name] = Feature(name, tuple(deps), func, dtype, output, stage)
+        return func
+    return decorator
+
+def compute_feature_graph(names, inputs, profiler=None, executor=None, dtype=None):
+    """Compute the requested features and only the features they depend on.
+
+    Args:
+        names: List of names of features to compute.
+        inputs: Dictionary of precomputed values by name. These are used instead of
+            computing the registered feature of the same name. Pose features expect the
+            inputs "tracks" (frame, joint, xy, fly), "pose" (a PoseCache of the
+            tracks), "ctr_ind" and "fwd_ind".
+        profiler: Optional StageProfiler. The time spent in each feature function is
+            attributed to the stage of the feature.
+        executor: Optional concurrent.futures.Executor. If specified, each feature is
+            submitted to it as soon as its dependencies are computed. NumPy releases the
+            GIL in most array operations, so independent features (e.g., egocentric
+            poses, wing angles and classical features) run in parallel on a thread pool.
+        dtype: Optional floating point data type (e.g., "float32") to cast features
+            registered as floating point to instead of their registered dtype.
+
+    Returns:
+        A dictionary of the requested features, cast to their registered dtype.
+    """
+    values = dict(inputs)
+    if profiler is None:
+        profiler = StageProfiler()
+
+    if executor is not None:
+        # Find all features that need to be computed.
+        pending = set()
+        def visit(name):
+            if name not in values and name not in pending:
+                if name not in FEATURES:
+                    raise ValueError(f"Unknown feature or missing input: {name}")
+                pending.add(name)
+                for dep in FEATURES[name].deps:
+                    visit(dep)
+        for name in names:
+            visit(name)
+
+        def run(feature, args):
+            with profiler.stage(feature.stage):
+                return feature.func(*args)
+
+        running = dict()
+        while len(pending) > 0 or len(running) > 0:
+            for name in sorted(pending):
+                feature = FEATURES[name]
+                if all(dep in values for dep in feature.deps):
+                    pending.remove(name)
+                    running[executor.submit(run, feature, [values[dep] for dep in feature.deps])] = name
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                values[running.pop(future)] = future.result()
+
+    def compute(name):
+        if name not in values:
+            if name not in FEATURES:
+                raise ValueError(f"Unknown feature or missing input: {name}")
+            feature = FEATURES[name]
+            args = [compute(dep) for dep in feature.deps]
+            with profiler.stage(feature.stage):
+                values[name] = feature.func(*args)
+        return values[name]
+
+    def get_dtype(name):
+        if dtype is not None and np.dtype(FEATURES[name].dtype).kind == "f":
+            return dtype
+        return FEATURES[name].dtype
+
+    return {name: np.asarray(compute(name)).astype(get_dtype(name), copy=False) for name in names}
+
+def select_fly(x, fly):
+    """Select a single fly (or pair of flies if fly is a tuple) from the last axes of x."""
+    if isinstance(fly, tuple):
+        return x[(Ellipsis,) + fly]
+    return x[..., fly]
+
+def pad_time(x, before=0, after=1):
+    """Pad the first (time) axis by repeating the edge values."""
+    return np.pad(x, ((before, after),) + ((0, 0),) * (x.ndim - 1), mode="edge")
+
+def perpendicular(x):
+    """Rotate 2D vectors of shape (n, 2, ...) by 90 degrees counter-clockwise."""
+    return np.stack([-x[:, 1], x[:, 0]], axis=1)
+
+def unit_vectors(x):
+    """Normalize 2D vectors of shape (n, 2, ...) to unit length."""
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+@register_feature("thx", ["pose", "ctr_ind"], stage="tracks")
+def filled_centroids(pose, ctr_ind):
+    """Filled thorax coordinates of shape (time, 2, fly)."""
+    return pose.get_all(ctr_ind)
+
+@register_feature("hd", ["pose", "fwd_ind"], stage="tracks")
+def filled_heads(pose, fwd_ind):
+    """Filled head coordinates of shape (time, 2, fly)."""
+    return pose.get_all(fwd_ind)
+
+@register_feature("heading", ["thx", "hd"], stage="ego")
+def heading(thx, hd):
+    """Tuple of (cos, sin) of the heading angle of each fly, each of shape (time, fly)."""
+    ego_fwd = hd - thx
+    ang = np.arctan2(ego_fwd[:, 1], ego_fwd[:, 0])
+    return np.cos(ang), np.sin(ang)
+
+def egocentric_feature(fly, rel_fly):
+    """Returns a function computing the pose of fly aligned to rel_fly."""
+    def func(tracks, thx, heading):
+        ca, sa = heading
+        return rotate_to_heading(tracks[..., fly], thx[..., rel_fly], ca[:, rel_fly], sa[:, rel_fly])
+    return func
+
+@register_feature("ego", ["tracks", "thx", "hd"], stage="ego")
+def egocentric_all(tracks, thx, hd):
+    """Pose of every fly aligned to every fly of shape (time, joint, xy, fly, rel_fly)."""
+    ego, _ = normalize_to_egocentric_batch(tracks, ctr=thx, fwd=hd)
+    return ego
+
+register_feature("trxF", ["tracks"], output=True, stage="tracks")(functools.partial(select_fly, fly=0))
+register_feature("trxM", ["tracks"], output=True, stage="tracks")(functools.partial(select_fly, fly=1))
+register_feature("egoF", ["tracks", "thx", "heading"], output=True, stage="ego")(egocentric_feature(0, 0))
+register_feature("egoM", ["tracks", "thx", "heading"], output=True, stage="ego")(egocentric_feature(1, 1))
+register_feature("egoFrM", ["tracks", "thx", "heading"], output=True, stage="ego")(egocentric_feature(0, 1))
+register_feature("egoMrF", ["tracks", "thx", "heading"], output=True, stage="ego")(egocentric_feature(1, 0))
+register_feature("wingF", ["egoF"], stage="wings")(compute_wing_angles)
+register_feature("wingM", ["egoM"], stage="wings")(compute_wing_angles)
+register_feature("wingFL", ["wingF"], output=True, stage="wings")(lambda x: x[0])
+register_feature("wingFR", ["wingF"], output=True, stage="wings")(lambda x: x[1])
+register_feature("wingML", ["wingM"], output=True, stage="wings")(lambda x: x[0])
+register_feature("wingMR", ["wingM"], output=True, stage="wings")(lambda x: x[1])
+
+@register_feature("pairArcTheta", ["pose"], stage="arc")
+def pair_arc_angles(pose):
+    """Tuple of (arcThetaL, arcThetaR) of each fly's wings relative to each fly's head.
+
+    Both are of shape (time, fly, fly) where [:, i, j] is the angle of the wings of fly
+    i relative to the head of fly j.
+    """
+    thx = pose.get_all(1)[..., :, None]
+    wingL = pose.get_all(3)[..., :, None]
+    wingR = pose.get_all(4)[..., :, None]
+    hd = pose.get_all(0)[..., None, :]
+    return compute_wing_arc_angles_from_points(thx, wingL, wingR, hd)
+
+register_feature("pairArcThetaL", ["pairArcTheta"], stage="arc")(lambda x: mask_self_pairs(x[0]))
+register_feature("pairArcThetaR", ["pairArcTheta"], stage="arc")(lambda x: mask_self_pairs(x[1]))
+register_feature("arcThetaL", ["pairArcTheta"], output=True, stage="arc")(lambda x: x[0][:, 1, 0])
+register_feature("arcThetaR", ["pairArcTheta"], output=True, stage="arc")(lambda x: x[1][:, 1, 0])
+
+@register_feature("V_vec", ["thx"])
+def velocity_vectors(thx):
+    """Vector joining the thorax points in consecutive frames."""
+    return pad_time(np.diff(thx, axis=0))
+
+@register_feature("Dir", ["thx", "hd"])
+def body_vectors(thx, hd):
+    """Vector of thorax to head."""
+    return hd - thx
+
+@register_feature("Dir_unit", ["Dir"])
+def body_unit_vectors(Dir):
+    """Unit vector of thorax to head."""
+    return unit_vectors(Dir)
+
+@register_feature("FV", ["V_vec", "Dir_unit"])
+def forward_velocity(V_vec, Dir_unit):
+    """Forward velocity - magnitude of the velocity in the direction of heading."""
+    return np.sum(V_vec * Dir_unit, axis=1)
+
+@register_feature("FA", ["FV"])
+def forward_acceleration(FV):
+    """Forward acceleration."""
+    return pad_time(np.diff(FV, axis=0))
+
+@register_feature("LV", ["V_vec", "Dir_unit"])
+def lateral_velocity(V_vec, Dir_unit):
+    """Lateral velocity - magnitude of the velocity perpendicular to the forward velocity."""
+    return np.sum(V_vec * perpendicular(Dir_unit), axis=1)
+
+@register_feature("LS", ["LV"])
+def lateral_speed(LV):
+    """Lateral speed - absolute magnitude of perpendicular velocity."""
+    return abs(LV)
+
+@register_feature("LA", ["LV"])
+def lateral_acceleration(LV):
+    """Lateral acceleration."""
+    return pad_time(np.diff(LV, axis=0))
+
+@register_feature("RS", ["Dir"])
+def rotational_speed(Dir, delt=1):
+    """Rotational speed - change in the heading."""
+    RS = signed_angle(Dir[0:(-1 - delt)], Dir[delt:-1])
+    return pad_time(RS, before=1, after=1)
+
+# Pairwise features have shape (time, fly, fly) where [:, i, j] describes fly i relative
+# to fly j. They are computed for all pairs at once by broadcasting over the fly axes.
+
+def mask_self_pairs(x):
+    """Set the entries of a fly relative to itself in a (time, fly, fly) array to NaN."""
+    x = np.array(x, dtype=np.result_type(np.asarray(x).dtype, np.float32))
+    diag = np.arange(x.shape[-1])
+    x[:, diag, diag] = np.nan
+    return x
+
+@register_feature("pairDist_all", ["thx"])
+def pair_distance_all(thx):
+    """Euclidean distance between the thorax of every pair of flies (including self)."""
+    return np.sqrt(np.sum((thx[..., :, None] - thx[..., None, :]) ** 2, axis=1))
+
+@register_feature("pairDir", ["thx", "hd"])
+def pair_vectors(thx, hd):
+    """Vector joining fly i's head to fly j's thorax of shape (time, 2, fly, fly)."""
+    return thx[..., None, :] - hd[..., :, None]
+
+@register_feature("pairDir_unit", ["pairDir"])
+def pair_unit_vectors(pairDir):
+    """Unit vector joining one fly's head to the other's thorax."""
+    return unit_vectors(pairDir)
+
+@register_feature("pairAng_all", ["Dir", "pairDir"])
+def pair_angle_all(Dir, pairDir):
+    """Angle subtended by fly j on fly i."""
+    return signed_angle(np.broadcast_to(Dir[..., :, None], pairDir.shape), pairDir)
+
+@register_feature("pairFV_all", ["V_vec", "pairDir_unit"])
+def pair_velocity_all(V_vec, pairDir_unit):
+    """Velocity of fly i in the direction of fly j."""
+    return np.sum(V_vec[..., :, None] * pairDir_unit, axis=1)
+
+@register_feature("pairLS_all", ["V_vec", "pairDir_unit"])
+def pair_lateral_speed_all(V_vec, pairDir_unit):
+    """Lateral speed of fly i in perpendicular direction of fly j."""
+    return np.abs(np.sum(V_vec[..., :, None] * perpendicular(pairDir_unit), axis=1))
+
+register_feature("pairDist", ["pairDist_all"])(mask_self_pairs)
+register_feature("pairAng", ["pairAng_all"])(mask_self_pairs)
+register_feature("pairFV", ["pairFV_all"])(mask_self_pairs)
+register_feature("pairLS", ["pairLS_all"])(mask_self_pairs)
+register_feature("mfDist", ["pairDist_all"], output=True)(lambda x: x[:, 1, 0])
+
+# Two fly classical features: (name, feature, fly or pair) with fly ordered as [female, male].
+for name, feature, fly in [
+        ("mFV", "FV", 1), ("fFV", "FV", 0),
+        ("mFA", "FA", 1), ("fFA", "FA", 0),
+        ("mLV", "LV", 1), ("fLV", "LV", 0),
+        ("mLS", "LS", 1), ("fLS", "LS", 0),
+        ("mLA", "LA", 1), ("fLA", "LA", 0),
+        ("mRS", "RS", 1), ("fRS", "RS", 0),
+        ("mfAng", "pairAng_all", (1, 0)), ("fmAng", "pairAng_all", (0, 1)),
+        ("mfFV", "pairFV_all", (1, 0)), ("fmFV", "pairFV_all", (0, 1)),
+        ("mfLS", "pairLS_all", (1, 0)), ("fmLS", "pairLS_all", (0, 1))]:
+    register_feature(name, [feature], output=True)(functools.partial(select_fly, fly=fly))
+
+# Outputs of compute_features in the order they are returned.
+CLASSICAL_FEATURES = [
+    "mfDist", "mFV", "fFV", "mFA", "fFA", "mLV", "fLV", "mLS", "fLS", "mLA", "fLA",
+    "mRS", "fRS", "mfAng", "fmAng", "mfFV", "fmFV", "mfLS", "fmLS"]
+
+# Per-fly (time, fly) and pairwise (time, fly, fly) features of compute_group_features.
+GROUP_FEATURES = [
+    "FV", "FA", "LV", "LS", "LA", "RS",
+    "pairDist", "pairAng", "pairFV", "pairLS", "pairArcThetaL", "pairArcThetaR"]
+
+def compute_group_features(tracks, features=GROUP_FEATURES, ctr_ind=1, fwd_ind=0):
+    """Compute per-fly and pairwise features for any number of flies.
+
+    Per-fly features are computed once for all flies and pairwise features are
+    computed for all pairs in one vectorized pass. compute_features is the two fly
+    special case of this.
+
+    Args:
+        tracks: Pose tracks of shape (frame, joint, xy, fly).
+        features: List of names of features to compute. Defaults to GROUP_FEATURES:
+
+            FV, FA, LV, LS, LA, RS: Forward velocity/acceleration, lateral
+                velocity/speed/acceleration and rotational speed of shape (frame, fly).
+                See compute_features.
+            pairDist: Distance between the thorax of fly i and fly j.
+            pairAng: Angle subtended by fly j on fly i.
+            pairFV: Velocity of fly i in the direction of fly j.
+            pairLS: Lateral speed of fly i in the perpendicular direction of fly j.
+            pairArcThetaL, pairArcThetaR: Arc angle of the wings of fly i relative to
+                the head of fly j. See compute_wing_arc_angles.
+
+            Pairwise features are of shape (frame, fly, fly) with [:, i, j] describing
+            fly i relative to fly j. Entries of a fly relative to itself are NaN.
+
+            The egocentric poses of all flies relative to all flies can also be
+            requested as "ego" (see normalize_to_egocentric_batch).
+        ctr_ind: Index of centroid joint. Defaults to 1.
+        fwd_ind: Index of "forward" joint (e.g., head). Defaults to 0.
+
+    Returns:
+        A dictionary of the requested features.
+    """
+    inputs = {"tracks": tracks, "pose": PoseCache(tracks), "ctr_ind": ctr_ind, "fwd_ind": fwd_ind}
+    return compute_feature_graph(features, inputs)
+
+# All features saved by make_expt_dataset by default.
+TRACKING_FEATURES = [
+    "trxF", "trxM", "egoF", "egoM", "egoFrM", "egoMrF",
+    "wingFL", "wingFR", "wingML", "wingMR", "arcThetaL", "arcThetaR"] + CLASSICAL_FEATURES
     
 def connected_components1d(x, return_limits=False):
     """Return the indices of the connected components in a 1D logical array.
@@ -537,10 +1854,10 @@ def connected_components1d(x, return_limits=False):
         If return_limits is True, a single array of size (n, 2) is returned where the
         columns contain the indices of the starts and ends of each component.
     """
-    L, n = scipy.ndimage.label(x.squeeze())
-    ccs = scipy.ndimage.find_objects(L)
-    starts = [cc[0].start for cc in ccs]
-    ends = [cc[0].stop for cc in ccs]
+    x = np.asarray(x).squeeze().astype(bool)
+    edges = np.diff(x.astype("int8"), prepend=np.int8(0), append=np.int8(0))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
     if return_limits:
         return np.stack([starts, ends], axis=1)
     else:
@@ -559,13 +1876,124 @@ def lims_to_mask(lims, size=None):
     """
     if not isinstance(lims, np.ndarray):
         lims = np.array(lims)
-    lims = lims.astype(int)
+    lims = lims.astype(int).reshape(-1, 2)
     if size is None:
         size = lims.max()
-    mask = np.full((size,), False)
-    for i0, i1 in lims:
-        mask[i0:i1] = True
-    return mask
+
+    # Count the intervals covering each element from the cumulative sum of +1 at each
+    # start and -1 at each end.
+    starts = np.clip(lims[:, 0], 0, size)
+    ends = np.clip(lims[:, 1], 0, size)
+    valid = ends > starts
+    delta = (np.bincount(starts[valid], minlength=size + 1) -
+             np.bincount(ends[valid], minlength=size + 1))
+    return np.cumsum(delta[:size]) > 0
+
+def reduce_intervals(x, lims, ufunc=np.fmax, empty=np.nan):
+    """Reduce the values of a vector within each interval.
+
+    Args:
+        x: Vector of values.
+        lims: Indices of limits as an array of shape (n, 2). Intervals may overlap.
+        ufunc: Binary NumPy ufunc used for the reduction. Defaults to np.fmax, which
+            computes the maximum ignoring NaNs.
+        empty: Value of the result for empty intervals. Defaults to NaN.
+
+    Returns:
+        A vector of shape (n,) with the reduction of x[i0:i1] for each interval.
+    """
+    x = np.asarray(x)
+    lims = np.clip(np.asarray(lims, dtype=int).reshape(-1, 2), 0, len(x))
+    out = np.full(len(lims), empty, dtype=np.result_type(x.dtype, np.asarray(empty).dtype))
+    valid = lims[:, 1] > lims[:, 0]
+    if valid.any():
+        # Append an element so that interval ends can be used as indices. Only the
+        # reductions at the interval starts are kept.
+        x = np.append(x, x[-1:])
+        out[valid] = ufunc.reduceat(x, lims[valid].ravel())[::2]
+    return out
+
+def get_frame_sample_edges(sample_at_frame):
+    """Compute the range of DAQ samples that belongs to each frame.
+
+    Samples are assigned to the nearest frame as in SampleFrameMap. The first and last
+    frames are given the same extent on their outer side as on their inner side rather
+    than extending to the ends of the recording.
+
+    Args:
+        sample_at_frame: Vector of the estimated DAQ sample index at each frame.
+
+    Returns:
+        An int64 vector of length len(sample_at_frame) + 1 where frame i contains the
+        samples in [edges[i], edges[i + 1]).
+    """
+    s = np.asarray(sample_at_frame, dtype="float64")
+    bounds = (s[1:] + s[:-1]) / 2
+    bounds = np.concatenate([[2 * s[0] - bounds[0]], bounds, [2 * s[-1] - bounds[-1]]])
+    return np.maximum(np.floor(bounds).astype("int64") + 1, 0)
+
+def interval_coverage(lims, edges):
+    """Count the samples covered by intervals up to each edge.
+
+    This is computed from the sorted starts and ends of the intervals, so it does not
+    depend on the length of the recording.
+
+    Args:
+        lims: Array of shape (n, 2) with the start and end (exclusive) of each interval.
+            Samples covered by several intervals are counted once per interval.
+        edges: Sorted vector of sample indices.
+
+    Returns:
+        An int64 vector with the number of covered samples before each edge.
+    """
+    lims = np.asarray(lims).reshape(-1, 2).astype("int64")
+    edges = np.asarray(edges, dtype="int64")
+    coverage = np.zeros(len(edges), dtype="int64")
+    for x, sign in [(np.sort(lims[:, 0]), 1), (np.sort(lims[:, 1]), -1)]:
+        # Each boundary contributes (edge - boundary) samples to every later edge.
+        n = np.searchsorted(x, edges, side="left")
+        total = np.concatenate([[0], np.cumsum(x)])
+        coverage += sign * (n * edges - total[n])
+    return coverage
+
+def frame_coverage(lims, edges):
+    """Compute the fraction of the samples of each frame covered by intervals.
+
+    Args:
+        lims: Array of shape (n, 2) with the start and end (exclusive) sample of each
+            non-overlapping interval (e.g., runs of pulse song).
+        edges: Sample edges of the frames (see get_frame_sample_edges).
+
+    Returns:
+        A vector of length len(edges) - 1 with the covered fraction of each frame.
+    """
+    return np.diff(interval_coverage(lims, edges)) / np.maximum(np.diff(edges), 1)
+
+def frame_interval_ids(lims, edges):
+    """Find the interval that overlaps each frame.
+
+    Args:
+        lims: Array of shape (n, 2) with the start and end (exclusive) sample of each
+            interval.
+        edges: Sample edges of the frames (see get_frame_sample_edges).
+
+    Returns:
+        An int64 vector of length len(edges) - 1 with the index in lims of the interval
+        with the latest start overlapping each frame, or -1 if there is none.
+    """
+    lims = np.asarray(lims).reshape(-1, 2)
+    n_frames = len(edges) - 1
+    if len(lims) == 0:
+        return np.full(n_frames, -1, dtype="int64")
+    order = np.argsort(lims[:, 0], kind="stable")
+    # First frame and frame after the last frame that contain samples of each interval.
+    f0 = np.clip(np.searchsorted(edges, lims[order, 0], side="right") - 1, 0, n_frames)
+    f1 = np.clip(np.searchsorted(edges, lims[order, 1], side="left"), 0, n_frames)
+    ids = np.full(n_frames, -1, dtype="int64")
+    # Intervals are few (e.g., bouts), so they are painted in order of start.
+    for i, a, b in zip(order, f0, f1):
+        ids[a:b] = i
+    return ids
 
 def encode_hdf5_strings(S):
     """Encodes a list of strings for writing to a HDF5 file.
@@ -576,32 +2004,687 @@ def encode_hdf5_strings(S):
     Returns:
         List of numpy arrays that can be written to HDF5.
     """
-    return [np.string_(x) for x in S]
+    return [np.bytes_(x) for x in S]
+
+# HDF5 layouts of the output datasets. chunk_frames sets the chunk length of
+# time-aligned datasets (None lets h5py pick), compression is a gzip level or "lzf",
+# shuffle enables the byte shuffle filter and float32 stores float features in single
+# precision. Sample indices are always kept in double precision.
+STORAGE_PROFILES = {
+    "default": {"chunk_frames": None, "compression": 1, "shuffle": False, "float32": False},
+    "lzf": {"chunk_frames": 2**14, "compression": "lzf", "shuffle": False, "float32": False},
+    "shuffle_gzip": {"chunk_frames": 2**14, "compression": 4, "shuffle": True, "float32": False},
+    "float32": {"chunk_frames": 2**14, "compression": 1, "shuffle": False, "float32": True},
+    "compact": {"chunk_frames": 2**14, "compression": 4, "shuffle": True, "float32": True},
+}
+
+def get_storage_profile(storage):
+    """Returns the storage profile dictionary given its name or the profile itself."""
+    if isinstance(storage, str):
+        if storage not in STORAGE_PROFILES:
+            raise ValueError(f"Unknown storage profile: {storage} (available: {list(STORAGE_PROFILES)})")
+        return STORAGE_PROFILES[storage]
+    return dict(STORAGE_PROFILES["default"], **storage)
+
+def write_dataset(f, name, data, n_frames=None, storage="default"):
+    """Write a dataset to an open HDF5 file using a storage profile.
+
+    Args:
+        f: The open h5py.File or group to write to.
+        name: Name of the dataset.
+        data: Array to write.
+        n_frames: Number of frames in the experiment. Datasets with this many rows are
+            considered time-aligned and use the chunk length and dtype of the profile.
+        storage: Name of a profile in STORAGE_PROFILES or a dictionary with the
+            settings to override in the default profile.
+
+    Returns:
+        The created h5py.Dataset.
+    """
+    profile = get_storage_profile(storage)
+    data = np.asarray(data)
+    if data.ndim == 0 or data.dtype.kind not in "biuf":
+        return f.create_dataset(name, data=data)
+
+    kwargs = {"compression": profile["compression"], "shuffle": profile["shuffle"]}
+    is_time_aligned = n_frames is not None and data.ndim > 0 and len(data) == n_frames and n_frames > 0
+    if is_time_aligned and profile["chunk_frames"] is not None:
+        kwargs["chunks"] = (min(profile["chunk_frames"], n_frames),) + data.shape[1:]
+    if is_time_aligned and profile["float32"] and data.dtype == np.float64 and name != "sample_at_frame":
+        data = data.astype("float32")
+    return f.create_dataset(name, data=data, **kwargs)
+
+def create_frame_dataset(f, name, shape, dtype, storage="default"):
+    """Create an empty resizable time-aligned dataset that is written in blocks.
+
+    Args:
+        f: The open h5py.File or group to write to.
+        name: Name of the dataset.
+        shape: Shape of the dataset. The first axis is time.
+        dtype: Data type of the data to be written.
+        storage: Name of a profile in STORAGE_PROFILES or a dictionary with the
+            settings to override in the default profile.
+
+    Returns:
+        The created h5py.Dataset.
+    """
+    profile = get_storage_profile(storage)
+    dtype = np.dtype(dtype)
+    if profile["float32"] and dtype == np.float64 and name != "sample_at_frame":
+        dtype = np.dtype("float32")
+    chunks = True
+    if profile["chunk_frames"] is not None and shape[0] > 0:
+        chunks = (min(profile["chunk_frames"], shape[0]),) + tuple(shape[1:])
+    return f.create_dataset(
+        name, shape=shape, maxshape=(None,) + tuple(shape[1:]), dtype=dtype, chunks=chunks,
+        compression=profile["compression"], shuffle=profile["shuffle"]
+    )
+
+def file_fingerprint(path, previous=None, block_size=2**24):
+    """Compute a fingerprint of the contents of a file to detect changes.
+
+    Args:
+        path: Path to the file.
+        previous: Optional fingerprint of the same file from an earlier run. If the size
+            and modification time of the file are unchanged, its hash is reused so the
+            file is not read again.
+        block_size: Number of bytes to read at a time when hashing. Defaults to 16 MB.
+
+    Returns:
+        A dictionary with the path, size, mtime and the SHA1 hash of the whole file
+        ("sha1"). Only the size and hash identify the contents (see
+        same_file_contents), so touching or copying an unchanged file does not count
+        as a change.
+    """
+    stat = os.stat(path)
+    if previous is not None and "sha1" in previous and (previous["size"], previous["mtime"]) == (stat.st_size, stat.st_mtime):
+        return {"path": path, "size": stat.st_size, "mtime": stat.st_mtime, "sha1": previous["sha1"]}
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(functools.partial(f.read, block_size), b""):
+            h.update(block)
+    return {"path": path, "size": stat.st_size, "mtime": stat.st_mtime, "sha1": h.hexdigest()}
+
+def same_file_contents(old, new):
+    """Check whether two file fingerprints describe the same contents.
+
+    Fingerprints saved before whole-file hashes were used (without "sha1") are
+    considered unchanged if the size and modification time are the same.
+    """
+    if "sha1" in old and "sha1" in new:
+        return old["size"] == new["size"] and old["sha1"] == new["sha1"]
+    return (old["size"], old["mtime"]) == (new["size"], new["mtime"])
+
+# Stages of make_expt_dataset and the stages whose outputs they use.
+STAGE_DEPENDENCIES = {
+    "sync": [],
+    "tracking": [],
+    "song": ["sync", "tracking"],
+}
 
-def make_expt_dataset(expt_folder, output_path=None, overwrite=False, with_audio=False, min_sine_wing_ang=30, ctr_ind=1, fwd_ind=0, skip_audio=False):
+def read_manifest(expt_path):
+    """Read the stage manifest of an experiment dataset.
+
+    Args:
+        expt_path: Path to experiment dataset.
+
+    Returns:
+        A dictionary mapping each stage name to a dictionary with the fingerprints of
+        its "inputs", its "params" and the names of the "datasets" it produced, or None
+        if the dataset does not have a manifest.
+    """
+    with h5py.File(expt_path, "r") as f:
+        if "manifest" not in f:
+            return None
+        return {k: json.loads(v) for k, v in f["manifest"].attrs.items()}
+
+def find_stale_stages(old_manifest, manifest):
+    """Find the stages whose inputs or parameters changed.
+
+    Args:
+        old_manifest: Manifest stored in an existing dataset (see read_manifest).
+        manifest: Manifest describing the current inputs and parameters. Only the
+            "inputs" and "params" keys are compared.
+
+    Returns:
+        A set of names of stages that need to be recomputed. This includes stages in
+        old_manifest that depend on recomputed stages.
+    """
+    def inputs_changed(old_entry, entry):
+        if set(old_entry["inputs"]) != set(entry["inputs"]):
+            return True
+        return not all(same_file_contents(old_entry["inputs"][name], x) for name, x in entry["inputs"].items())
+
+    stale = set()
+    for stage, entry in manifest.items():
+        old_entry = old_manifest.get(stage)
+        if (old_entry is None or inputs_changed(old_entry, entry) or
+                old_entry["params"] != entry["params"]):
+            stale.add(stage)
+
+    for stage in STAGE_DEPENDENCIES:
+        if any(dep in stale for dep in STAGE_DEPENDENCIES[stage]):
+            stale.add(stage)
+    return stale
+
+def get_rss():
+    """Returns the current resident memory of this process in bytes, or NaN if unknown."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return np.nan
+
+class StageProfiler:
+    """Records the run time and memory use of named processing stages.
+
+    Stages are timed with the stage context manager. Entering a stage that was already
+    recorded adds to its time, so a stage can be made of several separate calls. Stages
+    can be nested, in which case the time and memory of the inner stage also count
+    towards the outer stage. Stages can be recorded from several threads, in which case
+    the time of a stage is the sum of its time in each thread.
+
+    Args:
+        trace_memory: If True, record the peak memory allocated through Python
+            (including numpy arrays) in each stage with tracemalloc. This slows down
+            code that allocates many small objects. Defaults to False.
+
+    Attributes:
+        stages: Dictionary mapping each stage name to a dictionary with "time_s" (total
+            run time), "calls", "rss_mb" (resident memory at the end of the stage),
+            "max_rss_mb" (peak resident memory of the process so far) and "peak_mb"
+            (peak traced memory, only if trace_memory is True).
+    """
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.stages = dict()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    @property
+    def stack(self):
+        """Stack of the stages entered by the current thread."""
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager that profiles the code in its block as the named stage."""
+        started_tracing = False
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            elif len(self.stack) > 0:
+                # Keep the peak of the outer stage before resetting it for this stage.
+                self.stack[-1][1] = max(self.stack[-1][1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        entry = [name, 0]
+        self.stack.append(entry)
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - t0
+            self.stack.pop()
+            with self.lock:
+                stats = self.stages.setdefault(name, {"time_s": 0.0, "calls": 0})
+                stats["time_s"] += elapsed
+                stats["calls"] += 1
+                stats["rss_mb"] = get_rss() / 1024 ** 2
+                stats["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+                if self.trace_memory:
+                    peak = max(entry[1], tracemalloc.get_traced_memory()[1])
+                    stats["peak_mb"] = max(stats.get("peak_mb", 0), peak / 1024 ** 2)
+                    if len(self.stack) > 0:
+                        self.stack[-1][1] = max(self.stack[-1][1], peak)
+                    if started_tracing:
+                        tracemalloc.stop()
+            logger.debug(f"stage {name}: {elapsed:.2f} s, RSS {stats['rss_mb']:.0f} MB")
+
+    def summary(self):
+        """Returns a one-line summary of the time spent in each stage."""
+        return ", ".join(f"{name} {stats['time_s']:.2f} s" for name, stats in self.stages.items())
+
+    def save(self, f):
+        """Save the profile as attributes of a "profile" group in an open HDF5 file.
+
+        Each stage is saved as a subgroup with one attribute per statistic.
+        """
+        if "profile" in f:
+            del f["profile"]
+        grp = f.create_group("profile")
+        grp.attrs["host"] = os.uname().nodename
+        grp.attrs["date"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        for name, stats in self.stages.items():
+            stage_grp = grp.create_group(name)
+            for k, v in stats.items():
+                stage_grp.attrs[k] = v
+
+    def append_json(self, path, **info):
+        """Append the profile as a single JSON line to a log file.
+
+        Args:
+            path: Path to the log file.
+            **info: Additional fields to include (e.g., expt_name).
+        """
+        record = dict(info, host=os.uname().nodename, date=time.strftime("%Y-%m-%d %H:%M:%S"), slurm_job_id=os.environ.get("SLURM_JOB_ID"), slurm_array_task_id=os.environ.get("SLURM_ARRAY_TASK_ID"), stages=self.stages)
+        with open(path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+def compute_tracking_stage(expt_folder, ctr_ind=1, fwd_ind=0, features=TRACKING_FEATURES, profiler=None, tracks=None, executor=None, dtype=None):
+    """Load pose tracks and compute the tracking-related features.
+
+    Args:
+        expt_folder: Full absolute path to the experiment folder.
+        ctr_ind: Index of centroid joint. Defaults to 1.
+        fwd_ind: Index of "forward" joint (e.g., head). Defaults to 0.
+        features: List of names of registered features to compute. Defaults to
+            TRACKING_FEATURES.
+        profiler: Optional StageProfiler to record the "tracks", "ego", "wings", "arc"
+            and "features" stages in.
+        tracks: Optional tuple of (tracks, node_names) already loaded with load_tracks,
+            or a future that returns it.
+        executor: Optional concurrent.futures.Executor to compute independent features
+            on concurrently. See compute_feature_graph.
+        dtype: Optional floating point data type (e.g., "float32") to load the tracks
+            as and compute the features in. Defaults to the data type of the file.
+
+    Returns:
+        A tuple of (data, n_frames) containing a dictionary of datasets to save and the
+        number of tracked frames.
+    """
+    if profiler is None:
+        profiler = StageProfiler()
+
+    # Load tracking.
+    with profiler.stage("tracks"):
+        if tracks is None:
+            tracks = load_tracks(expt_folder, dtype=dtype)
+        elif isinstance(tracks, concurrent.futures.Future):
+            tracks = tracks.result()
+        tracks, node_names = tracks
+        if dtype is not None:
+            tracks = tracks.astype(dtype, copy=False)
+
+    # Compute the requested features and only what they depend on. Gap-filled series are
+    # shared across all features through the pose cache.
+    inputs = {"tracks": tracks, "pose": PoseCache(tracks), "ctr_ind": ctr_ind, "fwd_ind": fwd_ind}
+    feats = compute_feature_graph(features, inputs, profiler=profiler, executor=executor, dtype=dtype)
+
+    logger.info("features created")
+
+    data = dict()
+    data["node_names"] = encode_hdf5_strings(node_names)
+    data.update(feats)
+    return data, len(tracks)
+
+def find_last_tracked_frame(ds, chunk_frames=2**14):
+    """Find the last frame with any tracked coordinate by scanning backwards in blocks.
+
+    Args:
+        ds: The h5py.Dataset of tracks stored as (fly, xy, joint, frame).
+        chunk_frames: Number of frames to read at a time.
+
+    Returns:
+        Index of the last frame with any finite coordinate, or -1 if there is none.
+    """
+    n = ds.shape[-1]
+    for f1 in range(n, 0, -chunk_frames):
+        f0 = max(f1 - chunk_frames, 0)
+        is_tracked = np.isfinite(ds[..., f0:f1]).reshape(-1, f1 - f0).any(axis=0)
+        if is_tracked.any():
+            return f0 + int(np.flatnonzero(is_tracked)[-1])
+    return -1
+
+class TrackWindowReader:
+    """Reads blocks of pose tracks with the context needed for exact gap filling.
+
+    Gap filling interpolates between the previous and next valid samples of each
+    series, which can be arbitrarily far from a block. Instead of reading up to them,
+    the reader keeps the last valid sample of each filled series before the next block
+    and the next valid sample after the current one, so every read covers only the
+    requested frames. The next valid sample is searched for by reading only the filled
+    series, once per gap. Blocks must be read in order.
+
+    Args:
+        ds: The h5py.Dataset of tracks stored as (fly, xy, joint, frame).
+        n_frames: Number of frames to read (see find_last_tracked_frame).
+        fill_joints: Indices of the joints that are gap filled.
+        chunk_frames: Number of frames to read at a time when searching for the next
+            valid sample.
+    """
+    def __init__(self, ds, n_frames, fill_joints, chunk_frames=2**14):
+        self.ds = ds
+        self.n_frames = n_frames
+        self.fill_joints = list(fill_joints)
+        self.chunk_frames = chunk_frames
+        n_series = len(self.fill_joints) * 2 * ds.shape[0]
+        self.prev_frame = np.full(n_series, -1)  # Last valid sample before the next block.
+        self.prev_value = np.full(n_series, np.nan)
+        self.next_frame = np.full(n_series, -1)  # First valid sample found by the last search.
+        self.next_value = np.full(n_series, np.nan)
+
+    def read(self, f0, f1):
+        """Read frames [f0, f1) as (frame, joint, xy, fly) with context for gap filling.
+
+        Returns:
+            A tuple of (tracks, before, after) where before and after are the valid
+            samples of each series around the block to pass to PoseCache.
+        """
+        tracks = self.read_frames(f0, f1)
+
+        # Search forwards for the next valid sample of series that are missing at the
+        # end of the block, unless it was already found for a previous block.
+        missing = ~np.isfinite(self.get_series(tracks[-1:])[0])
+        pending = missing & (self.next_frame < f1)
+        search_from = f1
+        while pending.any() and search_from < self.n_frames:
+            search_to = min(search_from + self.chunk_frames, self.n_frames)
+            series = self.read_series(search_from, search_to)
+            valid = np.isfinite(series)
+            found = np.flatnonzero(pending & valid.any(axis=0))
+            first = np.argmax(valid[:, found], axis=0)
+            self.next_frame[found] = search_from + first
+            self.next_value[found] = series[first, found]
+            pending[found] = False
+            search_from = search_to
+        self.next_frame[pending] = self.n_frames
+        self.next_value[pending] = np.nan
+
+        before = self.to_joints(self.prev_frame - f0, self.prev_value)
+        after = self.to_joints(self.next_frame - f0, np.where(missing, self.next_value, np.nan))
+        return tracks, before, after
+
+    def advance(self, tracks, start, f):
+        """Record the last valid sample of each series before frame f for the next block.
+
+        Args:
+            tracks: Tracks returned by read.
+            start: First frame of tracks.
+            f: First frame of the next read.
+        """
+        series = self.get_series(tracks[:f - start])
+        valid = np.isfinite(series)
+        has_valid = np.flatnonzero(valid.any(axis=0))
+        last = len(valid) - 1 - np.argmax(valid[::-1, has_valid], axis=0)
+        self.prev_frame[has_valid] = start + last
+        self.prev_value[has_valid] = series[last, has_valid]
+
+    def read_frames(self, f0, f1, joints=slice(None)):
+        """Read frames [f0, f1) of the given joints as (frame, joint, xy, fly)."""
+        return np.transpose(self.ds[:, :, joints, f0:f1])
+
+    def read_series(self, f0, f1):
+        """Read only the filled series of frames [f0, f1) as an array of shape (frame, series)."""
+        return self.read_frames(f0, f1, joints=self.fill_joints).reshape(f1 - f0, -1)
+
+    def get_series(self, tracks):
+        """Returns the filled series of tracks as an array of shape (frame, series)."""
+        return tracks[:, self.fill_joints].reshape(len(tracks), -1)
+
+    def to_joints(self, index, value):
+        """Expand arrays of the filled series to arrays of shape (joint, xy, fly)."""
+        n_flies, _, n_joints = self.ds.shape[:3]
+        shape = (len(self.fill_joints), 2, n_flies)
+        full_index = np.zeros((n_joints, 2, n_flies), dtype=index.dtype)
+        full_value = np.full((n_joints, 2, n_flies), np.nan)
+        full_index[self.fill_joints] = index.reshape(shape)
+        full_value[self.fill_joints] = value.reshape(shape)
+        return full_index, full_value
+
+def compute_tracking_stage_chunked(expt_folder, f, ctr_ind=1, fwd_ind=0, features=TRACKING_FEATURES, return_features=(), chunk_frames=2**16, halo=2, storage="default", profiler=None, dtype=None):
+    """Compute the tracking-related features in blocks of frames and write them to a file.
+
+    Only a block of frames (plus the context needed for exact results) is in memory at
+    a time, so peak memory is set by the chunk size instead of the recording length.
+    Each block is read with a halo of frames on both sides so that features computed
+    from differences of neighboring frames (velocities, accelerations and rotational
+    speed) are the same as when computing the whole recording at once.
+
+    Args:
+        expt_folder: Full absolute path to the experiment folder.
+        f: The open h5py.File to write the features to, or None to only return
+            return_features.
+        ctr_ind: Index of centroid joint. Defaults to 1.
+        fwd_ind: Index of "forward" joint (e.g., head). Defaults to 0.
+        features: List of names of registered features to compute and write.
+        return_features: List of names of registered features to return in memory
+            (e.g., the male wing angles for the sine filter).
+        chunk_frames: Number of frames per block. Defaults to 65536.
+        halo: Number of frames of context on each side of a block. Defaults to 2.
+        storage: Name of the storage profile of the datasets (see STORAGE_PROFILES).
+        profiler: Optional StageProfiler to record the stages in.
+        dtype: Optional floating point data type (e.g., "float32") to compute the
+            features in. Defaults to the data type of the file.
+
+    Returns:
+        A tuple of (n_frames, returned) where returned is a dictionary with the full
+        length arrays of return_features.
+    """
+    if profiler is None:
+        profiler = StageProfiler()
+
+    track_file = find_track_file(expt_folder)
+    with h5py.File(track_file, "r") as f_tracks:
+        ds = f_tracks["tracks"]
+        node_names = [x.decode() for x in f_tracks["node_names"][:]]
+        if f is not None:
+            f.create_dataset("node_names", data=encode_hdf5_strings(node_names))
+
+        # Crop to valid range as in load_tracks.
+        with profiler.stage("tracks"):
+            n_frames = max(find_last_tracked_frame(ds), 0)
+
+        # Joints whose gaps are filled by the pose features: the centroid and forward
+        # joints, and the head, thorax and wings used by the wing arc angles.
+        fill_joints = sorted({ctr_ind, fwd_ind, 0, 1, 3, 4})
+        reader = TrackWindowReader(ds, n_frames, fill_joints, chunk_frames=min(chunk_frames, 2**14))
+
+        names = list(features) + [x for x in return_features if x not in features]
+        returned = dict()
+        for f0 in range(0, n_frames, chunk_frames):
+            f1 = min(f0 + chunk_frames, n_frames)
+            start = max(f0 - halo, 0)
+            with profiler.stage("tracks"):
+                tracks, before, after = reader.read(start, min(f1 + halo, n_frames))
+                reader.advance(tracks, start, max(f1 - halo, 0))
+                if dtype is not None:
+                    tracks = tracks.astype(dtype, copy=False)
+
+            inputs = {"tracks": tracks, "pose": PoseCache(tracks, before=before, after=after), "ctr_ind": ctr_ind, "fwd_ind": fwd_ind}
+            feats = compute_feature_graph(names, inputs, profiler=profiler, dtype=dtype)
+
+            with profiler.stage("write"):
+                for name, x in feats.items():
+                    x = x[f0 - start:f1 - start]
+                    if name in features:
+                        if name not in f:
+                            create_frame_dataset(f, name, (n_frames,) + x.shape[1:], x.dtype, storage=storage)
+                        f[name][f0:f1] = x
+                    if name in return_features:
+                        if name not in returned:
+                            returned[name] = np.empty((n_frames,) + x.shape[1:], dtype=x.dtype)
+                        returned[name][f0:f1] = x
+            logger.debug(f"computed frames {f0}-{f1} of {n_frames} ({len(tracks)} frames read)")
+
+    logger.info("features created")
+    return n_frames, returned
+
+def compute_song_stage(expt_folder, sample_at_frame, frame_at_sample, n_frames, wingML, wingMR, with_audio=False, min_sine_wing_ang=30, profiler=None, song=None):
+    """Load song segmentation and filter it to the video.
+
+    Args:
+        expt_folder: Full absolute path to the experiment folder.
+        sample_at_frame: Vector of the estimated DAQ sample index at each frame.
+        frame_at_sample: Estimated frame index at each sample (see get_expt_sync).
+        n_frames: Number of tracked frames.
+        wingML: Male left wing angle at each frame.
+        wingMR: Male right wing angle at each frame.
+        with_audio: If True, include audio data. Defaults to False.
+        min_sine_wing_ang: Minimum wing angle that must be within a sine bout to be
+            considered valid. Defaults to 30.
+        profiler: Optional StageProfiler to record the "song" and "sine_filter" stages
+            in.
+        song: Optional song intervals already loaded with load_song_intervals, or a
+            future that returns them.
+
+    Returns:
+        A dictionary of datasets to save.
+    """
+    if profiler is None:
+        profiler = StageProfiler()
+
+    logger.info("loading song data")
+    # Load song.
+    with profiler.stage("song"):
+        if song is None:
+            song = load_song_intervals(expt_folder)
+        elif isinstance(song, concurrent.futures.Future):
+            song = song.result()
+        if with_audio:
+            audio = load_song_audio(expt_folder)
+    pslow_lims, pfast_lims, sine_lims = song["pslow_lims"], song["pfast_lims"], song["sine_lims"]
+    pulse_bouts, sine_bouts, mix_bouts = song["pulse_bouts"], song["sine_bouts"], song["mix_bouts"]
+
+    # Filter out invalid song (outside of video bounds).
+    s0 = sample_at_frame[0]
+    s1 = sample_at_frame[n_frames - 1]
+    pslow_lims = pslow_lims[(pslow_lims[:, 0] >= s0) & (pslow_lims[:, 1] <= s1)]
+    pfast_lims = pfast_lims[(pfast_lims[:, 0] >= s0) & (pfast_lims[:, 1] <= s1)]
+    sine_lims = sine_lims[(sine_lims[:, 0] >= s0) & (sine_lims[:, 1] <= s1)]
+
+    pulse_bouts = pulse_bouts[(pulse_bouts[:, 0] >= s0) & (pulse_bouts[:, 1] <= s1)]
+    sine_bouts = sine_bouts[(sine_bouts[:, 0] >= s0) & (sine_bouts[:, 1] <= s1)]
+    mix_bouts = mix_bouts[(mix_bouts[:, 0] >= s0) & (mix_bouts[:, 1] <= s1)]
+
+    # Filter out sine without minimum wing angle.
+    with profiler.stage("sine_filter"):
+        max_wing_ang = reduce_intervals(np.fmax(wingML, wingMR), frame_at_sample[sine_lims], np.fmax)
+        valid_sines = max_wing_ang > min_sine_wing_ang
+        sine_lims = sine_lims[valid_sines]
+
+    data = dict()
+    data["pslow_lims"] = pslow_lims
+    data["pfast_lims"] = pfast_lims
+    data["sine_lims"] = sine_lims
+    data["pulse_bouts"] = pulse_bouts
+    data["sine_bouts"] = sine_bouts
+    data["mix_bouts"] = mix_bouts
+    if with_audio:
+        data["audio"] = audio
+
+    # Index of song events sorted by time.
+    data["event_frames"], data["event_types"] = make_event_index(
+        [pfast_lims, pslow_lims, sine_lims], frame_at_sample
+    )
+
+    # Song at each frame.
+    with profiler.stage("song_frames"):
+        data.update(compute_song_frames(sample_at_frame, n_frames, [pfast_lims, pslow_lims, sine_lims], [pulse_bouts, sine_bouts, mix_bouts]))
+    return data
+
+def compute_song_frames(sample_at_frame, n_frames, song_lims, bout_lims):
+    """Compute frame-aligned song channels from song intervals.
+
+    Args:
+        sample_at_frame: Vector of the estimated DAQ sample index at each frame.
+        n_frames: Number of tracked frames.
+        song_lims: List of (n, 2) arrays of the start and end samples of the runs of
+            each type in SONG_EVENT_TYPES.
+        bout_lims: List of (n, 2) arrays of the start and end samples of the bouts of
+            each type in SONG_BOUT_TYPES.
+
+    Returns:
+        A dictionary with the datasets in SONG_FRAME_FEATURES:
+
+        pfast_frac, pslow_frac, sine_frac: Fraction of the samples of each frame that
+        are detected as each type of song.
+
+        song_bout_id: Number of the bout overlapping each frame, counting the bouts of
+        all types in order of onset, or -1 outside of bouts.
+
+        song_bout_type: Index in SONG_BOUT_TYPES of the type of the bout overlapping
+        each frame, or -1 outside of bouts.
+    """
+    edges = get_frame_sample_edges(sample_at_frame)[:n_frames + 1]
+    data = dict()
+    for name, lims in zip(SONG_EVENT_TYPES, song_lims):
+        data[f"{name}_frac"] = frame_coverage(lims, edges)
+
+    bouts = np.concatenate([np.reshape(x, (-1, 2)) for x in bout_lims], axis=0)
+    types = np.concatenate([np.full((len(np.reshape(x, (-1, 2))),), i, dtype="int8") for i, x in enumerate(bout_lims)])
+    order = np.argsort(bouts[:, 0], kind="stable")
+    bout_ids = frame_interval_ids(bouts[order], edges)
+    data["song_bout_id"] = bout_ids
+    # Frames outside of bouts index the -1 appended at the end.
+    data["song_bout_type"] = np.append(types[order], np.int8(-1))[bout_ids]
+    return data
+
+def make_expt_dataset(expt_folder, output_path=None, overwrite=False, with_audio=False, min_sine_wing_ang=30, ctr_ind=1, fwd_ind=0, skip_audio=False, features=None, store_path=None, storage="default", trace_memory=False, profile_path=None, chunk_frames=None, n_threads=None, precision="float64"):
     """Gather experiment data into a single file.
 
+    The dataset stores a manifest with the fingerprints of the input files and the
+    parameters used by each stage (sync, tracking and song). If the output already
+    exists and has a manifest, only the stages whose inputs or parameters changed
+    (and the stages that depend on them) are recomputed. The outputs of the other
+    stages are copied over from the existing file.
+
     Args:
         expt_folder: Full absolute path to the experiment folder.
         output_path: Path to save the resulting dataset to. Can be specified as a folder
             or full path ending with ".h5". Defaults to saving to current folder. If a
             folder is specified, the dataset filename will be the experiment folder
             name with ".h5".
-        overwrite: If True, overwrite even if the output path already exists. Defaults
-            to False.
+        overwrite: If True, recompute all stages even if the output path already
+            exists. If False, existing outputs without a manifest are left untouched.
+            Defaults to False.
         with_audio: If True, include audio data which will drastically increase
             filesize. Defaults to False.
         min_sine_wing_ang: Minimum wing angle that must be within a sine bout to be
             considered valid. This filters noisy sine predictions. Defaults to 30.
         ctr_ind: Index of centroid joint. Defaults to 1.
         fwd_ind: Index of "forward" joint (e.g., head). Defaults to 0.
+        skip_audio: If True, do not load song. Song outputs of a previous run are kept
+            if they are still up to date. Defaults to False.
+        features: List of names of tracking features to compute and save, e.g.,
+            ["mfDist", "mFV", "wingML"]. Only these and the intermediates they depend
+            on are computed. See FEATURES for all registered features. Defaults to
+            TRACKING_FEATURES (all features).
+        store_path: Optional path to a consolidated feature store (see
+            store.FeatureStore). If specified, the dataset is appended to the store,
+            replacing the experiment if it was recomputed.
+        storage: Name of a profile in STORAGE_PROFILES setting the chunking,
+            compression and precision of the output datasets, or a dictionary with the
+            settings to override in the default profile. Defaults to "default".
+        trace_memory: If True, record the peak memory of each stage with tracemalloc
+            in addition to the run time and resident memory. Defaults to False.
+        profile_path: Optional path to a log file that the stage profile is appended
+            to as a JSON line. The profile is also saved in the "profile" group of the
+            output dataset.
+        chunk_frames: If specified, compute the tracking features in blocks of this
+            many frames and write each block directly to the output file, so that peak
+            memory does not grow with the recording length. See
+            compute_tracking_stage_chunked. Defaults to None (compute all at once).
+        n_threads: If specified, run concurrently on a pool of this many threads. The
+            sync, tracks and song inputs are read in parallel, independent features are
+            computed in parallel and datasets are written by a background thread while
+            the song stage is computed. Stage times in the profile then include the time
+            spent waiting for other threads. Defaults to None (run sequentially).
+        precision: "float64" or "float32". With "float32", tracks are loaded, features
+            are computed and frame-aligned datasets are stored in single precision,
+            which halves memory and I/O. Angles that are sensitive to rounding are
+            still computed in float64 (see signed_angle). Use "benchmark.py precision"
+            to check the error on an experiment. Defaults to "float64".
 
     Returns:
         Path to output dataset.
     """
     
     expt_name = os.path.basename(expt_folder)
-    print(f"Starting with: expt_name")
+    logger.info(f"Starting with: {expt_name}")
+    profiler = StageProfiler(trace_memory=trace_memory)
 
     if output_path is None:
         output_path = os.getcwd()
@@ -609,112 +2692,242 @@ def make_expt_dataset(expt_folder, output_path=None, overwrite=False, with_audio
     if not output_path.endswith(".h5"):
         output_path = os.path.join(output_path, f"{expt_name}.h5")
 
+    if features is None:
+        features = TRACKING_FEATURES
+    unknown = [x for x in features if x not in FEATURES or not FEATURES[x].output]
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown features: {unknown}")
+    if precision not in ("float64", "float32"):
+        raise ValueError(f"Unknown precision: {precision} (available: float64, float32)")
+    dtype = None if precision == "float64" else precision
+
+    # Read the manifest of an existing output.
+    old_manifest = None
     if os.path.exists(output_path) and not overwrite:
-        print(f"output path already exists and overwrite is set to False")
-        return output_path
-
-    print(f"will save features to {output_path}")
-    # Load synchronization.
-    sample_at_frame, frame_at_sample = get_expt_sync(expt_folder)
-
-    # Load tracking.
-    tracks, node_names = load_tracks(expt_folder)
-
-    # Compute tracking-related features.
-    trxF = tracks[..., 0] ###tracks switched in proofreading step from how typically ordered
-    trxM = tracks[..., 1] ###tracks switched in proofreading step from how typically ordered
-    egoF = normalize_to_egocentric(trxF)
-    egoM = normalize_to_egocentric(trxM)
-    egoFrM = normalize_to_egocentric(trxF, rel_to=trxM, ctr_ind=ctr_ind, fwd_ind=fwd_ind)
-    egoMrF = normalize_to_egocentric(trxM, rel_to=trxF, ctr_ind=ctr_ind, fwd_ind=fwd_ind)
-    wingFL, wingFR = compute_wing_angles(egoF)
-    wingML, wingMR = compute_wing_angles(egoM)
-    arcThetaL, arcThetaR = compute_wing_arc_angles(trxM, trxF)
-
-    # Compute standard classical features.
-    feats = compute_features(trxF[:, ctr_ind, :], trxM[:, ctr_ind, :], trxF[:, fwd_ind, :], trxM[:, fwd_ind, :])
-
-    print("features created")
-
+        old_manifest = read_manifest(output_path)
+        if old_manifest is None:
+            logger.info(f"output path already exists and overwrite is set to False")
+            add_to_store(store_path, output_path)
+            return output_path
+
+    def fingerprint(stage, name, path):
+        # Input files whose size and modification time did not change are not hashed again.
+        previous = None if old_manifest is None else old_manifest.get(stage, {}).get("inputs", {}).get(name)
+        return file_fingerprint(path, previous=previous)
+
+    # Describe the inputs and parameters of each stage.
+    manifest = dict()
+    manifest["sync"] = {
+        "inputs": {"daq": fingerprint("sync", "daq", os.path.join(expt_folder, "daq.h5"))},
+        "params": {},
+    }
+    manifest["tracking"] = {
+        "inputs": {"tracks": fingerprint("tracking", "tracks", find_track_file(expt_folder))},
+        "params": {"ctr_ind": ctr_ind, "fwd_ind": fwd_ind, "features": sorted(features)},
+    }
     if not skip_audio:
-        print("loading song data")
-        # Load song.
-        if with_audio:
-            pslow, pfast, sine, pulse_bouts, sine_bouts, mix_bouts, audio = load_song(expt_folder, return_audio=True)
-        else:
-            pslow, pfast, sine, pulse_bouts, sine_bouts, mix_bouts = load_song(expt_folder, return_audio=False)
-        pslow_lims = connected_components1d(pslow, return_limits=True)
-        pfast_lims = connected_components1d(pfast, return_limits=True)
-        sine_lims = connected_components1d(sine, return_limits=True)
-
-        # Filter out invalid song (outside of video bounds).
-        s0 = sample_at_frame[0]
-        s1 = sample_at_frame[len(tracks) - 1]
-        pslow_lims = pslow_lims[(pslow_lims[:, 0] >= s0) & (pslow_lims[:, 1] <= s1)]
-        pfast_lims = pfast_lims[(pfast_lims[:, 0] >= s0) & (pfast_lims[:, 1] <= s1)]
-        sine_lims = sine_lims[(sine_lims[:, 0] >= s0) & (sine_lims[:, 1] <= s1)]
-
-        pulse_bouts = pulse_bouts[(pulse_bouts[:, 0] >= s0) & (pulse_bouts[:, 1] <= s1)]
-        sine_bouts = sine_bouts[(sine_bouts[:, 0] >= s0) & (sine_bouts[:, 1] <= s1)]
-        mix_bouts = mix_bouts[(mix_bouts[:, 0] >= s0) & (mix_bouts[:, 1] <= s1)]
-
-        # Filter out sine without minimum wing angle.
-        valid_sines = []
-        for s0, s1 in sine_lims:
-            f0 = int(frame_at_sample[s0])
-            f1 = int(frame_at_sample[s1])
-            wing_angs = np.concatenate([wingML[f0:f1], wingMR[f0:f1]])
-            if (~np.isnan(wing_angs)).any() and (np.nanmax(wing_angs) > min_sine_wing_ang):
-                valid_sines.append(True)
-            else:
-                valid_sines.append(False)
-        valid_sines = np.stack(valid_sines)
-        sine_lims = sine_lims[valid_sines]
+        manifest["song"] = {
+            "inputs": {"song": fingerprint("song", "song", find_song_file(expt_folder))},
+            "params": {"min_sine_wing_ang": min_sine_wing_ang, "with_audio": with_audio},
+        }
+
+    # Rewrite all stages when the layout changes. The default layout is not recorded so
+    # that datasets written before storage profiles existed stay up to date.
+    profile = get_storage_profile(storage)
+    if profile != STORAGE_PROFILES["default"]:
+        for stage in manifest:
+            manifest[stage]["params"]["storage"] = profile
+
+    # Single precision features are also stored in single precision. This only changes
+    # the tracking and song frame features (sample_at_frame is always float64), so sync
+    # is not recomputed when the precision changes.
+    if precision == "float32":
+        storage = dict(profile, float32=True)
+        for stage in ["tracking", "song"]:
+            if stage in manifest:
+                manifest[stage]["params"]["precision"] = precision
+
+    # Find which stages need to be recomputed.
+    if old_manifest is not None:
+        stale = find_stale_stages(old_manifest, manifest)
+        keep = [stage for stage in old_manifest if stage not in stale]
+        if len(stale) == 0:
+            # Record new modification times of unchanged inputs (e.g., touched or copied
+            # files) so that they are not hashed again next time.
+            if any(old_manifest[stage]["inputs"] != manifest[stage]["inputs"] for stage in manifest):
+                with h5py.File(output_path, "a") as f:
+                    for stage in manifest:
+                        f["manifest"].attrs[stage] = json.dumps(dict(old_manifest[stage], inputs=manifest[stage]["inputs"]))
+            logger.info(f"output path already exists and is up to date")
+            add_to_store(store_path, output_path)
+            return output_path
+        logger.info(f"recomputing stages: {', '.join(sorted(stale & set(manifest)))}")
+    else:
+        stale = set(manifest)
+        keep = []
+
+    logger.info(f"will save features to {output_path}")
+    stage_data = dict()
+    written = dict()
 
     # Ensure output folder exists.
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
-    print("saving to output file")
-    # Save.
-    with h5py.File(output_path, "w") as f:
-        f.create_dataset("expt_name", data=expt_name)
-        f.create_dataset("expt_folder", data=expt_folder)
-        f.create_dataset("node_names", data=encode_hdf5_strings(node_names))
-
-        f.create_dataset("sample_at_frame", data=sample_at_frame, compression=1)
-        f.create_dataset("frame_at_sample", data=frame_at_sample, compression=1)
-
-        if not skip_audio:
-            f.create_dataset("pslow_lims", data=pslow_lims, compression=1)
-            f.create_dataset("pfast_lims", data=pfast_lims, compression=1)
-            f.create_dataset("sine_lims", data=sine_lims, compression=1)
-            f.create_dataset("pulse_bouts", data=pulse_bouts, compression=1)
-            f.create_dataset("sine_bouts", data=sine_bouts, compression=1)
-            f.create_dataset("mix_bouts", data=mix_bouts, compression=1)
+    # Save to a temporary file first so that a failed run never leaves a partial file.
+    tmp_path = output_path + ".tmp"
+
+    # Read the inputs of all stages in parallel. The thread pool is always shut down and
+    # the temporary file removed, so failed experiments leak neither (e.g., in worker.py).
+    executor = None
+    try:
+        prefetch = dict()
+        if n_threads is not None:
+            executor = concurrent.futures.ThreadPoolExecutor(n_threads)
+            if "sync" in stale:
+                prefetch["sync"] = executor.submit(get_expt_sync, expt_folder)
+            if "tracking" in stale and chunk_frames is None:
+                prefetch["tracks"] = executor.submit(load_tracks, expt_folder, dtype=dtype)
+            if "song" in stale and "song" in manifest:
+                prefetch["song"] = executor.submit(load_song_intervals, expt_folder)
+
+        # Load synchronization.
+        if "sync" in stale:
+            with profiler.stage("sync"):
+                if "sync" in prefetch:
+                    sample_at_frame, frame_at_sample = prefetch["sync"].result()
+                else:
+                    sample_at_frame, frame_at_sample = get_expt_sync(expt_folder)
+            stage_data["sync"] = {"sample_at_frame": sample_at_frame}
+        else:
+            frame_at_sample = load_frame_at_sample(output_path)
+            sample_at_frame = frame_at_sample.sample_at_frame
+
+        # Load tracking and compute features. The sine filter also needs the male wing angles.
+        song_features = ["wingML", "wingMR"] if "song" in stale and "song" in manifest else []
+        if "tracking" in stale and chunk_frames is not None:
+            # Features are written to the output file block by block.
+            with h5py.File(tmp_path, "w") as f:
+                n_frames, song_data = compute_tracking_stage_chunked(
+                    expt_folder, f, ctr_ind=ctr_ind, fwd_ind=fwd_ind, features=features, return_features=song_features,
+                    chunk_frames=chunk_frames, storage=storage, profiler=profiler, dtype=dtype
+                )
+            stage_data["tracking"] = dict()
+            written["tracking"] = ["node_names"] + list(features)
+        elif "tracking" in stale:
+            extra_features = [x for x in song_features if x not in features]
+            data, n_frames = compute_tracking_stage(
+                expt_folder, ctr_ind=ctr_ind, fwd_ind=fwd_ind, features=list(features) + extra_features, profiler=profiler,
+                tracks=prefetch.get("tracks"), executor=executor, dtype=dtype
+            )
+            song_data = {x: data.pop(x) if x in extra_features else data[x] for x in song_features}
+            stage_data["tracking"] = data
+        else:
+            with h5py.File(output_path, "r") as f:
+                n_frames = get_n_frames(f)
+                song_data = {x: f[x][:] for x in song_features if x in f}
+            if len(song_data) < len(song_features) and chunk_frames is not None:
+                n_frames, song_data = compute_tracking_stage_chunked(
+                    expt_folder, None, ctr_ind=ctr_ind, fwd_ind=fwd_ind, features=[], return_features=song_features,
+                    chunk_frames=chunk_frames, profiler=profiler, dtype=dtype
+                )
+            elif len(song_data) < len(song_features):
+                song_data, n_frames = compute_tracking_stage(expt_folder, ctr_ind=ctr_ind, fwd_ind=fwd_ind, features=song_features, profiler=profiler, dtype=dtype)
+        if len(song_features) > 0:
+            wingML, wingMR = song_data["wingML"], song_data["wingMR"]
+
+        # Write the sync and tracking outputs in the background while song is computed.
+        writer, f_writer, writes = None, None, []
+        if executor is not None:
+            writer = concurrent.futures.ThreadPoolExecutor(1)
+            f_writer = h5py.File(tmp_path, "a" if len(written) > 0 else "w")
+            for stage in list(stage_data):
+                writes += [writer.submit(write_dataset, f_writer, k, v, n_frames=n_frames, storage=storage) for k, v in stage_data[stage].items()]
+                written[stage] = written.get(stage, []) + list(stage_data[stage])
+                stage_data[stage] = dict()
 
-        if with_audio:
-            f.create_dataset("audio", data=audio, compression=1)
-
-        f.create_dataset("trxF", data=trxF, compression=1)
-        f.create_dataset("trxM", data=trxM, compression=1)
-        f.create_dataset("egoF", data=egoF, compression=1)
-        f.create_dataset("egoM", data=egoM, compression=1)
-        f.create_dataset("egoFrM", data=egoFrM, compression=1)
-        f.create_dataset("egoMrF", data=egoMrF, compression=1)
-        f.create_dataset("wingFL", data=wingFL, compression=1)
-        f.create_dataset("wingFR", data=wingFR, compression=1)
-        f.create_dataset("wingML", data=wingML, compression=1)
-        f.create_dataset("wingMR", data=wingMR, compression=1)
-        f.create_dataset("arcThetaL", data=arcThetaL, compression=1)
-        f.create_dataset("arcThetaR", data=arcThetaR, compression=1)
-
-        for k, v in feats.items():
-            f.create_dataset(k, data=v, compression=1)
+        try:
+            # Load song.
+            if "song" in stale and "song" in manifest:
+                song_data = compute_song_stage(
+                    expt_folder, sample_at_frame, frame_at_sample, n_frames, wingML, wingMR,
+                    with_audio=with_audio, min_sine_wing_ang=min_sine_wing_ang, profiler=profiler, song=prefetch.get("song")
+                )
+                if writer is not None:
+                    writes += [writer.submit(write_dataset, f_writer, k, v, n_frames=n_frames, storage=storage) for k, v in song_data.items()]
+                    written["song"] = list(song_data)
+                    song_data = dict()
+                stage_data["song"] = song_data
+        finally:
+            if writer is not None:
+                with profiler.stage("write"):
+                    writer.shutdown()
+                    f_writer.close()
+                for future in writes:
+                    future.result()
+
+        # Record the datasets produced by each stage.
+        for stage, data in stage_data.items():
+            manifest[stage]["datasets"] = written.get(stage, []) + list(data)
+        for stage in keep:
+            manifest[stage] = dict(old_manifest[stage], inputs=manifest[stage]["inputs"]) if stage in manifest else old_manifest[stage]
+        manifest = {k: v for k, v in manifest.items() if k in stage_data or k in keep}
+
+        logger.info("saving to output file")
+        with profiler.stage("write"), h5py.File(tmp_path, "a" if len(written) > 0 else "w") as f:
+            f.create_dataset("expt_name", data=expt_name)
+            f.create_dataset("expt_folder", data=expt_folder)
+            f.attrs["n_frames"] = n_frames
+
+            # Copy outputs of stages that are up to date.
+            if len(keep) > 0:
+                with h5py.File(output_path, "r") as f_old:
+                    for stage in keep:
+                        for name in old_manifest[stage]["datasets"]:
+                            f_old.copy(f_old[name], f, name=name)
+
+            for data in stage_data.values():
+                for k, v in data.items():
+                    write_dataset(f, k, v, n_frames=n_frames, storage=storage)
+
+            # The frame at each sample is fully determined by the sample at each frame, so
+            # only the latter is stored. Use load_frame_at_sample to read it back.
+            f["sample_at_frame"].attrs["n_samples"] = len(frame_at_sample)
+
+            grp = f.create_group("manifest")
+            for stage, entry in manifest.items():
+                grp.attrs[stage] = json.dumps(entry)
+
+        # The write stage is only complete once the file is closed, so the profile is added
+        # afterwards.
+        with h5py.File(tmp_path, "a") as f:
+            profiler.save(f)
+        os.replace(tmp_path, output_path)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    add_to_store(store_path, output_path, replace=True)
+    if profile_path is not None:
+        profiler.append_json(profile_path, expt_name=expt_name, expt_folder=expt_folder, output_path=output_path, recomputed=sorted(stage_data))
     
-    print("done")
+    logger.info(f"done ({profiler.summary()})")
     return output_path
 
-def main(expt_folder):
+def add_to_store(store_path, expt_path, replace=False):
+    """Append an experiment dataset to a consolidated feature store.
+
+    Args:
+        store_path: Path to the store file. If None, nothing is done.
+        expt_path: Path to the experiment dataset.
+        replace: If True, replace the experiment if it is already in the store.
+    """
+    if store_path is None:
+        return
+    from store import FeatureStore
+    FeatureStore(store_path).append(expt_path, replace=replace)
+
+def main(expt_folder, **kwargs):
     
     #save output file in experiment folders (can also specify different path if you want)
     if not expt_folder.endswith('.h5'):
@@ -725,15 +2938,159 @@ def main(expt_folder):
     # set this to true if you want to include the raw audio in the features h5 file
     withAudio = False
 
-    make_expt_dataset(expt_folder, output_path=output_path, with_audio=withAudio, skip_audio=True)
+    return make_expt_dataset(expt_folder, output_path=output_path, with_audio=withAudio, skip_audio=True, **kwargs)
+
+def find_expt_folders(root):
+    """Find all experiment folders under a root data directory.
+
+    Args:
+        root: Path to the data directory.
+
+    Returns:
+        A sorted list of paths to folders containing a video (*.mp4), ignoring
+        hidden files and folders.
+    """
+    expt_folders = []
+    for folder, subfolders, files in os.walk(root):
+        subfolders[:] = [x for x in subfolders if not x.startswith(".")]
+        if any(x.endswith(".mp4") and not x.startswith(".") for x in files):
+            expt_folders.append(folder)
+    return sorted(expt_folders)
+
+def estimate_expt_memory(expt_folder, frame_bytes=5000, sample_bytes=32):
+    """Estimate the peak memory needed to process an experiment.
+
+    This only reads the shapes of the tracks and sync datasets, not the data.
+
+    Args:
+        expt_folder: Path to experiment folder.
+        frame_bytes: Approximate bytes of memory used per video frame across all
+            pose features. Defaults to 5000.
+        sample_bytes: Approximate bytes of memory used per DAQ sample when loading
+            song. Defaults to 32.
+
+    Returns:
+        The estimated number of bytes, or 0 if the inputs could not be read.
+    """
+    n_frames, n_samples = 0, 0
+    try:
+        with h5py.File(find_track_file(expt_folder), "r") as f:
+            n_frames = f["tracks"].shape[-1]
+        with h5py.File(os.path.join(expt_folder, "daq.h5"), "r") as f:
+            n_samples = (f["sync"] if "sync" in f else f["Sync"]).shape[0]
+    except (OSError, KeyError):
+        pass
+    return n_frames * frame_bytes + n_samples * sample_bytes
+
+def get_available_memory():
+    """Returns the number of bytes of memory available to this job.
+
+    Uses the SLURM allocation if running in a SLURM job, otherwise the available
+    physical memory.
+    """
+    if "SLURM_MEM_PER_NODE" in os.environ:
+        return int(os.environ["SLURM_MEM_PER_NODE"]) * 1024 ** 2
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+
+def process_batch(expt_folders, n_workers=None, max_memory=None, **kwargs):
+    """Create datasets for many experiments in parallel using a process pool.
+
+    Experiments are started as long as there is a free worker and the sum of the
+    estimated memory of the running experiments fits within max_memory. A single
+    experiment is always allowed to run even if its estimate exceeds the budget.
+
+    Args:
+        expt_folders: List of paths to experiment folders.
+        n_workers: Maximum number of experiments to process at once. Defaults to the
+            number of CPUs available to this process.
+        max_memory: Memory budget in bytes shared by the running experiments. Defaults
+            to the memory returned by get_available_memory.
+        **kwargs: Additional keyword arguments passed to make_expt_dataset for each
+            experiment (e.g., features, store_path, storage, profile_path).
+
+    Returns:
+        A dictionary mapping each experiment folder to a tuple of (success, result)
+        where result is the output path if successful or the error message otherwise.
+    """
+    if n_workers is None:
+        n_workers = len(os.sched_getaffinity(0))
+    if max_memory is None:
+        max_memory = get_available_memory()
+
+    # Start with the largest experiments so that small ones fill in around them.
+    pending = [(estimate_expt_memory(x), x) for x in expt_folders]
+    pending = sorted(pending, key=lambda x: x[0], reverse=True)
+    logger.info(f"Processing {len(pending)} experiments with {n_workers} workers and {max_memory / 1024 ** 3:.1f} GB")
+
+    results = dict()
+    running = dict()
+    used_memory = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as pool:
+        while len(pending) > 0 or len(running) > 0:
+
+            # Submit jobs that fit in the worker and memory budget.
+            while len(pending) > 0 and len(running) < n_workers:
+                i = next((i for i, (mem, _) in enumerate(pending) if used_memory + mem <= max_memory), None)
+                if i is None and len(running) == 0:
+                    i = 0
+                if i is None:
+                    break
+                mem, expt_folder = pending.pop(i)
+                running[pool.submit(main, expt_folder, **kwargs)] = (expt_folder, mem)
+                used_memory += mem
+
+            # Collect finished jobs.
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                expt_folder, mem = running.pop(future)
+                used_memory -= mem
+                try:
+                    results[expt_folder] = (True, future.result())
+                    logger.info(f"OK: {expt_folder}")
+                except Exception as e:
+                    results[expt_folder] = (False, f"{type(e).__name__}: {e}")
+                    logger.error(f"FAILED: {expt_folder} ({type(e).__name__}: {e})")
+
+    n_failed = sum(not ok for ok, _ in results.values())
+    logger.info(f"Finished {len(results)} experiments ({n_failed} failed)")
+    return results
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
     parser.add_argument('-e', '--expt_folder', type=str, help='path to experiment folder')
+    parser.add_argument('-r', '--root', type=str, help='path to data directory; processes all experiment folders in it')
+    parser.add_argument('-l', '--expt_list', type=str, help='text file with one experiment folder per line')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='number of experiments to process in parallel (batch mode)')
+    parser.add_argument('--max_memory', type=float, default=None, help='memory budget in GB for all workers (batch mode)')
+    parser.add_argument('-f', '--features', type=str, nargs='+', default=None, help='names of tracking features to save (default: all)')
+    parser.add_argument('-s', '--store', type=str, default=None, help='path to a consolidated feature store to append the datasets to')
+    parser.add_argument('--storage', type=str, default="default", choices=list(STORAGE_PROFILES), help='storage profile of the datasets (default: default)')
+    parser.add_argument('--profile_log', type=str, default=None, help='file to append the stage profile of each experiment to as JSON lines')
+    parser.add_argument('--trace_memory', action='store_true', help='record the peak memory of each stage with tracemalloc')
+    parser.add_argument('--chunk_frames', type=int, default=None, help='compute tracking features in blocks of this many frames to limit memory')
+    parser.add_argument('--threads', type=int, default=None, help='read inputs, compute features and write outputs concurrently on this many threads per experiment')
+    parser.add_argument('--precision', type=str, default="float64", choices=["float64", "float32"], help='floating point precision of the tracking features')
+    parser.add_argument('--log_level', type=str, default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"], help='logging level (default: INFO)')
     
     args = parser.parse_args()
-    expt_folder = args.expt_folder
 
-    main(expt_folder)
\ No newline at end of file
+    logging.basicConfig(level=args.log_level, format="%(asctime)s %(levelname)s %(processName)s: %(message)s")
+    kwargs = dict(features=args.features, store_path=args.store, storage=args.storage, profile_path=args.profile_log, trace_memory=args.trace_memory, chunk_frames=args.chunk_frames, n_threads=args.threads, precision=args.precision)
+
+    if args.expt_folder is not None:
+        main(args.expt_folder, **kwargs)
+    else:
+        if args.root is not None:
+            expt_folders = find_expt_folders(args.root)
+        elif args.expt_list is not None:
+            with open(args.expt_list, "r") as f:
+                expt_folders = [line.split()[0] for line in f if line.strip()]
+        else:
+            parser.error("one of --expt_folder, --root or --expt_list is required")
+
+        max_memory = None if args.max_memory is None else args.max_memory * 1024 ** 3
+        results = process_batch(expt_folders, n_workers=args.workers, max_memory=max_memory, **kwargs)
+        if not all(ok for ok, _ in results.values()):
+            raise SystemExit(1)
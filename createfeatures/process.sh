@@ -1,6 +1,8 @@
 #!/bin/bash
 
-# Usage: bash process_jobscript.sh
+# Usage: bash process.sh /path/to/dataDirectory/ [N_WORKERS]
+# If N_WORKERS is given, that many workers process the experiments from a shared queue
+# (process_worker_jobscript.sh) instead of submitting one array task per experiment.
 
 JOB_SCRIPT="process_jobscript.sh"
 
@@ -9,12 +11,14 @@ mkdir -p "$SAVE_FOLDER"
 
 # Paths to all video files (ignoring hidden dot files)
 EXP_FOLDER=$1
+N_WORKERS=$2
 readarray VIDEO_PATHS < <(find $EXP_FOLDER -not -path '*/\.*' -name "*.mp4")
 
 echo "${VIDEO_PATHS[@]}"
 
 ARRAY_ARGS_FILE="$SAVE_FOLDER/process_array_args.txt"
 rm -f "$ARRAY_ARGS_FILE"
+rm -rf "$ARRAY_ARGS_FILE.markers"
 
 NUM_ARRAY_JOBS=0
 
@@ -22,9 +26,14 @@ NUM_ARRAY_JOBS=0
 for VIDEO_PATH in "${VIDEO_PATHS[@]}"
 do
     EXPT_FOLDER="$(dirname $VIDEO_PATH)"
-    TEST_PATH="$(dirname $VIDEO_PATH)/$(dirname $VIDEO_PATH).h5"
-
-    if [ -f "$TEST_PATH" ]; then
+    TEST_PATH="$EXPT_FOLDER/$(basename $EXPT_FOLDER).h5"
+
+    # skip if no input file (daq.h5, tracking .h5 or song .mat) was modified since the
+    # output was made. Otherwise features.py hashes the modified inputs and recomputes
+    # only the stages whose contents changed. If none did (e.g., the files were touched
+    # or copied), it only records the new modification times in the output, so the
+    # experiment is skipped here next time.
+    if [ -f "$TEST_PATH" ] && [ -z "$(find "$EXPT_FOLDER" -maxdepth 1 -type f \( -name "daq.h5" -o -name "*tracking.h5" -o -name "*.mat" \) -newer "$TEST_PATH")" ]; then
             echo "Exists: $TEST_PATH"
             continue
     fi
@@ -37,4 +46,11 @@ do
 done
 
 echo "Jobs: $NUM_ARRAY_JOBS"
-sbatch -a 1-"$NUM_ARRAY_JOBS" "$JOB_SCRIPT" "$ARRAY_ARGS_FILE"
\ No newline at end of file
+if [ -n "$N_WORKERS" ]; then
+    # the args file is used as the queue (only the first word of each line is read)
+    N_WORKERS=$(( N_WORKERS < NUM_ARRAY_JOBS ? N_WORKERS : NUM_ARRAY_JOBS ))
+    echo "Workers: $N_WORKERS"
+    sbatch -a 1-"$N_WORKERS" process_worker_jobscript.sh "$ARRAY_ARGS_FILE"
+else
+    sbatch -a 1-"$NUM_ARRAY_JOBS" "$JOB_SCRIPT" "$ARRAY_ARGS_FILE"
+fi
\ No newline at end of file
@@ -0,0 +1,21 @@
+#!/bin/bash
+#SBATCH --time=12:00:00
+#SBATCH --mem=64000
+#SBATCH --cpus-per-task=8
+#SBATCH --output='logs/ftrs_batch.%j.log'
+##SBATCH -N 1
+##SBATCH --ntasks-per-socket=1
+##SBATCH --ntasks-per-node=1
+
+# Usage: sbatch process_batch_jobscript.sh /path/to/dataDirectory/
+# Processes every experiment folder in the data directory in a single job.
+# The number of parallel experiments is set by --cpus-per-task and is further
+# limited by --mem (estimated per experiment).
+
+EXP_FOLDER=$1
+
+# you may also consider creating a separate environment specifically for creating features
+module load anaconda
+conda activate sleap
+
+python features.py -r "$EXP_FOLDER" -j "$SLURM_CPUS_PER_TASK"
@@ -0,0 +1,20 @@
+#!/bin/bash
+#SBATCH --time=12:00:00
+#SBATCH --mem=64000
+#SBATCH --cpus-per-task=8
+#SBATCH --output='logs/ftrs_worker.%A.%a.log'
+##SBATCH -N 1
+##SBATCH --ntasks-per-socket=1
+##SBATCH --ntasks-per-node=1
+
+# Usage: sbatch -a 1-N_WORKERS process_worker_jobscript.sh /path/to/queue.txt
+# Each array task is a worker that processes experiments from the shared queue file
+# (one experiment folder per line) until it is empty. See worker.py.
+
+queue_file="$1"
+
+# you may also consider creating a separate environment specifically for creating features
+module load anaconda
+conda activate sleap
+
+python worker.py run "$queue_file" --threads "$SLURM_CPUS_PER_TASK"
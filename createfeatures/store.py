@@ -0,0 +1,309 @@
+import os
+import fcntl
+import logging
+import argparse
+import h5py
+import numpy as np
+
+import features
+
+
+logger = logging.getLogger("store")
+
+# Columns of the experiment index table.
+EXPERIMENT_DTYPE = np.dtype([
+    ("name", h5py.string_dtype()),
+    ("folder", h5py.string_dtype()),
+    ("frame_offset", "int64"),
+    ("n_frames", "int64"),
+    ("event_offset", "int64"),
+    ("n_events", "int64"),
+    ("n_pfast", "int64"),
+    ("n_pslow", "int64"),
+    ("n_sine", "int64"),
+    ("valid", "bool"),
+])
+
+def get_expt_dataset_path(path):
+    """Returns the path to the experiment dataset given a dataset or experiment folder."""
+    if path.endswith(".h5"):
+        return path
+    return os.path.join(path, f"{os.path.basename(os.path.normpath(path))}.h5")
+
+def find_store_features(f):
+    """Find the time-aligned features of an experiment dataset.
+
+    Args:
+        f: The open h5py.File of the experiment dataset.
+
+    Returns:
+        A list of names of datasets with one row per frame.
+    """
+    manifest = features.read_manifest(f.filename)
+    if manifest is not None:
+        names = [x for stage in ["sync", "tracking"] if stage in manifest for x in manifest[stage]["datasets"]]
+    else:
+        names = ["sample_at_frame"] + [x for x in features.TRACKING_FEATURES if x in f]
+    names += [x for x in features.SONG_FRAME_FEATURES if x in f]
+    n_frames = features.get_n_frames(f)
+    return [x for x in names if x in f and x != "node_names" and f[x].shape[:1] == (n_frames,)]
+
+class FeatureStore:
+    """Consolidated store of features from many experiments.
+
+    Each feature is saved as a single chunked dataset under "features/" with the frames
+    of all experiments concatenated along time. The "experiments" table indexes the
+    frame range and song events of each experiment, and song events of all experiments
+    are concatenated under "events/" with frames relative to the start of the store.
+
+    Appends are serialized with a lock file so that several workers can write to the
+    same store. Experiments are appended with their index row written last, so a failed
+    append is discarded the next time the store is written to.
+
+    Args:
+        path: Path to the store file. It is created on the first append.
+        chunk_frames: Number of frames per chunk of the feature datasets.
+        compression: Compression of the feature datasets passed to h5py.
+    """
+    def __init__(self, path, chunk_frames=2**16, compression=1):
+        self.path = path
+        self.chunk_frames = chunk_frames
+        self.compression = compression
+
+    def __len__(self):
+        return len(self.experiments())
+
+    def experiments(self):
+        """Returns the index table of the valid experiments in the store."""
+        if not os.path.exists(self.path):
+            return np.zeros((0,), dtype=EXPERIMENT_DTYPE)
+        with h5py.File(self.path, "r") as f:
+            table = f["experiments"][:]
+        return table[table["valid"]]
+
+    def feature_names(self):
+        """Returns the names of the features in the store."""
+        with h5py.File(self.path, "r") as f:
+            return list(f["features"])
+
+    def read(self, name, expt_names=None):
+        """Read a feature for many experiments.
+
+        Args:
+            name: Name of the feature (e.g., "mFV").
+            expt_names: Optional list of experiment names to read. If None, all
+                experiments are read.
+
+        Returns:
+            The concatenated feature of the selected experiments in the order of the
+            index table. Use the index table to find the rows of each experiment.
+        """
+        with h5py.File(self.path, "r") as f:
+            table = f["experiments"][:]
+            ds = f["features"][name]
+            if expt_names is None and table["valid"].all():
+                return ds[:]
+            rows = table[table["valid"]]
+            if expt_names is not None:
+                rows = rows[np.isin(decode_strings(rows["name"]), list(expt_names))]
+            return np.concatenate([ds[x["frame_offset"]:x["frame_offset"] + x["n_frames"]] for x in rows] + [ds[:0]], axis=0)
+
+    def load_experiment(self, expt_name, names=None):
+        """Read the features of a single experiment.
+
+        Args:
+            expt_name: Name of the experiment.
+            names: Optional list of features to read. Defaults to all features.
+
+        Returns:
+            A dictionary mapping feature names to arrays.
+        """
+        table = self.experiments()
+        row = table[decode_strings(table["name"]) == expt_name]
+        if len(row) == 0:
+            raise KeyError(f"Experiment not found in store: {expt_name}")
+        f0, n = row[-1]["frame_offset"], row[-1]["n_frames"]
+        with h5py.File(self.path, "r") as f:
+            if names is None:
+                names = list(f["features"])
+            return {x: f["features"][x][f0:f0 + n] for x in names}
+
+    def load_events(self):
+        """Returns a tuple of (event_frames, event_types, event_expt) of valid experiments.
+
+        event_frames are relative to the start of the store. event_expt is the row of
+        each event's experiment in the table returned by experiments().
+        """
+        with h5py.File(self.path, "r") as f:
+            table = f["experiments"][:]
+            event_frames, event_types = f["events/frames"][:], f["events/types"][:]
+        rows = np.flatnonzero(table["valid"])
+        inds = [np.arange(table[i]["event_offset"], table[i]["event_offset"] + table[i]["n_events"]) for i in rows]
+        event_expt = np.concatenate([np.full(len(x), j) for j, x in enumerate(inds)] + [np.zeros(0, int)])
+        inds = np.concatenate(inds + [np.zeros(0, int)])
+        return event_frames[inds], event_types[inds], event_expt
+
+    def append(self, expt_path, names=None, replace=False):
+        """Append an experiment dataset to the store.
+
+        Args:
+            expt_path: Path to the experiment dataset or experiment folder.
+            names: Optional list of features to append. Defaults to all time-aligned
+                datasets of the experiment. Datasets that are not time-aligned are
+                skipped.
+            replace: If True, an experiment already in the store is replaced by
+                invalidating its rows and appending it again. If False, experiments
+                already in the store are skipped.
+
+        Returns:
+            True if the experiment was appended.
+
+        Raises:
+            ValueError: If a feature has a different shape per frame than in the store.
+        """
+        expt_path = get_expt_dataset_path(expt_path)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with h5py.File(expt_path, "r") as src, h5py.File(self.path, "a") as f:
+                self.initialize(f, src)
+                expt_name = src["expt_name"][()] if "expt_name" in src else os.path.basename(expt_path)[:-3]
+                expt_name = expt_name.decode() if isinstance(expt_name, bytes) else str(expt_name)
+                expt_folder = src["expt_folder"][()] if "expt_folder" in src else os.path.dirname(expt_path)
+                expt_folder = expt_folder.decode() if isinstance(expt_folder, bytes) else str(expt_folder)
+
+                table = f["experiments"]
+                rows = table[:]
+                existing = np.flatnonzero(rows["valid"] & (decode_strings(rows["name"]) == expt_name))
+                if len(existing) > 0 and not replace:
+                    logger.info(f"already in store: {expt_name}")
+                    return False
+
+                # Only time-aligned features with the same shape as the store can be appended.
+                n_frames = features.get_n_frames(src)
+                if names is None:
+                    names = find_store_features(src)
+                skipped = [x for x in names if x not in src or src[x].shape[:1] != (n_frames,)]
+                if len(skipped) > 0:
+                    logger.warning(f"skipping features that are not time-aligned in {expt_name}: {skipped}")
+                names = [x for x in names if x not in skipped]
+                for name in names:
+                    if name in f["features"] and f["features"][name].shape[1:] != src[name].shape[1:]:
+                        raise ValueError(f"Shape of {name} in {expt_name} {src[name].shape[1:]} does not match the store {f['features'][name].shape[1:]}")
+
+                # Discard data of a failed append.
+                frame_offset = int((rows["frame_offset"] + rows["n_frames"]).max(initial=0))
+                event_offset = int((rows["event_offset"] + rows["n_events"]).max(initial=0))
+                for ds in f["features"].values():
+                    ds.resize(frame_offset, axis=0)
+                f["events/frames"].resize(event_offset, axis=0)
+                f["events/types"].resize(event_offset, axis=0)
+
+                # Append features. Features missing from either side are filled with NaN.
+                for name in names:
+                    if name not in f["features"]:
+                        self.create_feature(f, name, src[name], frame_offset)
+                for name, ds in f["features"].items():
+                    if name in names:
+                        x = src[name][:]
+                    else:
+                        x = np.full((n_frames,) + ds.shape[1:], ds.fillvalue, dtype=ds.dtype)
+                    ds.resize(frame_offset + n_frames, axis=0)
+                    ds[frame_offset:] = x
+
+                # Append song events.
+                n_events = 0
+                song_counts = [0] * len(features.SONG_EVENT_TYPES)
+                if all(f"{x}_lims" in src for x in features.SONG_EVENT_TYPES):
+                    index = features.load_event_index(expt_path)
+                    n_events = len(index)
+                    song_counts = [int((index.event_types == i).sum()) for i in range(len(features.SONG_EVENT_TYPES))]
+                    f["events/frames"].resize(event_offset + n_events, axis=0)
+                    f["events/frames"][event_offset:] = index.event_frames + frame_offset
+                    f["events/types"].resize(event_offset + n_events, axis=0)
+                    f["events/types"][event_offset:] = index.event_types
+
+                # Write the index row last.
+                row = np.array([(expt_name, expt_folder, frame_offset, n_frames, event_offset, n_events, *song_counts, True)], dtype=EXPERIMENT_DTYPE)
+                for i in existing:
+                    old = table[i]
+                    old["valid"] = False
+                    table[i] = old
+                table.resize(len(rows) + 1, axis=0)
+                table[len(rows)] = row[0]
+        logger.info(f"added to store: {expt_name} ({n_frames} frames, {n_events} song events)")
+        return True
+
+    def initialize(self, f, src):
+        """Create the groups and index table of a new store."""
+        if "experiments" in f:
+            return
+        f.create_dataset("experiments", shape=(0,), maxshape=(None,), dtype=EXPERIMENT_DTYPE, chunks=(1024,))
+        f.create_group("features")
+        f.create_dataset("events/frames", shape=(0, 2), maxshape=(None, 2), dtype="int64", chunks=(4096, 2), compression=self.compression)
+        f.create_dataset("events/types", shape=(0,), maxshape=(None,), dtype="int8", chunks=(4096,), compression=self.compression)
+        f["events"].attrs["types"] = features.encode_hdf5_strings(features.SONG_EVENT_TYPES)
+        if "node_names" in src:
+            f.attrs["node_names"] = src["node_names"][:]
+
+    def create_feature(self, f, name, src_ds, n_frames):
+        """Create a resizable feature dataset with n_frames rows of NaN for earlier experiments."""
+        return f["features"].create_dataset(
+            name, shape=(n_frames,) + src_ds.shape[1:], maxshape=(None,) + src_ds.shape[1:],
+            dtype=src_ds.dtype, chunks=(self.chunk_frames,) + src_ds.shape[1:],
+            compression=self.compression, fillvalue=np.nan if src_ds.dtype.kind == "f" else 0,
+        )
+
+def decode_strings(x):
+    """Decode an array of bytes or str into an array of str."""
+    return np.array([s.decode() if isinstance(s, bytes) else s for s in x], dtype=object)
+
+def ingest(store_path, expt_paths, names=None, replace=False):
+    """Append many experiment datasets to a store.
+
+    Args:
+        store_path: Path to the store file.
+        expt_paths: List of paths to experiment datasets or experiment folders.
+        names: Optional list of features to append. Defaults to all.
+        replace: If True, replace experiments already in the store.
+
+    Returns:
+        Number of experiments appended.
+    """
+    store = FeatureStore(store_path)
+    n = 0
+    for expt_path in expt_paths:
+        if not os.path.exists(get_expt_dataset_path(expt_path)):
+            logger.warning(f"no dataset found: {expt_path}")
+            continue
+        n += store.append(expt_path, names=names, replace=replace)
+    logger.info(f"Ingested {n} experiments into {store_path} ({len(store)} total)")
+    return n
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('store_path', type=str, help='path to the consolidated store file')
+    parser.add_argument('-e', '--expt', type=str, nargs='+', default=[], help='experiment datasets or folders to ingest')
+    parser.add_argument('-r', '--root', type=str, help='path to data directory; ingests all experiment folders in it')
+    parser.add_argument('-l', '--expt_list', type=str, help='text file with one experiment folder per line')
+    parser.add_argument('-f', '--features', type=str, nargs='+', default=None, help='names of features to ingest (default: all)')
+    parser.add_argument('--replace', action='store_true', help='replace experiments already in the store')
+
+    parser.add_argument('--log_level', type=str, default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"], help='logging level (default: INFO)')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level, format="%(asctime)s %(levelname)s %(processName)s: %(message)s")
+
+    expt_paths = list(args.expt)
+    if args.root is not None:
+        expt_paths += features.find_expt_folders(args.root)
+    if args.expt_list is not None:
+        with open(args.expt_list, "r") as f:
+            expt_paths += [line.split()[0] for line in f if line.strip()]
+    if len(expt_paths) == 0:
+        parser.error("one of --expt, --root or --expt_list is required")
+
+    ingest(args.store_path, expt_paths, names=args.features, replace=args.replace)
@@ -0,0 +1,269 @@
+import os
+import argparse
+import h5py
+import numpy as np
+import scipy.io
+
+
+# Skeleton of the exported SLEAP tracks with the position of each node in body
+# coordinates (pixels, forward is +x, y points down as in image coordinates so the
+# left side is -y).
+SYNTHETIC_SKELETON = {
+    "head": (30, 0),
+    "thorax": (0, 0),
+    "abdomen": (-35, 0),
+    "wingL": (-30, -10),
+    "wingR": (-30, 10),
+    "forelegL4": (30, -22),
+    "forelegR4": (30, 22),
+    "midlegL4": (0, -28),
+    "midlegR4": (0, 28),
+    "hindlegL4": (-25, -24),
+    "hindlegR4": (-25, 24),
+    "eyeL": (24, -6),
+    "eyeR": (24, 6),
+}
+
+def make_song_intervals(n_samples, fs=10000, bouts_per_min=4, seed=0):
+    """Generate song bouts and the runs of pulse and sine song within them.
+
+    Args:
+        n_samples: Number of samples in the recording.
+        fs: Audio sample rate in Hz.
+        bouts_per_min: Average number of song bouts per minute.
+        seed: Random seed.
+
+    Returns:
+        A dictionary with the (n, 2) arrays of start and end (exclusive) sample indices
+        of the "pslow", "pfast" and "sine" runs, and the "bout_lims" and "bout_types"
+        of the bouts as in the bInf struct.
+    """
+    rng = np.random.default_rng(seed)
+    n_bouts = rng.poisson(bouts_per_min * n_samples / fs / 60)
+    bout_starts = np.sort(rng.integers(0, max(n_samples - 5 * fs, 1), n_bouts))
+    bout_lens = rng.integers(fs // 2, 4 * fs, n_bouts)
+    bout_types = rng.choice(["Pul", "Sin", "Mix"], n_bouts, p=[0.5, 0.2, 0.3])
+
+    runs = {"pslow": [], "pfast": [], "sine": []}
+    for s0, n, bout_type in zip(bout_starts, bout_lens, bout_types):
+        t = s0
+        while t < s0 + n:
+            if bout_type == "Sin" or (bout_type == "Mix" and rng.random() < 0.4):
+                kind, run_len = "sine", rng.integers(fs // 10, fs // 2)
+            else:
+                kind, run_len = ("pfast", "pslow")[rng.integers(2)], rng.integers(20, 80)
+            runs[kind].append((t, min(t + run_len, s0 + n)))
+            t += run_len + rng.integers(fs // 50, fs // 20)
+
+    song = {k: np.array(v, dtype="int64").reshape(-1, 2) for k, v in runs.items()}
+    song["bout_lims"] = np.stack([bout_starts, bout_starts + bout_lens], axis=1).astype("float64")
+    song["bout_types"] = bout_types
+    return song
+
+def intervals_to_block(lims, s0, s1):
+    """Rasterize intervals into a boolean mask of the samples in [s0, s1)."""
+    mask = np.zeros(s1 - s0, dtype=bool)
+    lims = lims[(lims[:, 1] > s0) & (lims[:, 0] < s1)]
+    for a, b in np.clip(lims - s0, 0, s1 - s0):
+        mask[a:b] = True
+    return mask
+
+# Number of samples recorded before the first and after the last frame.
+LEAD_SAMPLES = 1000
+
+def write_daq(path, n_frames, fs=10000, fps=150, n_channels=9, lead_samples=LEAD_SAMPLES, seed=0, chunk_size=2**20):
+    """Write a daq.h5 with a camera exposure sync channel and multichannel audio.
+
+    Args:
+        path: Path to the daq.h5 file.
+        n_frames: Number of video frames.
+        fs: Sample rate in Hz.
+        fps: Video frame rate.
+        n_channels: Number of audio channels. If 0, no audio is written.
+        lead_samples: Number of samples before the first frame and after the last.
+        seed: Random seed.
+        chunk_size: Number of samples to generate at a time.
+
+    Returns:
+        The number of samples in the recording.
+    """
+    rng = np.random.default_rng(seed)
+    spf = fs / fps
+    pulse_len = int(spf / 3)
+    n_samples = int(np.ceil(lead_samples * 2 + n_frames * spf))
+    with h5py.File(path, "w") as f:
+        sync = f.create_dataset("sync", shape=(n_samples,), dtype="float64", chunks=(min(2**16, n_samples),), compression=1)
+        if n_channels > 0:
+            audio = f.create_dataset("audio", shape=(n_samples, n_channels), dtype="float32", chunks=(min(2**14, n_samples), n_channels))
+        for s0 in range(0, n_samples, chunk_size):
+            s1 = min(s0 + chunk_size, n_samples)
+            t = np.arange(s0, s1) - lead_samples
+            frame = np.floor(t / spf)
+            on = (t >= 0) & (frame < n_frames) & (t - frame * spf < pulse_len)
+            sync[s0:s1] = np.where(on, 3.3, 0.0) + rng.normal(0, 0.05, s1 - s0)
+            if n_channels > 0:
+                audio[s0:s1] = rng.normal(0, 0.01, (s1 - s0, n_channels)).astype("float32")
+    return n_samples
+
+# Position of the extended wing of the male in body coordinates during sine song.
+EXTENDED_WING = (-10, -35)
+
+def write_tracks(path, n_frames, fps=150, n_flies=2, gap_rate=0.002, pad_frames=30, wing_extension_lims=None, seed=0, chunk_frames=2**16):
+    """Write a SLEAP-style analysis file with smooth trajectories and NaN gaps.
+
+    Args:
+        path: Path to the tracking file.
+        n_frames: Number of tracked frames.
+        fps: Video frame rate.
+        n_flies: Number of tracked flies.
+        gap_rate: Probability per frame of a gap starting in each node of each fly.
+            Gaps last from 1 to 50 frames.
+        pad_frames: Number of untracked (all NaN) frames appended at the end as in
+            exported files.
+        wing_extension_lims: Optional (n, 2) array of start and end (exclusive) frames
+            during which the male (second fly) extends its left wing.
+        seed: Random seed.
+        chunk_frames: Number of frames to generate at a time.
+    """
+    rng = np.random.default_rng(seed)
+    node_names = list(SYNTHETIC_SKELETON)
+    offsets = np.array(list(SYNTHETIC_SKELETON.values()), dtype="float64")  # (joint, xy)
+
+    # Sums of slow sinusoids make smooth, chunk-independent trajectories.
+    freqs = rng.uniform(0.005, 0.05, (n_flies, 3, 3)) / fps * 2 * np.pi
+    phases = rng.uniform(0, 2 * np.pi, (n_flies, 3, 3))
+
+    n_total = n_frames + pad_frames
+    n_joints = len(node_names)
+    with h5py.File(path, "w") as f:
+        # Stored as (fly, xy, joint, frame) like SLEAP exports read from MATLAB.
+        ds = f.create_dataset("tracks", shape=(n_flies, 2, n_joints, n_total), dtype="float64", chunks=(n_flies, 2, n_joints, min(4096, n_total)), compression=1)
+        for f0 in range(0, n_total, chunk_frames):
+            f1 = min(f0 + chunk_frames, n_total)
+            t = np.arange(f0, f1, dtype="float64")
+            block = np.full((f1 - f0, n_joints, 2, n_flies), np.nan)
+            for fly in range(n_flies):
+                waves = np.sin(t[:, None, None] * freqs[fly] + phases[fly]).sum(axis=-1)  # (t, 3)
+                ctr = 512 + 150 * waves[:, :2]
+                heading = np.pi * waves[:, 2]
+                ca, sa = np.cos(heading), np.sin(heading)
+                x = offsets[None, :, 0] * ca[:, None] - offsets[None, :, 1] * sa[:, None]
+                y = offsets[None, :, 0] * sa[:, None] + offsets[None, :, 1] * ca[:, None]
+                block[..., fly] = np.stack([x, y], axis=-1) + ctr[:, None, :] + rng.normal(0, 0.5, (f1 - f0, n_joints, 2))
+
+                if fly == 1 and wing_extension_lims is not None:
+                    is_extended = intervals_to_block(wing_extension_lims, f0, f1)
+                    ex, ey = EXTENDED_WING
+                    wing = np.stack([ex * ca - ey * sa, ex * sa + ey * ca], axis=-1) + ctr
+                    block[is_extended, node_names.index("wingL"), :, fly] = wing[is_extended]
+
+            # Gaps of random length in each node.
+            starts = np.argwhere(rng.random((f1 - f0, n_joints, n_flies)) < gap_rate)
+            for i, joint, fly in starts:
+                block[i:i + rng.integers(1, 50), joint, :, fly] = np.nan
+            block[max(n_frames - f0, 0):] = np.nan
+            ds[..., f0:f1] = np.transpose(block)
+
+        f.create_dataset("node_names", data=[x.encode() for x in node_names])
+        f.create_dataset("track_names", data=[x.encode() for x in ["female", "male"][:n_flies]])
+
+def write_song_mat_v73(path, song, n_samples, chunk_size=2**22):
+    """Write song segmentation as a MATLAB v7.3 (HDF5) file.
+
+    The per-sample masks are written in blocks so that long recordings never need to
+    fit in memory.
+
+    Args:
+        path: Path to the .mat file.
+        song: Dictionary of song intervals and bouts (see make_song_intervals).
+        n_samples: Number of samples in the recording.
+        chunk_size: Number of samples to write at a time.
+    """
+    with h5py.File(path, "w", userblock_size=512) as f:
+        for name in ["pslow", "pfast", "sine"]:
+            # MATLAB stores column vectors transposed, i.e., (1, n).
+            ds = f.create_dataset(name, shape=(1, n_samples), dtype="uint8", chunks=(1, min(2**16, n_samples)), compression=3)
+            ds.attrs["MATLAB_class"] = np.bytes_("logical")
+            for s0 in range(0, n_samples, chunk_size):
+                s1 = min(s0 + chunk_size, n_samples)
+                ds[0, s0:s1] = intervals_to_block(song[name], s0, s1)
+
+        bInf = f.create_group("bInf")
+        bInf.attrs["MATLAB_class"] = np.bytes_("struct")
+        if len(song["bout_lims"]) == 0:
+            ds = bInf.create_dataset("stEn", data=np.zeros(2, dtype="uint64"))
+            ds.attrs["MATLAB_empty"] = np.uint8(1)
+        else:
+            bInf.create_dataset("stEn", data=song["bout_lims"].T)
+        refs = f.require_group("#refs#")
+        type_refs = []
+        for i, bout_type in enumerate(song["bout_types"]):
+            ds = refs.create_dataset(f"t{i}", data=np.array([ord(c) for c in bout_type], dtype="uint16")[:, None])
+            ds.attrs["MATLAB_class"] = np.bytes_("char")
+            type_refs.append(ds.ref)
+        ds = bInf.create_dataset("Type", data=np.array(type_refs, dtype=h5py.ref_dtype)[None, :])
+        ds.attrs["MATLAB_class"] = np.bytes_("cell")
+
+    # MATLAB header in the userblock.
+    header = b"MATLAB 7.3 MAT-file, Platform: GLNXA64, Created by: synthetic.py HDF5 schema 1.00 ."
+    with open(path, "r+b") as f:
+        f.write(header.ljust(116, b" ") + b"\x00" * 8 + b"\x00\x02IM")
+
+def write_song_mat_v5(path, song, n_samples):
+    """Write song segmentation as an older (v5) MAT file. Only for short recordings."""
+    masks = {name: intervals_to_block(song[name], 0, n_samples)[:, None].astype("float64") for name in ["pslow", "pfast", "sine"]}
+    bInf = {"stEn": song["bout_lims"].reshape(-1, 2), "Type": np.array(song["bout_types"], dtype=object).reshape(-1, 1)}
+    scipy.io.savemat(path, dict(masks, bInf=bInf))
+
+def make_synthetic_expt(expt_folder, duration=600, fs=10000, fps=150, n_channels=9, n_flies=2, gap_rate=0.002, mat_version="7.3", seed=0):
+    """Write a synthetic experiment folder that can be processed by make_expt_dataset.
+
+    Args:
+        expt_folder: Path to the experiment folder to create.
+        duration: Length of the recording in seconds.
+        fs: Audio sample rate in Hz.
+        fps: Video frame rate.
+        n_channels: Number of audio channels in daq.h5.
+        n_flies: Number of flies. The first two are the female and the male.
+        gap_rate: Probability per frame of a tracking gap starting in each node.
+        mat_version: "7.3" to write song.mat as HDF5 (as MATLAB does for large
+            files) or "5" for an older MAT file.
+        seed: Random seed.
+
+    Returns:
+        A dictionary with the ground truth "n_frames", "n_samples" and song intervals.
+    """
+    os.makedirs(expt_folder, exist_ok=True)
+    n_frames = int(duration * fps)
+    n_samples = write_daq(os.path.join(expt_folder, "daq.h5"), n_frames, fs=fs, fps=fps, n_channels=n_channels, seed=seed)
+    song = make_song_intervals(n_samples, fs=fs, seed=seed + 2)
+
+    # The male extends a wing during sine song so that sine passes the wing angle filter.
+    spf = fs / fps
+    sine_frames = np.stack([np.floor((song["sine"][:, 0] - LEAD_SAMPLES) / spf), np.ceil((song["sine"][:, 1] - LEAD_SAMPLES) / spf)], axis=1)
+    sine_frames = np.clip(sine_frames, 0, n_frames).astype("int64")
+    write_tracks(os.path.join(expt_folder, "inference.cleaned.proofread.tracking.h5"), n_frames, fps=fps, n_flies=n_flies, gap_rate=gap_rate, wing_extension_lims=sine_frames, seed=seed + 1)
+    song_path = os.path.join(expt_folder, "song.mat")
+    if mat_version == "5":
+        write_song_mat_v5(song_path, song, n_samples)
+    else:
+        write_song_mat_v73(song_path, song, n_samples)
+
+    song["n_frames"] = n_frames
+    song["n_samples"] = n_samples
+    return song
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('expt_folder', type=str, help='path to the experiment folder to create')
+    parser.add_argument('-d', '--duration', type=float, default=600, help='recording length in seconds')
+    parser.add_argument('-c', '--channels', type=int, default=9, help='number of audio channels')
+    parser.add_argument('--mat_version', type=str, default="7.3", choices=["7.3", "5"], help='format of song.mat')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+
+    args = parser.parse_args()
+
+    song = make_synthetic_expt(args.expt_folder, duration=args.duration, n_channels=args.channels, mat_version=args.mat_version, seed=args.seed)
+    print(f"Wrote {args.expt_folder} ({song['n_frames']} frames, {song['n_samples']} samples)")
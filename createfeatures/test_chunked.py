@@ -0,0 +1,61 @@
+import os
+import h5py
+import numpy as np
+import pytest
+
+import features
+import synthetic
+
+
+@pytest.fixture(scope="module")
+def gap_expt(tmp_path_factory):
+    """Synthetic experiment with joints missing for long stretches."""
+    expt_folder = str(tmp_path_factory.mktemp("chunked") / "expt")
+    synthetic.make_synthetic_expt(expt_folder, duration=60)
+    with h5py.File(features.find_track_file(expt_folder), "r+") as f:
+        tracks = f["tracks"]  # (fly, xy, joint, frame)
+        tracks[1, :, 3, 2000:] = np.nan  # Male wingL lost until the end.
+        tracks[0, :, 0, :3000] = np.nan  # Female head missing from the start.
+        tracks[1, :, 0, 4100:6900] = np.nan  # Male head gap spanning several blocks.
+    return expt_folder
+
+@pytest.mark.parametrize("chunk_frames,precision", [(1000, "float64"), (777, "float64"), (1000, "float32")])
+def test_chunked_matches_in_memory(gap_expt, tmp_path, monkeypatch, chunk_frames, precision):
+    expected_path = features.make_expt_dataset(gap_expt, output_path=str(tmp_path / "full.h5"), overwrite=True, precision=precision)
+
+    reads = []
+    read_frames = features.TrackWindowReader.read_frames
+    def record_read_frames(self, f0, f1, joints=slice(None)):
+        reads.append(f1 - f0)
+        return read_frames(self, f0, f1, joints=joints)
+    monkeypatch.setattr(features.TrackWindowReader, "read_frames", record_read_frames)
+
+    chunked_path = features.make_expt_dataset(gap_expt, output_path=str(tmp_path / "chunked.h5"), overwrite=True, precision=precision, chunk_frames=chunk_frames)
+
+    # Reads are bounded by the block size (with a halo of 2 frames on each side).
+    assert len(reads) > 0
+    assert max(reads) <= chunk_frames + 2 * 2
+
+    with h5py.File(expected_path, "r") as f_expected, h5py.File(chunked_path, "r") as f_chunked:
+        for name in features.TRACKING_FEATURES:
+            np.testing.assert_array_equal(f_chunked[name][()], f_expected[name][()], err_msg=name)
+
+def test_interpolate_missing_blocks():
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(500, 6))
+    x[rng.random(x.shape) < 0.3] = np.nan
+    x[:200, 0] = np.nan
+    x[100:, 1] = np.nan
+    x[:, 2] = np.nan
+    expected = features.interpolate_missing(x, axis=0)
+
+    # Fill a block given the valid samples before and after it.
+    f0, f1 = 150, 250
+    t = np.arange(len(x)).reshape(-1, 1)
+    valid = np.isfinite(x)
+    prev_idx = np.where(valid[:f0], t[:f0], -1).max(axis=0)
+    next_idx = np.where(valid[f1:], t[f1:], len(x)).min(axis=0)
+    cols = np.arange(x.shape[1])
+    before = (prev_idx - f0, np.where(prev_idx >= 0, x[np.maximum(prev_idx, 0), cols], np.nan))
+    after = (next_idx - f0, np.where(next_idx < len(x), x[np.minimum(next_idx, len(x) - 1), cols], np.nan))
+    np.testing.assert_array_equal(features.interpolate_missing(x[f0:f1], axis=0, before=before, after=after), expected[f0:f1])
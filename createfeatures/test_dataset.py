@@ -0,0 +1,96 @@
+import os
+import threading
+import h5py
+import numpy as np
+import pytest
+
+import features
+import synthetic
+
+
+@pytest.fixture
+def broken_expt(tmp_path):
+    """Synthetic experiment whose tracks file has no tracks dataset."""
+    expt_folder = str(tmp_path / "expt")
+    synthetic.make_synthetic_expt(expt_folder, duration=10)
+    with h5py.File(features.find_track_file(expt_folder), "r+") as f:
+        del f["tracks"]
+    return expt_folder
+
+@pytest.mark.parametrize("n_threads,chunk_frames", [(None, None), (4, None), (4, 500)])
+def test_failed_dataset_cleans_up(broken_expt, tmp_path, n_threads, chunk_frames):
+    output_path = str(tmp_path / "out.h5")
+    n_threads_before = threading.active_count()
+
+    with pytest.raises(KeyError):
+        features.make_expt_dataset(broken_expt, output_path=output_path, n_threads=n_threads, chunk_frames=chunk_frames)
+
+    assert not os.path.exists(output_path)
+    assert not os.path.exists(output_path + ".tmp")
+    assert threading.active_count() == n_threads_before
+
+@pytest.fixture
+def expt(tmp_path):
+    expt_folder = str(tmp_path / "expt")
+    synthetic.make_synthetic_expt(expt_folder, duration=10)
+    return expt_folder
+
+def fail_if_called(*args, **kwargs):
+    raise AssertionError("stage was recomputed")
+
+def test_touched_inputs_are_not_recomputed(expt, tmp_path, monkeypatch):
+    output_path = features.make_expt_dataset(expt, output_path=str(tmp_path / "out.h5"))
+    input_paths = [os.path.join(expt, "daq.h5"), features.find_track_file(expt), features.find_song_file(expt)]
+    for path in input_paths:
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime + 100, stat.st_mtime + 100))
+
+    for name in ["get_expt_sync", "load_tracks", "compute_tracking_stage", "compute_song_stage"]:
+        monkeypatch.setattr(features, name, fail_if_called)
+    features.make_expt_dataset(expt, output_path=output_path)
+
+    # The new modification times are recorded, so the inputs are not hashed again.
+    manifest = features.read_manifest(output_path)
+    assert manifest["tracking"]["inputs"]["tracks"]["mtime"] == os.stat(input_paths[1]).st_mtime
+    monkeypatch.setattr(features.hashlib, "sha1", fail_if_called)
+    features.make_expt_dataset(expt, output_path=output_path)
+
+def test_changed_inputs_are_recomputed(expt, tmp_path):
+    output_path = features.make_expt_dataset(expt, output_path=str(tmp_path / "out.h5"))
+    with h5py.File(output_path, "r") as f:
+        mfDist = f["mfDist"][:]
+
+    # Move the male in the middle of the recording.
+    with h5py.File(features.find_track_file(expt), "r+") as f:
+        f["tracks"][1, :, :, 500:600] += 50
+
+    old_manifest = features.read_manifest(output_path)
+    features.make_expt_dataset(expt, output_path=output_path)
+    manifest = features.read_manifest(output_path)
+    assert manifest["tracking"]["inputs"]["tracks"]["sha1"] != old_manifest["tracking"]["inputs"]["tracks"]["sha1"]
+    assert manifest["sync"]["inputs"] == old_manifest["sync"]["inputs"]
+    with h5py.File(output_path, "r") as f:
+        assert not np.array_equal(f["mfDist"][500:600], mfDist[500:600])
+        np.testing.assert_array_equal(f["mfDist"][:400], mfDist[:400])
+
+def test_file_fingerprint(tmp_path):
+    path = str(tmp_path / "data.bin")
+    data = np.random.default_rng(0).bytes(5 * 2**20)
+    with open(path, "wb") as f:
+        f.write(data)
+    fingerprint = features.file_fingerprint(path, block_size=2**20)
+
+    # Same contents with a new modification time.
+    os.utime(path, (0, 12345))
+    touched = features.file_fingerprint(path, previous=fingerprint)
+    assert touched["mtime"] != fingerprint["mtime"]
+    assert features.same_file_contents(fingerprint, touched)
+
+    # A change in the middle of the file with the size and modification time restored
+    # is only found when the file is hashed again.
+    with open(path, "r+b") as f:
+        f.seek(len(data) // 2)
+        f.write(bytes([data[len(data) // 2] ^ 1]))
+    os.utime(path, (0, 12345))
+    assert features.same_file_contents(touched, features.file_fingerprint(path, previous=touched))
+    assert not features.same_file_contents(touched, features.file_fingerprint(path))
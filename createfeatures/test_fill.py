@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import features
+
+
+def legacy_fill_missing(x, kind="nearest", **kwargs):
+    """Fill missing values with pandas, as fill_missing did before interpolate_missing."""
+    if x.ndim == 3:
+        return np.stack([legacy_fill_missing(xi, kind=kind, **kwargs) for xi in x], axis=0)
+    return pd.DataFrame(x).interpolate(kind=kind, axis=0, limit_direction="both", **kwargs).to_numpy()
+
+def make_gappy(shape, seed=0):
+    """Random series along axis -2 with scattered, leading, trailing and complete gaps."""
+    rng = np.random.default_rng(seed)
+    x = rng.normal(size=shape)
+    x[rng.random(shape) < 0.3] = np.nan
+    x[..., :40, 0] = np.nan  # Leading gap.
+    x[..., -25:, 1] = np.nan  # Trailing gap.
+    x[..., :10, 2] = np.nan  # Leading and trailing gaps.
+    x[..., -10:, 2] = np.nan
+    x[..., :, 3] = np.nan  # No valid values.
+    x[..., 50:200, 4] = np.nan  # Long gap.
+    return x
+
+@pytest.mark.parametrize("shape", [(300, 6), (3, 300, 6)])
+@pytest.mark.parametrize("method", ["linear", "nearest"])
+def test_fill_missing_matches_pandas(shape, method):
+    x = make_gappy(shape)
+    expected = legacy_fill_missing(x, method=method)
+    filled = features.fill_missing(x, method=method)
+    assert filled.shape == x.shape
+    np.testing.assert_array_equal(filled, expected)
+
+    # Inputs are not modified.
+    np.testing.assert_array_equal(np.isnan(x), np.isnan(make_gappy(shape)))
+
+@pytest.mark.parametrize("method", ["linear", "nearest"])
+def test_interpolate_missing_matches_pandas(method):
+    x = make_gappy((300, 6))
+    np.testing.assert_array_equal(features.interpolate_missing(x, method=method, axis=0), legacy_fill_missing(x, method=method))
+
+    # Interpolation along another axis of a 3D array.
+    x = make_gappy((2, 300, 6), seed=1)
+    expected = np.stack([legacy_fill_missing(x[:, :, j].T, method=method).T for j in range(x.shape[2])], axis=2)
+    np.testing.assert_array_equal(features.interpolate_missing(np.moveaxis(x, 1, 0), method=method, axis=0), np.moveaxis(expected, 1, 0))
+    np.testing.assert_array_equal(features.interpolate_missing(x, method=method, axis=1), expected)
+
+def test_fill_missing_default_kind():
+    # The default kind is ignored by pandas, which interpolates linearly.
+    x = make_gappy((300, 6))
+    np.testing.assert_array_equal(features.fill_missing(x, kind="nearest"), legacy_fill_missing(x, kind="nearest"))
+    np.testing.assert_array_equal(features.fill_missing(x, kind="linear"), legacy_fill_missing(x, kind="linear"))
+
+@pytest.mark.parametrize("fill", [True, False])
+@pytest.mark.parametrize("scale_factor", [1, 2.5])
+def test_normalize_to_egocentric_batch(fill, scale_factor):
+    rng = np.random.default_rng(0)
+    n_frames, n_joints, n_flies = 500, 6, 3
+    tracks = rng.normal(scale=100, size=(n_frames, n_joints, 2, n_flies))
+    tracks[rng.random((n_frames, n_joints, 1, n_flies)).repeat(2, axis=2) < 0.1] = np.nan
+    tracks[:30, 1, :, 0] = np.nan  # Leading gap in the centroid of the first fly.
+    tracks[-20:, 0, :, 1] = np.nan  # Trailing gap in the head of the second fly.
+    tracks[100:120, :, :, 2] = np.nan  # Frames where a fly is lost.
+
+    ego, ang = features.normalize_to_egocentric_batch(tracks, scale_factor=scale_factor, fill=fill)
+    assert ego.shape == (n_frames, n_joints, 2, n_flies, n_flies)
+    assert ang.shape == (n_frames, n_flies)
+    for j in range(n_flies):
+        for i in range(n_flies):
+            expected, expected_ang = features.normalize_to_egocentric(tracks[..., i], rel_to=tracks[..., j], scale_factor=scale_factor, fill=fill, return_angles=True)
+            np.testing.assert_array_equal(np.isnan(ego[..., i, j]), np.isnan(expected))
+            np.testing.assert_allclose(ego[..., i, j], expected, rtol=0, atol=1e-9)
+        np.testing.assert_array_equal(ang[:, j], expected_ang)
+
+def test_normalize_to_egocentric_batch_precomputed():
+    rng = np.random.default_rng(1)
+    tracks = rng.normal(scale=100, size=(300, 6, 2, 2))
+    tracks[rng.random(tracks.shape[:2]) < 0.2] = np.nan
+    ctr = features.fill_missing(tracks[:, 1], kind="nearest")
+    fwd = features.fill_missing(tracks[:, 0], kind="nearest")
+    ego, ang = features.normalize_to_egocentric_batch(tracks, ctr=ctr, fwd=fwd)
+    for j in range(2):
+        for i in range(2):
+            expected, expected_ang = features.normalize_to_egocentric(tracks[..., i], rel_to=tracks[..., j], ctr=ctr[..., j], fwd=fwd[..., j], return_angles=True)
+            np.testing.assert_allclose(ego[..., i, j], expected, rtol=0, atol=1e-9)
+        np.testing.assert_array_equal(ang[:, j], expected_ang)
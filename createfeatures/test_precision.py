@@ -0,0 +1,79 @@
+import os
+import h5py
+import numpy as np
+import pytest
+
+import features
+import synthetic
+
+
+# Largest absolute error of float32 features relative to float64 in the units of each
+# feature (pixels, degrees, pixels per frame...).
+FLOAT32_MAX_ERROR = dict(
+    {name: 2e-3 for name in features.TRACKING_FEATURES},
+    egoFrM=5e-3,
+    egoMrF=5e-3,
+    arcThetaL=2e-3,
+    arcThetaR=2e-3,
+    mfAng=0.05,
+    fmAng=0.05,
+    mRS=features.SIGNED_ANGLE_RESOLUTION,
+    fRS=features.SIGNED_ANGLE_RESOLUTION,
+)
+
+# Features computed with signed_angle, whose rounded cosines can flip by one step.
+ROUNDED_ANGLE_FEATURES = ["mRS", "fRS", "mfAng", "fmAng"]
+
+@pytest.fixture(scope="module")
+def expt_datasets(tmp_path_factory):
+    """Datasets of a synthetic experiment computed in float64 and float32."""
+    root = str(tmp_path_factory.mktemp("precision"))
+    expt_folder = os.path.join(root, "expt")
+    synthetic.make_synthetic_expt(expt_folder, duration=60)
+    paths = dict()
+    for precision in ["float64", "float32"]:
+        paths[precision] = features.make_expt_dataset(expt_folder, output_path=os.path.join(root, f"{precision}.h5"), overwrite=True, precision=precision)
+    return paths
+
+@pytest.mark.parametrize("name", features.TRACKING_FEATURES)
+def test_float32_error(expt_datasets, name):
+    with h5py.File(expt_datasets["float64"], "r") as f64, h5py.File(expt_datasets["float32"], "r") as f32:
+        x = f64[name][()]
+        y = f32[name][()]
+        assert f32[name].dtype == np.float32
+    assert x.shape == y.shape
+    np.testing.assert_array_equal(np.isnan(x), np.isnan(y))
+
+    err = np.abs(x - y.astype("float64"))[np.isfinite(x)]
+    assert err.max() <= FLOAT32_MAX_ERROR[name]
+    if name in ROUNDED_ANGLE_FEATURES:
+        # Only rare frames can differ by a rounding step of signed_angle.
+        assert np.mean(err > 1e-3) < 0.01
+
+def test_float32_sync_and_song(expt_datasets):
+    with h5py.File(expt_datasets["float64"], "r") as f64, h5py.File(expt_datasets["float32"], "r") as f32:
+        assert f32["sample_at_frame"].dtype == np.float64
+        np.testing.assert_array_equal(f64["sample_at_frame"][()], f32["sample_at_frame"][()])
+        for name in ["song_bout_id", "song_bout_type"]:
+            np.testing.assert_array_equal(f64[name][()], f32[name][()])
+        for name in ["pfast_frac", "pslow_frac", "sine_frac"]:
+            np.testing.assert_allclose(f64[name][()], f32[name][()], atol=1e-6)
+
+def test_signed_angle_float32_inputs():
+    rng = np.random.default_rng(0)
+    a = rng.normal(size=(10000, 2)).astype("float32")
+    # Include nearly parallel vectors, where arccos is most sensitive to rounding.
+    b = (a + rng.normal(scale=1e-3, size=a.shape)).astype("float32")
+    np.testing.assert_array_equal(features.signed_angle(a, b), features.signed_angle(a.astype("float64"), b.astype("float64")))
+
+def test_wing_arc_angles_float32_inputs():
+    rng = np.random.default_rng(0)
+    thx = rng.normal(scale=100, size=(10000, 2)).astype("float32")
+    wingL = (thx + rng.normal(scale=30, size=thx.shape)).astype("float32")
+    wingR = (thx + rng.normal(scale=30, size=thx.shape)).astype("float32")
+    hd = (thx + rng.normal(scale=100, size=thx.shape)).astype("float32")
+    expected = features.compute_wing_arc_angles_from_points(*[x.astype("float64") for x in [thx, wingL, wingR, hd]])
+    arc = features.compute_wing_arc_angles_from_points(thx, wingL, wingR, hd)
+    for x, y in zip(arc, expected):
+        assert x.dtype == np.float64
+        np.testing.assert_allclose(x, y, rtol=0, atol=FLOAT32_MAX_ERROR["arcThetaL"])
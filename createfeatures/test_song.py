@@ -0,0 +1,66 @@
+import h5py
+import numpy as np
+import pytest
+
+import features
+import synthetic
+
+
+@pytest.fixture(scope="module")
+def song_expts(tmp_path_factory):
+    """The same synthetic experiment with song.mat written as v7.3 and as v5."""
+    root = tmp_path_factory.mktemp("song")
+    expts = dict()
+    for mat_version in ["7.3", "5"]:
+        expt_folder = str(root / f"v{mat_version}")
+        song = synthetic.make_synthetic_expt(expt_folder, duration=120, n_channels=1, mat_version=mat_version)
+        expts[mat_version] = expt_folder
+    return expts, song
+
+@pytest.mark.parametrize("use_cache", [False, True])
+def test_v5_and_v73_intervals_match(song_expts, use_cache):
+    expts, truth = song_expts
+    song_v73 = features.load_song_intervals(expts["7.3"], use_cache=use_cache)
+    song_v5 = features.load_song_intervals(expts["5"], use_cache=use_cache)
+
+    assert song_v5["n_samples"] == song_v73["n_samples"] == truth["n_samples"]
+    for name in features.SONG_INTERVALS:
+        np.testing.assert_array_equal(song_v5[name], song_v73[name], err_msg=name)
+    for name, bout_type in [("pulse_bouts", "Pul"), ("sine_bouts", "Sin"), ("mix_bouts", "Mix")]:
+        assert len(song_v5[name]) > 0
+        np.testing.assert_array_equal(song_v5[name], truth["bout_lims"][truth["bout_types"] == bout_type], err_msg=name)
+
+def test_v5_load_song_bouts(song_expts):
+    expts, truth = song_expts
+    pslow, pfast, sine, pulse_bouts, sine_bouts, mix_bouts = features.load_song(expts["5"])
+    assert pslow.shape == pfast.shape == sine.shape == (truth["n_samples"],)
+    np.testing.assert_array_equal(pulse_bouts, truth["bout_lims"][truth["bout_types"] == "Pul"])
+    np.testing.assert_array_equal(sine_bouts, truth["bout_lims"][truth["bout_types"] == "Sin"])
+    np.testing.assert_array_equal(mix_bouts, truth["bout_lims"][truth["bout_types"] == "Mix"])
+
+def test_split_bouts_cell_layouts():
+    bout_lims = np.array([[0, 10], [20, 30], [40, 50]], dtype="float64")
+    bout_types = ["Sin", "Pul", "Sin"]
+    cells = np.empty(3, dtype=object)
+    cells[:] = [np.array([t]) for t in bout_types]  # As loaded by scipy.io.loadmat.
+    for types in [np.array(bout_types), cells.reshape(-1, 1), cells.reshape(1, -1)]:
+        pulse_bouts, sine_bouts, mix_bouts = features.split_bouts(bout_lims, types)
+        np.testing.assert_array_equal(pulse_bouts, bout_lims[[1]])
+        np.testing.assert_array_equal(sine_bouts, bout_lims[[0, 2]])
+        assert mix_bouts.shape == (0, 2)
+
+def test_old_cache_is_rebuilt(song_expts):
+    expts, truth = song_expts
+    expected = features.load_song_intervals(expts["5"], use_cache=False)
+    cache_path = features.find_song_file(expts["5"]) + ".intervals.h5"
+    features.load_song_intervals(expts["5"])
+
+    # Corrupt the cached bouts and mark the cache as written by the previous version.
+    with h5py.File(cache_path, "r+") as f:
+        del f["sine_bouts"]
+        f.create_dataset("sine_bouts", data=np.zeros((3, 2)))
+        del f.attrs["version"]
+    song = features.load_song_intervals(expts["5"])
+    np.testing.assert_array_equal(song["sine_bouts"], expected["sine_bouts"])
+    with h5py.File(cache_path, "r") as f:
+        assert f.attrs["version"] == features.SONG_CACHE_VERSION
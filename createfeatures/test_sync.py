@@ -0,0 +1,83 @@
+import os
+import h5py
+import numpy as np
+import pytest
+import scipy.ndimage
+import scipy.interpolate
+
+import features
+import synthetic
+
+
+def legacy_expt_sync(trigger):
+    """Dense sample/frame maps as computed before SampleFrameMap (label + interp1d)."""
+    trigger = np.array(trigger)
+    trigger[trigger[:] < 1.5] = 0
+    trigger[trigger[:] > 1.5] = 1
+    daq2frame, n_frames = scipy.ndimage.label(trigger)
+    frame_idx, frame_time, count = np.unique(daq2frame, return_index=True, return_counts=True)
+    frame_daq_sample = frame_time[1:] + (count[1:] - 1) / 2
+    f = scipy.interpolate.interp1d(frame_daq_sample, np.arange(frame_daq_sample.shape[0]), kind="nearest", fill_value="extrapolate")
+    daq_frame_idx = f(np.arange(trigger.shape[0]))
+    return frame_daq_sample, daq_frame_idx
+
+def make_sync(expt_folder, n_frames, fps, dropped=(), end_in_pulse=False, fs=10000):
+    """Write a synthetic daq.h5 with dropped frames and return its sync signal.
+
+    Args:
+        expt_folder: Folder to write daq.h5 to.
+        n_frames: Number of video frames.
+        fps: Video frame rate. The exposure pulses are an odd number of samples long at
+            100 fps and an even number at 150 fps.
+        dropped: Indices of frames whose exposure pulse is removed.
+        end_in_pulse: If True, the recording ends in the middle of the last pulse.
+        fs: Sample rate in Hz.
+    """
+    os.makedirs(expt_folder, exist_ok=True)
+    path = os.path.join(expt_folder, "daq.h5")
+    synthetic.write_daq(path, n_frames, fs=fs, fps=fps, n_channels=0)
+    with h5py.File(path, "r") as f:
+        sync = f["sync"][:]
+
+    spf = fs / fps
+    lead = synthetic.LEAD_SAMPLES
+    for i in dropped:
+        sync[int(np.ceil(lead + i * spf)):int(np.ceil(lead + (i + 1) * spf))] = 0
+    if end_in_pulse:
+        sync = sync[:int(np.ceil(lead + (n_frames - 1) * spf)) + int(spf / 3) // 2 + 1]
+
+    with h5py.File(path, "w") as f:
+        f.create_dataset("sync", data=sync)
+    return sync
+
+@pytest.mark.parametrize("fps,dropped,end_in_pulse", [
+    (150, (), False),
+    (100, (), False),
+    (150, (0, 3, 4, 50, 51, 52), False),
+    (100, (10, 11, 299), True),
+    (150, (), True),
+])
+@pytest.mark.parametrize("chunk_size", [2**20, 997])
+def test_sync_matches_legacy(tmp_path, fps, dropped, end_in_pulse, chunk_size):
+    sync = make_sync(str(tmp_path), 300, fps, dropped=dropped, end_in_pulse=end_in_pulse)
+    expected_sample_at_frame, expected_frame_at_sample = legacy_expt_sync(sync)
+
+    sample_at_frame, frame_at_sample = features.get_expt_sync(str(tmp_path), chunk_size=chunk_size)
+
+    assert len(sample_at_frame) == 300 - len([i for i in dropped if i < 300])
+    np.testing.assert_array_equal(sample_at_frame, expected_sample_at_frame)
+    assert len(frame_at_sample) == len(sync)
+    np.testing.assert_array_equal(np.asarray(frame_at_sample), expected_frame_at_sample)
+
+def test_sample_frame_map_indexing(tmp_path):
+    sync = make_sync(str(tmp_path), 200, 100, dropped=(5, 6))
+    _, expected = legacy_expt_sync(sync)
+    _, frame_at_sample = features.get_expt_sync(str(tmp_path))
+    n_samples = len(sync)
+
+    idx = np.random.default_rng(0).integers(0, n_samples, 1000)
+    np.testing.assert_array_equal(frame_at_sample[idx], expected[idx])
+    np.testing.assert_array_equal(frame_at_sample[-idx - 1], expected[-idx - 1])
+    np.testing.assert_array_equal(frame_at_sample[5:n_samples - 3:7], expected[5:n_samples - 3:7])
+    assert frame_at_sample[n_samples // 2] == expected[n_samples // 2]
+    assert frame_at_sample.shape == (n_samples,)
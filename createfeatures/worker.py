@@ -0,0 +1,324 @@
+import os
+import time
+import fcntl
+import signal
+import socket
+import hashlib
+import logging
+import argparse
+import contextlib
+
+import features
+
+
+logger = logging.getLogger("worker")
+
+# States of an experiment in the queue, recorded as marker files.
+MARKER_STATES = ["claim", "done", "failed"]
+
+def get_marker_folder(queue_path):
+    """Returns the folder with the claim/done/failed markers of a queue file."""
+    return queue_path + ".markers"
+
+def get_marker_path(queue_path, expt_folder, state):
+    """Returns the path to the marker of an experiment in a given state.
+
+    Markers are named by the experiment folder name and a hash of its full path, so
+    experiments with the same name in different data directories do not collide.
+    """
+    expt_folder = os.path.normpath(expt_folder)
+    key = hashlib.sha1(expt_folder.encode()).hexdigest()[:12]
+    return os.path.join(get_marker_folder(queue_path), f"{os.path.basename(expt_folder)}.{key}.{state}")
+
+@contextlib.contextmanager
+def lock_queue(queue_path, exclusive=True):
+    """Hold a lock on a queue file while reading or appending to it.
+
+    Args:
+        queue_path: Path to the queue file.
+        exclusive: If True, take an exclusive lock (for appending), otherwise a shared
+            lock (for reading). Defaults to True.
+    """
+    with open(queue_path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def read_queue(queue_path):
+    """Read the experiment folders in a queue file.
+
+    Args:
+        queue_path: Path to a text file with one experiment folder per line. Only the
+            first word of each line is used, so the array args files written by
+            process.sh can be used as queues.
+
+    Returns:
+        A list of experiment folders in the order of the file.
+    """
+    if not os.path.exists(queue_path):
+        return []
+    with lock_queue(queue_path, exclusive=False):
+        with open(queue_path, "r") as f:
+            return [line.split()[0] for line in f if line.strip()]
+
+def add_to_queue(queue_path, expt_folders):
+    """Append experiment folders to a queue file.
+
+    Experiments can be added while workers are running; they are picked up when a
+    worker next looks for work.
+
+    Args:
+        queue_path: Path to the queue file. It is created if it does not exist.
+        expt_folders: List of paths to experiment folders. Folders already in the
+            queue are skipped.
+
+    Returns:
+        The number of experiments added.
+    """
+    os.makedirs(get_marker_folder(queue_path), exist_ok=True)
+    with lock_queue(queue_path):
+        queued = set()
+        if os.path.exists(queue_path):
+            with open(queue_path, "r") as f:
+                queued = set(os.path.normpath(line.split()[0]) for line in f if line.strip())
+        new = [x for x in expt_folders if os.path.normpath(x) not in queued]
+        new = list(dict.fromkeys(new))
+        with open(queue_path, "a") as f:
+            f.writelines(f"{x}\n" for x in new)
+    return len(new)
+
+def create_marker(path, message=""):
+    """Atomically create a marker file.
+
+    Args:
+        path: Path to the marker.
+        message: Text to write to the marker (e.g., the worker or error).
+
+    Returns:
+        True if the marker was created, False if it already existed.
+    """
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, "w") as f:
+        f.write(message)
+    return True
+
+def get_worker_name():
+    """Returns a description of this worker to write in its claims."""
+    job = os.environ.get("SLURM_JOB_ID", "")
+    if "SLURM_ARRAY_TASK_ID" in os.environ:
+        job = f"{os.environ.get('SLURM_ARRAY_JOB_ID', job)}_{os.environ['SLURM_ARRAY_TASK_ID']}"
+    return f"{socket.gethostname()} pid={os.getpid()} job={job} time={time.strftime('%Y-%m-%d %H:%M:%S')}"
+
+def claim_next(queue_path, retry_failed=False):
+    """Claim the next experiment in a queue that no other worker has claimed.
+
+    Args:
+        queue_path: Path to the queue file.
+        retry_failed: If True, experiments that failed before can be claimed again.
+            Defaults to False.
+
+    Returns:
+        The claimed experiment folder, or None if there is nothing left to claim.
+
+    Notes:
+        The claim marker is created with O_EXCL, so exactly one worker wins each
+        experiment even across nodes sharing the filesystem. Workers mark experiments
+        as done before releasing their claim, so the done marker is checked again after
+        claiming to skip experiments that finished in between.
+    """
+    os.makedirs(get_marker_folder(queue_path), exist_ok=True)
+    states = ["done"] if retry_failed else ["done", "failed"]
+    for expt_folder in read_queue(queue_path):
+        if any(os.path.exists(get_marker_path(queue_path, expt_folder, x)) for x in states):
+            continue
+        claim_path = get_marker_path(queue_path, expt_folder, "claim")
+        if not create_marker(claim_path, get_worker_name()):
+            continue
+        if any(os.path.exists(get_marker_path(queue_path, expt_folder, x)) for x in states):
+            os.remove(claim_path)
+            continue
+        if retry_failed:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(get_marker_path(queue_path, expt_folder, "failed"))
+        return expt_folder
+    return None
+
+def release(queue_path, expt_folder, success=None, message=""):
+    """Release the claim on an experiment.
+
+    Args:
+        queue_path: Path to the queue file.
+        expt_folder: Path to the claimed experiment folder.
+        success: True to mark the experiment as done, False to mark it as failed, or
+            None to return it to the queue (e.g., if the worker was stopped).
+        message: Text to write to the done or failed marker.
+    """
+    if success is not None:
+        state = "done" if success else "failed"
+        create_marker(get_marker_path(queue_path, expt_folder, state), message)
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(get_marker_path(queue_path, expt_folder, "claim"))
+
+def get_queue_status(queue_path):
+    """Find the state of each experiment in a queue.
+
+    Args:
+        queue_path: Path to the queue file.
+
+    Returns:
+        A dictionary mapping each state ("pending", "claim", "done" and "failed") to a
+        list of experiment folders.
+    """
+    status = {x: [] for x in ["pending"] + MARKER_STATES}
+    for expt_folder in read_queue(queue_path):
+        state = next((x for x in ["done", "failed", "claim"] if os.path.exists(get_marker_path(queue_path, expt_folder, x))), "pending")
+        status[state].append(expt_folder)
+    return status
+
+def reset_queue(queue_path, failed=False):
+    """Return claimed experiments to the queue.
+
+    Claims are left behind if a worker is killed without a chance to clean up (e.g.,
+    SIGKILL or a node failure). Only run this when no workers are running.
+
+    Args:
+        queue_path: Path to the queue file.
+        failed: If True, also return failed experiments to the queue. Defaults to False.
+
+    Returns:
+        The number of experiments returned to the queue.
+    """
+    states = ["claim", "failed"] if failed else ["claim"]
+    n = 0
+    for expt_folder in read_queue(queue_path):
+        for state in states:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(get_marker_path(queue_path, expt_folder, state))
+                n += 1
+    return n
+
+def raise_on_sigterm(signum, frame):
+    """Signal handler to exit cleanly when SLURM stops a job."""
+    raise SystemExit(f"received signal {signum}")
+
+def run_worker(queue_path, max_expts=None, retry_failed=False, **kwargs):
+    """Process experiments from a shared queue until it is empty.
+
+    Each experiment is claimed, processed with features.main in this interpreter and
+    marked as done or failed, so the start up cost (environment, imports) is paid once
+    per worker instead of once per experiment. Any number of workers can run on the
+    same queue.
+
+    Args:
+        queue_path: Path to the queue file.
+        max_expts: Maximum number of experiments to process. Defaults to no limit.
+        retry_failed: If True, also process experiments that failed before. Defaults
+            to False.
+        **kwargs: Additional keyword arguments passed to features.main for each
+            experiment (e.g., store_path, storage, n_threads, precision).
+
+    Returns:
+        A dictionary mapping each processed experiment folder to a tuple of
+        (success, result) where result is the output path if successful or the error
+        message otherwise.
+
+    Notes:
+        If the worker is stopped by SIGTERM (e.g., at the job time limit) or Ctrl+C,
+        the experiment being processed is returned to the queue.
+    """
+    if os.environ.get("SLURM_JOB_ID") is not None:
+        signal.signal(signal.SIGTERM, raise_on_sigterm)
+
+    results = dict()
+    while max_expts is None or len(results) < max_expts:
+        expt_folder = claim_next(queue_path, retry_failed=retry_failed)
+        if expt_folder is None:
+            break
+
+        logger.info(f"Claimed: {expt_folder}")
+        t0 = time.perf_counter()
+        try:
+            result = features.main(expt_folder, **kwargs)
+        except Exception as e:
+            results[expt_folder] = (False, f"{type(e).__name__}: {e}")
+            release(queue_path, expt_folder, success=False, message=results[expt_folder][1])
+            logger.exception(f"FAILED: {expt_folder}")
+            continue
+        except BaseException:
+            release(queue_path, expt_folder)
+            logger.warning(f"Stopped, returned to queue: {expt_folder}")
+            raise
+        results[expt_folder] = (True, result)
+        release(queue_path, expt_folder, success=True, message=f"{result}\n")
+        logger.info(f"OK: {expt_folder} ({time.perf_counter() - t0:.1f} s)")
+
+    n_failed = sum(not ok for ok, _ in results.values())
+    logger.info(f"Worker finished {len(results)} experiments ({n_failed} failed)")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="process experiments from a queue until it is empty")
+    run_parser.add_argument('queue_path', type=str, help='path to the queue file')
+    run_parser.add_argument('-n', '--max_expts', type=int, default=None, help='maximum number of experiments to process (default: no limit)')
+    run_parser.add_argument('--retry_failed', action='store_true', help='also process experiments that failed before')
+    run_parser.add_argument('-f', '--features', type=str, nargs='+', default=None, help='names of tracking features to save (default: all)')
+    run_parser.add_argument('-s', '--store', type=str, default=None, help='path to a consolidated feature store to append the datasets to')
+    run_parser.add_argument('--storage', type=str, default="default", choices=list(features.STORAGE_PROFILES), help='storage profile of the datasets (default: default)')
+    run_parser.add_argument('--profile_log', type=str, default=None, help='file to append the stage profile of each experiment to as JSON lines')
+    run_parser.add_argument('--chunk_frames', type=int, default=None, help='compute tracking features in blocks of this many frames to limit memory')
+    run_parser.add_argument('--threads', type=int, default=None, help='read inputs, compute features and write outputs concurrently on this many threads per experiment')
+    run_parser.add_argument('--precision', type=str, default="float64", choices=["float64", "float32"], help='floating point precision of the tracking features')
+    run_parser.add_argument('--log_level', type=str, default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"], help='logging level (default: INFO)')
+
+    add_parser = subparsers.add_parser("add", help="append experiment folders to a queue")
+    add_parser.add_argument('queue_path', type=str, help='path to the queue file')
+    add_parser.add_argument('-e', '--expt', type=str, nargs='+', default=[], help='experiment folders to add')
+    add_parser.add_argument('-r', '--root', type=str, help='path to data directory; adds all experiment folders in it')
+    add_parser.add_argument('-l', '--expt_list', type=str, help='text file with one experiment folder per line')
+
+    status_parser = subparsers.add_parser("status", help="count the experiments in each state")
+    status_parser.add_argument('queue_path', type=str, help='path to the queue file')
+    status_parser.add_argument('-v', '--verbose', action='store_true', help='also list the claimed and failed experiments')
+
+    reset_parser = subparsers.add_parser("reset", help="return claimed experiments to the queue (only when no workers are running)")
+    reset_parser.add_argument('queue_path', type=str, help='path to the queue file')
+    reset_parser.add_argument('--failed', action='store_true', help='also return failed experiments to the queue')
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        logging.basicConfig(level=args.log_level, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+        results = run_worker(args.queue_path, max_expts=args.max_expts, retry_failed=args.retry_failed, features=args.features, store_path=args.store, storage=args.storage, profile_path=args.profile_log, chunk_frames=args.chunk_frames, n_threads=args.threads, precision=args.precision)
+        if not all(ok for ok, _ in results.values()):
+            raise SystemExit(1)
+
+    elif args.command == "add":
+        expt_folders = list(args.expt)
+        if args.root is not None:
+            expt_folders += features.find_expt_folders(args.root)
+        if args.expt_list is not None:
+            with open(args.expt_list, "r") as f:
+                expt_folders += [line.split()[0] for line in f if line.strip()]
+        if len(expt_folders) == 0:
+            add_parser.error("one of --expt, --root or --expt_list is required")
+        print(f"added {add_to_queue(args.queue_path, expt_folders)} experiments to {args.queue_path}")
+
+    elif args.command == "status":
+        status = get_queue_status(args.queue_path)
+        print(f"pending: {len(status['pending'])}, running: {len(status['claim'])}, done: {len(status['done'])}, failed: {len(status['failed'])}")
+        if args.verbose:
+            for state in ["claim", "failed"]:
+                for expt_folder in status[state]:
+                    with open(get_marker_path(args.queue_path, expt_folder, state), "r") as f:
+                        print(f"{state}: {expt_folder} ({f.read().strip()})")
+
+    elif args.command == "reset":
+        print(f"returned {reset_queue(args.queue_path, failed=args.failed)} experiments to the queue")
@@ -1,18 +1,24 @@
 #!/bin/bash
-# Usage bash: segment_jobscript.sh
+# Usage: bash segment.sh /path/to/dataDirectory/ [block_seconds]
+# If block_seconds is given, the audio of each experiment is split into overlapping
+# blocks that are segmented in parallel and stitched back into one song file. The split
+# runs as a job (split_jobscript.sh) that submits the segmentation and stitch jobs.
 
 JOB_SCRIPT="segment_jobscript.sh"
 
 # where to save the ARRAY ARGS FILE (created for parallel submission)
 SAVE_FOLDER="/tigress/MMURTHY/Kyle/code/dataProcessing/songSegmentation"
 EXP_FOLDER=$1
+BLOCK_SECONDS=$2
 readarray DAQ_PATHS < <(find $EXP_FOLDER -not -path '*/\.*' -name "daq.h5") # find all daq files in the folders
 
 # echo "${DAQ_PATHS[@]}"
 
 #creates an array file for the job script to use
 ARRAY_ARGS_FILE="$SAVE_FOLDER/segment_array_args_IM.txt"
-rm -f "$ARRAY_ARGS_FILE"
+STITCH_ARGS_FILE="$SAVE_FOLDER/stitch_args_IM.txt"
+SPLIT_ARGS_FILE="$SAVE_FOLDER/split_args_IM.txt"
+rm -f "$ARRAY_ARGS_FILE" "$STITCH_ARGS_FILE" "$SPLIT_ARGS_FILE"
 
 NUM_ARRAY_JOBS=0
 
@@ -24,6 +30,12 @@ for DAQ_PATH in "${DAQ_PATHS[@]}"; do
 	if [ -f "$SAVE_PATH" ]; then # skip folders that have already been segmented
 		echo "EXISTS: $SAVE_PATH"
 		continue
+	elif [ -n "$BLOCK_SECONDS" ]; then
+		# split by split_jobscript.sh into one array job per block, stitched into
+		# SAVE_PATH after all blocks finish
+		echo "$DAQ_PATH"
+		NUM_ARRAY_JOBS=$((NUM_ARRAY_JOBS + 1))
+		echo "$DAQ_PATH $SAVE_PATH" >> $SPLIT_ARGS_FILE
 	else
 		echo "$DAQ_PATH"
 		NUM_ARRAY_JOBS=$((NUM_ARRAY_JOBS + 1))
@@ -34,5 +46,10 @@ for DAQ_PATH in "${DAQ_PATHS[@]}"; do
 
 done
 
-echo "Jobs: $NUM_ARRAY_JOBS"
-sbatch -a 1-"$NUM_ARRAY_JOBS" "$JOB_SCRIPT" "$ARRAY_ARGS_FILE"
+if [ -n "$BLOCK_SECONDS" ]; then
+	echo "Experiments: $NUM_ARRAY_JOBS"
+	sbatch split_jobscript.sh "$SPLIT_ARGS_FILE" "$BLOCK_SECONDS" "$ARRAY_ARGS_FILE" "$STITCH_ARGS_FILE"
+else
+	echo "Jobs: $NUM_ARRAY_JOBS"
+	sbatch -a 1-"$NUM_ARRAY_JOBS" "$JOB_SCRIPT" "$ARRAY_ARGS_FILE"
+fi
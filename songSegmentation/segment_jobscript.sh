@@ -9,18 +9,12 @@
 #SBATCH --output='logs/WT.%A.%a.log'
 
 text_file="$1"
-linenum=$SLURM_ARRAY_TASK_ID
-linenum=$((linenum-1))
+# read only this task's line of the text file (one line per array task)
+linetxt=$(sed -n "${SLURM_ARRAY_TASK_ID}p" "$text_file")
+echo "$linetxt"
 
-echo $linenum
-OLDIFS=$IFS
-IFS=$'\n'
-
-array=( $(grep "[a-z]" $text_file) )
-linetxt=${array["$linenum"]}
-
-IFS=$OLDIFS
-delim=' ' read -r -a linearray <<< "$linetxt"
+# Split up line
+read -r -a linearray <<< "$linetxt"
 
 module purge
 module load matlab/R2018b
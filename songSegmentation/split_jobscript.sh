@@ -0,0 +1,39 @@
+#!/bin/bash
+#SBATCH --job-name=split
+#SBATCH --time=01:00:00
+#SBATCH -N 1
+#SBATCH --cpus-per-task=1
+#SBATCH --mem=8G
+#SBATCH --output='logs/split.%j.log'
+
+# Usage: sbatch split_jobscript.sh split_args.txt block_seconds segment_args.txt stitch_args.txt
+# Each line of split_args.txt has the path to a daq.h5 and the path to save the stitched
+# song file to. The audio of each experiment is split into blocks with split_song.py, then
+# one segment_jobscript.sh array task is submitted per block and stitch_jobscript.sh is
+# submitted to run after all of them finish.
+
+text_file="$1"
+block_seconds="$2"
+array_args_file="$3"
+stitch_args_file="$4"
+
+module load anaconda
+conda activate sleap
+
+set -o pipefail
+rm -f "$array_args_file" "$stitch_args_file"
+
+while read -r daq_path save_path; do
+    [ -z "$daq_path" ] && continue
+    block_folder="$(dirname "$daq_path")/song_blocks"
+    echo "splitting: $daq_path -> $block_folder"
+    python split_song.py split "$daq_path" "$block_folder" -b "$block_seconds" | grep "\.song\.mat$" >> "$array_args_file" || exit 1
+    echo "$block_folder $save_path" >> "$stitch_args_file"
+done < "$text_file"
+
+num_array_jobs=$(grep -c "[a-z]" "$array_args_file")
+echo "Jobs: $num_array_jobs"
+if [ "$num_array_jobs" -gt 0 ]; then
+    job_id=$(sbatch --parsable -a 1-"$num_array_jobs" segment_jobscript.sh "$array_args_file")
+    sbatch --dependency=afterany:"$job_id" stitch_jobscript.sh "$stitch_args_file"
+fi
@@ -0,0 +1,297 @@
+import os
+import json
+import argparse
+import h5py
+import numpy as np
+import scipy.io
+
+
+# Per-sample vectors saved by segment_song_bandstop_daq.m that are stitched by taking
+# each sample from the block that owns it.
+SAMPLE_VECTORS = ["pfast", "pslow", "sine", "pulse", "song"]
+
+def make_blocks(n_samples, block_samples, overlap_samples):
+    """Split a recording into overlapping blocks.
+
+    Each block owns a contiguous range of samples and the owned ranges of all blocks
+    partition the recording. Blocks are segmented with overlap_samples of extra audio on
+    each side of their owned range so that song near the edges has the same context as
+    in the full recording.
+
+    Args:
+        n_samples: Number of samples in the recording.
+        block_samples: Number of samples owned by each block.
+        overlap_samples: Number of samples of context on each side of a block.
+
+    Returns:
+        An (n_blocks, 4) int64 array where each row contains the start and end
+        (exclusive) of the samples read by the block followed by the start and end
+        (exclusive) of the samples it owns.
+    """
+    own0 = np.arange(0, max(n_samples, 1), block_samples, dtype="int64")
+    own1 = np.minimum(own0 + block_samples, n_samples)
+    s0 = np.maximum(own0 - overlap_samples, 0)
+    s1 = np.minimum(own1 + overlap_samples, n_samples)
+    return np.stack([s0, s1, own0, own1], axis=1)
+
+def find_sample_axis(shape):
+    """Returns the axis of the audio that indexes samples (the longest one)."""
+    return int(np.argmax(shape))
+
+def split_daq(daq_path, block_folder, block_seconds=600, overlap_seconds=10, fs=10000):
+    """Split the audio of a daq.h5 into overlapping blocks saved as small daq files.
+
+    Each block is saved as "block_XXXX.daq.h5" with the same "/audio" layout as the
+    original file so that segment_song_bandstop_daq.m can segment it unchanged. The
+    blocks are described in "blocks.json" which is read by stitch_song.
+
+    Args:
+        daq_path: Path to daq.h5.
+        block_folder: Folder to save the blocks to.
+        block_seconds: Length of the audio owned by each block in seconds.
+        overlap_seconds: Length of the extra audio on each side of a block in seconds.
+            This should be longer than a song bout so that bouts at block edges are
+            detected in full by at least one block.
+        fs: Audio sample rate in Hz.
+
+    Returns:
+        A list of paths to the block daq files.
+    """
+    os.makedirs(block_folder, exist_ok=True)
+    with h5py.File(daq_path, "r") as f:
+        audio = f["audio"]
+        axis = find_sample_axis(audio.shape)
+        n_samples = audio.shape[axis]
+        blocks = make_blocks(n_samples, int(block_seconds * fs), int(overlap_seconds * fs))
+
+        block_paths = []
+        for i, (s0, s1, _, _) in enumerate(blocks):
+            block_path = os.path.join(block_folder, f"block_{i:04d}.daq.h5")
+            idx = [slice(None)] * audio.ndim
+            idx[axis] = slice(s0, s1)
+            with h5py.File(block_path, "w") as g:
+                g.create_dataset("audio", data=audio[tuple(idx)])
+                g.attrs["sample_offset"] = s0
+            block_paths.append(block_path)
+
+    with open(os.path.join(block_folder, "blocks.json"), "w") as f:
+        json.dump({
+            "daq_path": os.path.abspath(daq_path),
+            "n_samples": int(n_samples),
+            "fs": fs,
+            "blocks": blocks.tolist(),
+            "block_paths": [os.path.basename(x) for x in block_paths],
+        }, f, indent=2)
+    print(f"Split {daq_path} into {len(blocks)} blocks ({n_samples} samples)")
+    return block_paths
+
+def get_block_song_path(block_path):
+    """Returns the path of the segmentation of a block daq file."""
+    return block_path[:-len(".daq.h5")] + ".song.mat"
+
+def load_block_song(path):
+    """Load the outputs of segment_song_bandstop_daq.m for one block.
+
+    Args:
+        path: Path to the .mat file saved for a block.
+
+    Returns:
+        A dictionary with the per-sample vectors in SAMPLE_VECTORS that are present,
+        "bout_lims" ((n, 2) array of bInf.stEn), "bout_types" (bInf.Type), "bout_mask"
+        (bInf.Mask), "pulse_centers" (pInf.wc), "pulse_labels" and "Fs".
+    """
+    seg = scipy.io.loadmat(path, variable_names=SAMPLE_VECTORS + ["bInf", "pInf", "pulseLabels", "Fs"], squeeze_me=True, struct_as_record=False)
+    song = {name: np.ravel(seg[name]) for name in SAMPLE_VECTORS if name in seg}
+    song["bout_lims"] = np.reshape(seg["bInf"].stEn, (-1, 2)).astype("float64")
+    song["bout_types"] = np.atleast_1d(seg["bInf"].Type).astype(str)
+    song["bout_mask"] = np.ravel(seg["bInf"].Mask)
+    song["pulse_centers"] = np.atleast_1d(seg["pInf"].wc).astype("float64")
+    song["pulse_labels"] = np.atleast_1d(seg["pulseLabels"])
+    song["Fs"] = float(seg["Fs"])
+    return song
+
+def stitch_vector(vectors, blocks, n_samples):
+    """Stitch per-sample vectors of blocks by taking each sample from its owner block.
+
+    Args:
+        vectors: List of 1D arrays with one element per sample read by each block.
+        blocks: Blocks as returned by make_blocks.
+        n_samples: Number of samples in the recording.
+
+    Returns:
+        A 1D array with n_samples elements.
+    """
+    out = np.zeros(n_samples, dtype=np.result_type(*vectors))
+    for x, (s0, s1, own0, own1) in zip(vectors, blocks):
+        if len(x) != s1 - s0:
+            raise ValueError(f"Block [{s0}, {s1}) has {len(x)} samples, expected {s1 - s0}.")
+        out[own0:own1] = x[own0 - s0:own1 - s0]
+    return out
+
+def merge_bouts(bout_lims, bout_types, blocks):
+    """Merge the song bouts of overlapping blocks into bouts of the full recording.
+
+    Bouts that do not touch the samples owned by their block are dropped. The remaining
+    bouts are sorted and overlapping bouts from different blocks, which are the same bout
+    detected in the overlap of both blocks, are merged into one bout spanning both. If
+    their types differ, the merged bout is "Mix".
+
+    Args:
+        bout_lims: List of (n, 2) arrays of start and end samples of the bouts of each
+            block, relative to the start of the block.
+        bout_types: List of arrays of n type strings of the bouts of each block.
+        blocks: Blocks as returned by make_blocks.
+
+    Returns:
+        A tuple of (bout_lims, bout_types) of the full recording.
+    """
+    lims, types, block_ids = [], [], []
+    for i, (x, t, (s0, _, own0, own1)) in enumerate(zip(bout_lims, bout_types, blocks)):
+        x = np.reshape(x, (-1, 2)) + s0
+        keep = (x[:, 1] >= own0) & (x[:, 0] < own1)
+        lims.append(x[keep])
+        types.append(np.asarray(t, dtype=str)[keep])
+        block_ids.append(np.full(keep.sum(), i))
+    lims, types, block_ids = np.concatenate(lims + [np.zeros((0, 2))]), np.concatenate(types + [np.zeros(0, str)]), np.concatenate(block_ids + [np.zeros(0, int)])
+
+    order = np.lexsort((lims[:, 1], lims[:, 0]))
+    merged_lims, merged_types, merged_blocks = [], [], []
+    for (start, end), bout_type, block_id in zip(lims[order], types[order], block_ids[order]):
+        if len(merged_lims) > 0 and start <= merged_lims[-1][1] and block_id not in merged_blocks[-1]:
+            merged_lims[-1][1] = max(merged_lims[-1][1], end)
+            if merged_types[-1] != bout_type:
+                merged_types[-1] = "Mix"
+            merged_blocks[-1].add(block_id)
+        else:
+            merged_lims.append([start, end])
+            merged_types.append(bout_type)
+            merged_blocks.append({block_id})
+    return np.array(merged_lims, dtype="float64").reshape(-1, 2), np.array(merged_types, dtype=str)
+
+def merge_pulses(pulse_centers, pulse_labels, blocks, min_separation=50):
+    """Merge the pulses of overlapping blocks into pulses of the full recording.
+
+    Each pulse is kept by the block that owns its center. A pulse at the edge of two
+    blocks may be detected by both at slightly different positions, so pulses closer
+    than min_separation samples to a kept pulse of another block are dropped.
+
+    Args:
+        pulse_centers: List of arrays with the pulse centers of each block in samples
+            relative to the start of the block.
+        pulse_labels: List of arrays with the class labels of the pulses of each block.
+        blocks: Blocks as returned by make_blocks.
+        min_separation: Minimum distance in samples between pulses of different blocks.
+
+    Returns:
+        A tuple of (pulse_centers, pulse_labels) of the full recording.
+    """
+    centers, labels, block_ids = [], [], []
+    for i, (x, y, (s0, _, own0, own1)) in enumerate(zip(pulse_centers, pulse_labels, blocks)):
+        x = np.asarray(x, dtype="float64") + s0
+        keep = (x >= own0) & (x < own1)
+        centers.append(x[keep])
+        labels.append(np.asarray(y)[keep])
+        block_ids.append(np.full(keep.sum(), i))
+    centers, labels, block_ids = np.concatenate(centers + [np.zeros(0)]), np.concatenate(labels + [np.zeros(0)]), np.concatenate(block_ids + [np.zeros(0, int)])
+
+    order = np.argsort(centers, kind="stable")
+    centers, labels, block_ids = centers[order], labels[order], block_ids[order]
+    is_duplicate = np.zeros(len(centers), dtype=bool)
+    is_duplicate[1:] = (np.diff(centers) < min_separation) & (np.diff(block_ids) != 0)
+    return centers[~is_duplicate], labels[~is_duplicate]
+
+def stitch_block_songs(songs, blocks, n_samples, min_pulse_separation=50):
+    """Stitch the segmentation of overlapping blocks into one segmentation.
+
+    Args:
+        songs: List of dictionaries of each block as returned by load_block_song.
+        blocks: Blocks as returned by make_blocks.
+        n_samples: Number of samples in the recording.
+        min_pulse_separation: See merge_pulses.
+
+    Returns:
+        A dictionary with the same keys as each block, for the full recording.
+    """
+    stitched = dict()
+    for name in SAMPLE_VECTORS + ["bout_mask"]:
+        if all(name in x for x in songs):
+            stitched[name] = stitch_vector([x[name] for x in songs], blocks, n_samples)
+    stitched["bout_lims"], stitched["bout_types"] = merge_bouts([x["bout_lims"] for x in songs], [x["bout_types"] for x in songs], blocks)
+    stitched["pulse_centers"], stitched["pulse_labels"] = merge_pulses(
+        [x["pulse_centers"] for x in songs], [x["pulse_labels"] for x in songs], blocks, min_separation=min_pulse_separation
+    )
+    stitched["Fs"] = songs[0]["Fs"]
+    return stitched
+
+def save_song(path, song, daq_path=None):
+    """Save a stitched segmentation with the variable names of segment_song_bandstop_daq.m.
+
+    Only the variables used downstream are saved (the per-sample masks, song, bInf,
+    pInf.wc, pulseLabels and pulseTimesAutomatic).
+
+    Args:
+        path: Path to the .mat file.
+        song: Dictionary as returned by stitch_block_songs.
+        daq_path: Optional path to the original daq.h5 saved as exptPath.
+    """
+    out = {name: song[name][:, None] for name in SAMPLE_VECTORS if name in song}
+    bInf = {"stEn": song["bout_lims"], "Type": np.array(song["bout_types"], dtype=object).reshape(-1, 1)}
+    if "bout_mask" in song:
+        bInf["Mask"] = song["bout_mask"][:, None]
+    out["bInf"] = bInf
+    out["pInf"] = {"wc": song["pulse_centers"][:, None]}
+    out["pulseLabels"] = song["pulse_labels"][:, None]
+    out["pulseTimesAutomatic"] = song["pulse_centers"][:, None] / song["Fs"]
+    out["Fs"] = song["Fs"]
+    if daq_path is not None:
+        out["exptPath"] = daq_path
+    scipy.io.savemat(path, out, do_compression=True)
+
+def stitch_song(block_folder, save_path, min_pulse_separation=50):
+    """Stitch the segmentations of the blocks created by split_daq.
+
+    Args:
+        block_folder: Folder with blocks.json and the segmentation of each block.
+        save_path: Path to save the stitched segmentation to.
+        min_pulse_separation: See merge_pulses.
+
+    Returns:
+        The stitched segmentation as returned by stitch_block_songs.
+    """
+    with open(os.path.join(block_folder, "blocks.json"), "r") as f:
+        info = json.load(f)
+    song_paths = [get_block_song_path(os.path.join(block_folder, x)) for x in info["block_paths"]]
+    missing = [x for x in song_paths if not os.path.exists(x)]
+    if len(missing) > 0:
+        raise FileNotFoundError(f"{len(missing)} of {len(song_paths)} blocks were not segmented: {missing}")
+
+    songs = [load_block_song(x) for x in song_paths]
+    song = stitch_block_songs(songs, np.array(info["blocks"], dtype="int64"), info["n_samples"], min_pulse_separation=min_pulse_separation)
+    save_song(save_path, song, daq_path=info["daq_path"])
+    print(f"Stitched {len(songs)} blocks into {save_path} ({len(song['bout_lims'])} bouts, {len(song['pulse_centers'])} pulses)")
+    return song
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    split_parser = subparsers.add_parser("split", help='split daq.h5 audio into overlapping blocks')
+    split_parser.add_argument('daq_path', type=str, help='path to daq.h5')
+    split_parser.add_argument('block_folder', type=str, help='folder to save the blocks to')
+    split_parser.add_argument('-b', '--block_seconds', type=float, default=600, help='length of each block in seconds')
+    split_parser.add_argument('-o', '--overlap_seconds', type=float, default=10, help='extra audio on each side of a block in seconds')
+    split_parser.add_argument('--fs', type=float, default=10000, help='audio sample rate in Hz')
+
+    stitch_parser = subparsers.add_parser("stitch", help='stitch the segmentation of the blocks into one song file')
+    stitch_parser.add_argument('block_folder', type=str, help='folder with the blocks created by split')
+    stitch_parser.add_argument('save_path', type=str, help='path to save the stitched segmentation to')
+    stitch_parser.add_argument('--min_pulse_separation', type=float, default=50, help='minimum distance in samples between pulses of different blocks')
+
+    args = parser.parse_args()
+
+    if args.command == "split":
+        for block_path in split_daq(args.daq_path, args.block_folder, block_seconds=args.block_seconds, overlap_seconds=args.overlap_seconds, fs=args.fs):
+            print(block_path, get_block_song_path(block_path))
+    else:
+        stitch_song(args.block_folder, args.save_path, min_pulse_separation=args.min_pulse_separation)
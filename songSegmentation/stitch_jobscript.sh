@@ -0,0 +1,22 @@
+#!/bin/bash
+#SBATCH --job-name=stitch
+#SBATCH --time=01:00:00
+#SBATCH -N 1
+#SBATCH --cpus-per-task=1
+#SBATCH --mem=32G
+#SBATCH --output='logs/stitch.%j.log'
+
+# Usage: sbatch stitch_jobscript.sh stitch_args.txt
+# Each line of the text file has a block folder created by split_song.py and the path
+# to save the stitched song file to.
+
+text_file="$1"
+
+module load anaconda
+conda activate sleap
+
+while read -r block_folder save_path; do
+    [ -z "$block_folder" ] && continue
+    echo "stitching: $block_folder -> $save_path"
+    python split_song.py stitch "$block_folder" "$save_path"
+done < "$text_file"
@@ -0,0 +1,143 @@
+import os
+import h5py
+import numpy as np
+import pytest
+import scipy.io
+
+import split_song
+
+
+N_SAMPLES = 10500
+BLOCK_SAMPLES = 3000
+OVERLAP_SAMPLES = 400
+
+# Bouts of the full recording. The second and third cross the first and second block
+# boundaries, and the last one ends at the end of the recording.
+BOUT_LIMS = np.array([[100, 900], [2700, 3300], [5500, 6200], [8000, 8500], [10000, 10500]], dtype="float64")
+BOUT_TYPES = np.array(["Pul", "Sin", "Pul", "Mix", "Pul"])
+
+# Pulse centers of the full recording. Pulses in the overlap of two blocks are detected
+# by both. Pulses are further apart than merge_pulses's min_separation, as in real song.
+PULSE_CENTERS = np.array([150, 2800, 2990, 3100, 3250, 5900, 6100, 8100, 10200], dtype="float64")
+
+def make_block_songs(blocks, rng, jitter=3):
+    """Per-block segmentations of the full recording as segment_song_bandstop_daq.m saves them.
+
+    Each block detects the bouts and pulses within the audio it reads. Bouts at the edges
+    of a block are truncated, pulses are detected with a small jitter and the masks are
+    corrupted outside of the samples owned by the block.
+    """
+    sine = np.zeros(N_SAMPLES)
+    for s0, s1 in BOUT_LIMS[BOUT_TYPES == "Sin"].astype(int):
+        sine[s0:s1] = 1
+    songs = []
+    for s0, s1, own0, own1 in blocks:
+        block_sine = sine[s0:s1].copy()
+        block_sine[:own0 - s0] = 2
+        block_sine[own1 - s0:] = 2
+        in_block = (BOUT_LIMS[:, 1] > s0) & (BOUT_LIMS[:, 0] < s1)
+        pulses = PULSE_CENTERS[(PULSE_CENTERS >= s0) & (PULSE_CENTERS < s1)]
+        songs.append({
+            "sine": block_sine,
+            "song": np.arange(s0, s1, dtype="float64"),
+            "bout_lims": np.clip(BOUT_LIMS[in_block], s0, s1) - s0,
+            "bout_types": BOUT_TYPES[in_block],
+            "pulse_centers": pulses - s0 + rng.integers(-jitter, jitter + 1, len(pulses)),
+            "pulse_labels": np.ones(len(pulses)),
+            "Fs": 10000.0,
+        })
+    return songs
+
+@pytest.fixture
+def blocks():
+    return split_song.make_blocks(N_SAMPLES, BLOCK_SAMPLES, OVERLAP_SAMPLES)
+
+def test_make_blocks(blocks):
+    assert len(blocks) == 4
+    np.testing.assert_array_equal(blocks[:, 2], [0, 3000, 6000, 9000])
+    np.testing.assert_array_equal(blocks[:, 3], [3000, 6000, 9000, N_SAMPLES])
+    np.testing.assert_array_equal(blocks[:, 0], np.maximum(blocks[:, 2] - OVERLAP_SAMPLES, 0))
+    np.testing.assert_array_equal(blocks[:, 1], np.minimum(blocks[:, 3] + OVERLAP_SAMPLES, N_SAMPLES))
+
+def test_merge_bouts(blocks):
+    songs = make_block_songs(blocks, np.random.default_rng(0))
+    bout_lims, bout_types = split_song.merge_bouts([x["bout_lims"] for x in songs], [x["bout_types"] for x in songs], blocks)
+    np.testing.assert_array_equal(bout_lims, BOUT_LIMS)
+    np.testing.assert_array_equal(bout_types, BOUT_TYPES)
+
+def test_merge_bouts_of_different_types(blocks):
+    songs = make_block_songs(blocks, np.random.default_rng(0))
+    songs[1]["bout_types"] = np.where(songs[1]["bout_types"] == "Sin", "Pul", songs[1]["bout_types"])
+    bout_lims, bout_types = split_song.merge_bouts([x["bout_lims"] for x in songs], [x["bout_types"] for x in songs], blocks)
+    np.testing.assert_array_equal(bout_lims, BOUT_LIMS)
+    assert bout_types[1] == "Mix"
+
+def test_merge_pulses(blocks):
+    songs = make_block_songs(blocks, np.random.default_rng(0))
+    # Pulses in overlaps are detected by more than one block.
+    assert sum(len(x["pulse_centers"]) for x in songs) > len(PULSE_CENTERS)
+
+    centers, labels = split_song.merge_pulses([x["pulse_centers"] for x in songs], [x["pulse_labels"] for x in songs], blocks)
+    assert len(centers) == len(labels) == len(PULSE_CENTERS)
+    np.testing.assert_allclose(centers, PULSE_CENTERS, atol=3)
+
+    # Each pulse is kept by the block that owns its center.
+    owner = np.searchsorted(blocks[:, 2], PULSE_CENTERS, side="right") - 1
+    for center, i in zip(centers, owner):
+        assert center - blocks[i, 0] in songs[i]["pulse_centers"]
+
+def test_stitch_vector(blocks):
+    songs = make_block_songs(blocks, np.random.default_rng(0))
+    sine = split_song.stitch_vector([x["sine"] for x in songs], blocks, N_SAMPLES)
+    song = split_song.stitch_vector([x["song"] for x in songs], blocks, N_SAMPLES)
+    np.testing.assert_array_equal(song, np.arange(N_SAMPLES))
+    assert set(np.unique(sine)) == {0, 1}
+    np.testing.assert_array_equal(np.flatnonzero(np.diff(sine)) + 1, [2700, 3300])
+
+    with pytest.raises(ValueError):
+        split_song.stitch_vector([x["sine"][1:] for x in songs], blocks, N_SAMPLES)
+
+def test_split_and_stitch(tmp_path):
+    rng = np.random.default_rng(0)
+    daq_path = str(tmp_path / "daq.h5")
+    with h5py.File(daq_path, "w") as f:
+        f.create_dataset("audio", data=rng.normal(size=(N_SAMPLES, 2)).astype("float32"))
+
+    block_folder = str(tmp_path / "song_blocks")
+    block_paths = split_song.split_daq(daq_path, block_folder, block_seconds=0.3, overlap_seconds=0.04)
+    assert len(block_paths) == 4
+
+    # Save the segmentation of each block with the layout of MATLAB.
+    blocks = split_song.make_blocks(N_SAMPLES, BLOCK_SAMPLES, OVERLAP_SAMPLES)
+    for block_path, song, (s0, s1, _, _) in zip(block_paths, make_block_songs(blocks, rng), blocks):
+        with h5py.File(block_path, "r") as f:
+            assert f["audio"].shape == (s1 - s0, 2)
+            assert f.attrs["sample_offset"] == s0
+        scipy.io.savemat(split_song.get_block_song_path(block_path), {
+            "sine": song["sine"][:, None],
+            "song": song["song"][:, None],
+            "bInf": {"stEn": song["bout_lims"], "Type": np.array(song["bout_types"], dtype=object).reshape(-1, 1), "Mask": np.zeros((s1 - s0, 1))},
+            "pInf": {"wc": song["pulse_centers"][:, None]},
+            "pulseLabels": song["pulse_labels"][:, None],
+            "Fs": song["Fs"],
+        })
+
+    save_path = str(tmp_path / "song_new.mat")
+    split_song.stitch_song(block_folder, save_path)
+
+    seg = scipy.io.loadmat(save_path)
+    np.testing.assert_array_equal(seg["song"].squeeze(), np.arange(N_SAMPLES))
+    np.testing.assert_array_equal(seg["bInf"]["stEn"][0][0], BOUT_LIMS)
+    assert seg["bInf"]["Type"][0][0].shape == (len(BOUT_TYPES), 1)
+    np.testing.assert_array_equal([str(np.squeeze(t)) for t in seg["bInf"]["Type"][0][0].ravel()], BOUT_TYPES)
+    assert seg["pInf"]["wc"][0][0].shape == (len(PULSE_CENTERS), 1)
+
+def test_stitch_missing_block(tmp_path):
+    daq_path = str(tmp_path / "daq.h5")
+    with h5py.File(daq_path, "w") as f:
+        f.create_dataset("audio", data=np.zeros((N_SAMPLES, 1), dtype="float32"))
+    block_folder = str(tmp_path / "song_blocks")
+    split_song.split_daq(daq_path, block_folder, block_seconds=0.3, overlap_seconds=0.04)
+    with pytest.raises(FileNotFoundError):
+        split_song.stitch_song(block_folder, str(tmp_path / "song_new.mat"))
+    assert not os.path.exists(tmp_path / "song_new.mat")
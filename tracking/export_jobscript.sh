@@ -9,18 +9,12 @@
 
 # Split up text file
 text_file="$1"
-linenum=$SLURM_ARRAY_TASK_ID
-linenum=$((linenum-1))
-OLDIFS=$IFS
-IFS=$'\n'
-
-array=( $(grep "[a-z]" $text_file) )
-linetxt=${array["$linenum"]}
+# read only this task's line of the text file (one line per array task)
+linetxt=$(sed -n "${SLURM_ARRAY_TASK_ID}p" "$text_file")
 echo "$linetxt"
 
 # Split up line
-IFS=$OLDIFS
-delim=' ' read -r -a linearray <<< "$linetxt"
+read -r -a linearray <<< "$linetxt"
 
 module load anaconda
 conda activate sleap
@@ -10,21 +10,12 @@
 ##SBATCH --ntasks-per-node=1
 
 text_file="$1"
-linenum=$SLURM_ARRAY_TASK_ID
-linenum=$((linenum-1))
-
-# will be saved to log files in /log
-echo $linenum
-OLDIFS=$IFS
-IFS=$'\n'
-
-array=( $(grep "[a-z]" $text_file) )
-linetxt=${array["$linenum"]}
-
+# read only this task's line of the text file (one line per array task)
+linetxt=$(sed -n "${SLURM_ARRAY_TASK_ID}p" "$text_file")
 echo "$linetxt"
 
-IFS=$OLDIFS
-delim=' ' read -r -a linearray <<< "$linetxt"
+# Split up line
+read -r -a linearray <<< "$linetxt"
 
 
 # tigress modules